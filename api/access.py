@@ -0,0 +1,33 @@
+"""
+Эффективные права на блоки (таблица api_blockaccess).
+
+Правила:
+    * visible_to_users дают просмотр, editable_by_users - просмотр и редактирование;
+    * то же для групп: visible_blocks / editable_blocks группы дают права каждому её участнику.
+      Группы раскрываются в строки по пользователям здесь, поэтому чтение дерева и проверки прав
+      не зависят от числа групп пользователя;
+    * блок с access_type = 'inherited' получает ещё и все права своих родителей;
+    * private / public / public_ed наследование прерывают;
+    * public виден всем, public_ed всем виден и доступен для редактирования - строк для этого не нужно.
+"""
+from django.db import connection
+
+from .models import Group
+from .query import refresh_block_access_query
+
+
+def refresh_block_access(block_ids):
+    """Пересчитывает права для block_ids и их inherited-потомков, возвращает id блоков, где права изменились."""
+    if not block_ids:
+        return set()
+    with connection.cursor() as cursor:
+        cursor.execute(refresh_block_access_query, {'block_ids': list(block_ids)})
+        return {row[0] for row in cursor.fetchall()}
+
+
+def group_block_ids(group_ids):
+    """id блоков, которые группы group_ids делают видимыми или редактируемыми."""
+    return (set(Group.visible_blocks.through.objects
+                .filter(group_id__in=group_ids).values_list('block_id', flat=True)) |
+            set(Group.editable_blocks.through.objects
+                .filter(group_id__in=group_ids).values_list('block_id', flat=True)))
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.contrib.postgres.search import SearchQuery
 from .models import Block
 from django import forms
 
@@ -11,12 +12,22 @@ class BlockAdminForm(forms.ModelForm):
 
 class BlockAdmin(admin.ModelAdmin):
     list_display = ('id', 'creator', 'text', 'created_at', 'get_editable_users')
-    search_fields = ('text', 'creator__username')
+    search_fields = ('creator__username',)
     list_filter = ('created_at', 'creator')
     date_hierarchy = 'created_at'
     form = BlockAdminForm
     filter_horizontal = ('visible_to_users', 'editable_by_users', 'children')
 
+    def get_search_results(self, request, queryset, search_term):
+        # Текст ищется по индексу search_vector, а не через ILIKE. Поиск идёт по пришедшему queryset,
+        # чтобы не терять фильтры списка
+        filtered = queryset
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            query = SearchQuery(search_term, config='simple', search_type='websearch')
+            queryset |= filtered.filter(search_vector=query)
+        return queryset, may_have_duplicates
+
     def get_editable_users(self, obj):
         return ", ".join([user.username for user in obj.editable_by_users.all()])
     get_editable_users.short_description = 'Editable Users'  # Название столбца в админке
@@ -0,0 +1,61 @@
+"""
+Пул соединений psycopg 3 для асинхронных вью (api/async_views.py).
+
+Django ORM под ASGI выполняет запросы в пуле потоков, поэтому медленные запросы дерева держат
+по потоку на запрос. Здесь запросы идут через собственный асинхронный пул и не блокируют event loop.
+"""
+import asyncio
+
+from django.conf import settings
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+_pool = None
+_pool_lock = None
+
+
+async def get_pool():
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            db = settings.DATABASES['default']
+            conninfo = make_conninfo(dbname=db['NAME'],
+                                     user=db.get('USER') or None,
+                                     password=db.get('PASSWORD') or None,
+                                     host=db.get('HOST') or None,
+                                     port=db.get('PORT') or None)
+            options = getattr(settings, 'ASYNC_DB_POOL', {})
+            pool = AsyncConnectionPool(conninfo,
+                                       min_size=options.get('min_size', 2),
+                                       max_size=options.get('max_size', 20),
+                                       timeout=options.get('timeout', 30),
+                                       # Соединение проверяется перед выдачей из пула
+                                       check=AsyncConnectionPool.check_connection,
+                                       kwargs={'autocommit': True,
+                                               'prepare_threshold': options.get('prepare_threshold', 5)},
+                                       open=False)
+            await pool.open()
+            _pool = pool
+    return _pool
+
+
+async def fetch_all(query, params):
+    """Возвращает (columns, rows)."""
+    pool = await get_pool()
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(query, params)
+            columns = [col.name for col in cursor.description]
+            return columns, await cursor.fetchall()
+
+
+async def fetch_one(query, params):
+    pool = await get_pool()
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchone()
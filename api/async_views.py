@@ -0,0 +1,221 @@
+"""
+Асинхронные версии чтения дерева и истории изменений для ASGI.
+Запросы идут через пул psycopg 3 (api/async_db.py), а не через Django ORM.
+"""
+import asyncio
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, NotFound
+from rest_framework.utils.encoders import JSONEncoder
+from django.utils.http import quote_etag
+from django.utils.translation import gettext_lazy as _
+
+from .async_db import fetch_all, fetch_one
+from .authentication import StatelessJWTAuthentication, revocations
+from .cache import get_tree_cache
+from .events import get_broker, read_events_ticket
+from .models import DEFAULT_TREE_DEPTH
+from .pagination import ChangeLogKeysetPagination
+from .profiles import root_block_claim
+from .query import (flat_map_json_query,
+                    subtree_version_query,
+                    can_view_block_query,
+                    block_changelog_query,
+                    block_changelog_before_query,
+                    root_block_query)
+from .serializers import TreeParamsSerializer
+from .views import (INFORM_BLOCK_ID,
+                    INFORM_BLOCK_USER_ID,
+                    is_not_modified,
+                    json_response,
+                    set_version_headers,
+                    _tree_query_params)
+
+
+SSE_KEEPALIVE_SECONDS = 15
+
+
+async def _authenticate(request):
+    """Пользователь из JWT или None для анонимного запроса. При плохом токене - AuthenticationFailed."""
+    result = await sync_to_async(StatelessJWTAuthentication().authenticate)(request)
+    return result[0] if result else None
+
+
+async def _events_user_id(request, block_id):
+    """
+    id пользователя для подписки на события: из заголовка Authorization или из ?ticket=
+    (api/events.py), None для анонимного запроса. При плохом токене или билете - AuthenticationFailed.
+    """
+    ticket = request.GET.get('ticket')
+    if ticket is None or StatelessJWTAuthentication().get_header(request):
+        user = await _authenticate(request)
+        return user.id if user is not None else None
+    user_id = read_events_ticket(ticket, block_id)
+    if user_id is None or await sync_to_async(revocations.is_revoked)(user_id):
+        raise AuthenticationFailed({'detail': _('Ticket is invalid or expired'), 'code': 'bad_ticket'})
+    return user_id
+
+
+def _json(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False,
+                        json_dumps_params={'ensure_ascii': False})
+
+
+async def aget_subtree_version(user_id, block_id, depth=DEFAULT_TREE_DEPTH, max_children=None):
+    updated_at, change_seq, revisions, paths_count, is_visible, change_version = await fetch_one(
+        subtree_version_query, {'user_id': user_id, 'block_id': block_id, 'max_depth': depth})
+    version = (f'{user_id}:{block_id}:{depth}:{max_children}:json:'
+               f'{change_seq}:{revisions}:{paths_count}:{is_visible}')
+    return 'W/' + quote_etag(hashlib.md5(version.encode()).hexdigest()), updated_at, change_version
+
+
+async def aget_flat_map_json(user_id, block_id, depth=DEFAULT_TREE_DEPTH, max_children=None, etag=None):
+    """
+    Асинхронный get_flat_map_json, общий с ним ключ кэша. Бэкенд кэша синхронный (SharedTreeCache ходит
+    в django CACHES по сети), поэтому вызывается через sync_to_async, чтобы не блокировать цикл событий.
+    """
+    tree_cache = get_tree_cache()
+    key = (user_id, block_id, depth, max_children, 'json', etag)
+    result = await sync_to_async(tree_cache.get)(key)
+    if result is None:
+        generation = await sync_to_async(tree_cache.generation)()
+        document, block_ids = await fetch_one(flat_map_json_query,
+                                              _tree_query_params(user_id, [block_id], depth, max_children))
+        result = document.encode()
+        await sync_to_async(tree_cache.set)(key, result, set(block_ids) | {block_id}, generation)
+    return result
+
+
+async def _tree_response(request, user_id, block_id, params):
+    etag, last_modified, change_version = await aget_subtree_version(user_id, block_id, **params)
+    if is_not_modified(request, etag):
+        return set_version_headers(HttpResponse(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified,
+                                   change_version)
+    data = await aget_flat_map_json(user_id, block_id, **params, etag=etag)
+    return set_version_headers(json_response(data), etag, last_modified, change_version)
+
+
+async def block_tree(request, pk):
+    if request.method != 'GET':
+        return HttpResponse(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    try:
+        user = await _authenticate(request)
+    except AuthenticationFailed as error:
+        return _json(error.detail, status.HTTP_401_UNAUTHORIZED)
+
+    if user is None:
+        data = await aget_flat_map_json(INFORM_BLOCK_USER_ID, INFORM_BLOCK_ID)
+        return json_response(data, status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
+
+    params = TreeParamsSerializer(data=request.GET)
+    if not params.is_valid():
+        return _json(params.errors, status.HTTP_400_BAD_REQUEST)
+    return await _tree_response(request, user.id, pk, params.validated_data)
+
+
+async def root_block_tree(request):
+    if request.method != 'GET':
+        return HttpResponse(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    try:
+        user = await _authenticate(request)
+    except AuthenticationFailed as error:
+        return _json(error.detail, status.HTTP_401_UNAUTHORIZED)
+
+    if user is None:
+        data = await aget_flat_map_json(INFORM_BLOCK_USER_ID, INFORM_BLOCK_ID)
+        return json_response(data, status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
+
+    block_id = root_block_claim(user)
+    if block_id is None:
+        row = await fetch_one(root_block_query, {'user_id': user.id})
+        block_id = row[0] if row is not None else None
+    if block_id is None:
+        return _json({'error': 'Root block not found.'}, status.HTTP_404_NOT_FOUND)
+    return await _tree_response(request, user.id, block_id, {'depth': DEFAULT_TREE_DEPTH, 'max_children': None})
+
+
+async def block_changelog(request, pk):
+    if request.method != 'GET':
+        return HttpResponse(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    try:
+        user = await _authenticate(request)
+    except AuthenticationFailed as error:
+        return _json(error.detail, status.HTTP_401_UNAUTHORIZED)
+    if user is None:
+        return _json({}, status.HTTP_401_UNAUTHORIZED)
+
+    row = await fetch_one(can_view_block_query, {'user_id': user.id, 'block_id': pk})
+    if row is None:
+        return _json({'error': 'Block not found.'}, status.HTTP_404_NOT_FOUND)
+    if not row[0]:
+        return _json({'error': 'You do not have permission to view this block.'}, status.HTTP_401_UNAUTHORIZED)
+
+    paginator = ChangeLogKeysetPagination()
+    try:
+        reverse, params = paginator.get_page_params(request)
+    except NotFound as error:
+        return _json({'detail': error.detail}, status.HTTP_404_NOT_FOUND)
+    columns, rows = await fetch_all(block_changelog_before_query if reverse else block_changelog_query,
+                                    {'block_id': pk, **params})
+    data = []
+    for values in rows:
+        entry = dict(zip(columns, values))
+        entry['changed_by'] = {'id': entry.pop('changed_by_id'),
+                               'username': entry.pop('changed_by_username'),
+                               'email': entry.pop('changed_by_email')}
+        data.append(entry)
+    return _json(paginator.get_paginated_data(data, reverse))
+
+
+async def block_events(request, pk):
+    """
+    Server-Sent Events об изменениях в поддереве блока pk. События только уведомляют,
+    данные клиент догружает через GET /block/<pk>/changes/. EventSource в браузере вместо заголовка
+    передаёт ?ticket= из POST /block/<pk>/events/ticket/.
+    """
+    if request.method != 'GET':
+        return HttpResponse(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    try:
+        user_id = await _events_user_id(request, pk)
+    except AuthenticationFailed as error:
+        return _json(error.detail, status.HTTP_401_UNAUTHORIZED)
+    if user_id is None:
+        return _json({}, status.HTTP_401_UNAUTHORIZED)
+
+    row = await fetch_one(can_view_block_query, {'user_id': user_id, 'block_id': pk})
+    if row is None:
+        return _json({'error': 'Block not found.'}, status.HTTP_404_NOT_FOUND)
+    if not row[0]:
+        return _json({'error': 'You do not have permission to view this block.'}, status.HTTP_403_FORBIDDEN)
+
+    response = StreamingHttpResponse(_event_stream(user_id, pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def _event_stream(user_id, block_id):
+    async with get_broker().subscribe() as queue:
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+
+            ancestors = event.get('ancestors')
+            if ancestors is not None and block_id not in ancestors and event['type'] != 'resync':
+                continue
+            if event['type'] == 'access':
+                # Права могли отобрать: проверяем заново, прежде чем слать что-то дальше
+                row = await fetch_one(can_view_block_query, {'user_id': user_id, 'block_id': block_id})
+                if not row or not row[0]:
+                    yield 'event: revoked\ndata: {}\n\n'
+                    return
+            payload = {key: value for key, value in event.items() if key != 'ancestors'}
+            yield f'event: change\ndata: {json.dumps(payload)}\n\n'
@@ -0,0 +1,132 @@
+"""
+Аутентификация по JWT без запроса пользователя из базы.
+
+Вью нужны только user.id и is_authenticated, поэтому StatelessJWTAuthentication собирает
+пользователя (TokenUser) из проверенных полей токена. Отзыв проверяется по множеству пользователей
+в памяти воркера: выключенные и удалённые (таблица DeletedUser, строка живёт, пока могут быть живы
+выданные им access-токены). Множество перечитывается раз в REVOCATION_REFRESH_SECONDS, так что
+отзыв доходит до всех воркеров с этой задержкой.
+
+    JWT_AUTHENTICATION = {
+        'USER_LOOKUP': 'token',  # token - TokenUser; cache - User из кэша на USER_CACHE_TTL; db - User из базы
+        'USER_CACHE_TTL': 60,
+        'REVOCATION_REFRESH_SECONDS': 30,
+    }
+
+Blacklist simplejwt хранит только refresh-токены: выход из системы запрещает получать новые
+access-токены, но уже выданный access-токен действует до истечения.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .query import add_deleted_user_query, prune_deleted_users_query, revoked_users_query
+
+DEFAULTS = {
+    'USER_LOOKUP': 'token',
+    'USER_CACHE_TTL': 60,
+    'REVOCATION_REFRESH_SECONDS': 30,
+}
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'JWT_AUTHENTICATION', {})}
+
+
+def _token_lifetime():
+    return int(jwt_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+class Revocations:
+    """Отозванные пользователи; перечитываются из базы не чаще раза в refresh_seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self.user_ids = frozenset()
+
+    def _refresh(self):
+        options = _options()
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < options['REVOCATION_REFRESH_SECONDS']:
+            return
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < options['REVOCATION_REFRESH_SECONDS']:
+                return
+            with connection.cursor() as cursor:
+                cursor.execute(revoked_users_query, {'token_lifetime': _token_lifetime()})
+                user_ids = frozenset(row[0] for row in cursor.fetchall())
+            self.user_ids, self._loaded_at = user_ids, now
+
+    def is_revoked(self, user_id):
+        self._refresh()
+        return user_id in self.user_ids
+
+    def revoke_user(self, user_id, deleted=False):
+        """Отзывает токены пользователя в этом воркере сразу, в остальных - при следующем обновлении."""
+        if deleted:
+            # Строки удалённого пользователя нет, помним его отдельно, пока его токены не истекут
+            params = {'user_id': user_id, 'token_lifetime': _token_lifetime()}
+            with connection.cursor() as cursor:
+                cursor.execute(prune_deleted_users_query, params)
+                cursor.execute(add_deleted_user_query, params)
+        with self._lock:
+            self.user_ids = self.user_ids | {user_id}
+
+
+revocations = Revocations()
+
+
+class UserCache:
+    """Пользователи по id на ttl секунд в памяти воркера."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}  # user_id -> (загружен в, пользователь)
+
+    def get(self, user_id, ttl):
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is not None and now - entry[0] < ttl:
+            return entry[1]
+        user = get_user_model().objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).first()
+        with self._lock:
+            self._users = {key: value for key, value in self._users.items() if now - value[0] < ttl}
+            self._users[user_id] = (now, user)
+        return user
+
+    def discard(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+
+user_cache = UserCache()
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        if revocations.is_revoked(user_id):
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        options = _options()
+        if options['USER_LOOKUP'] == 'db':
+            return super().get_user(validated_token)
+        if options['USER_LOOKUP'] == 'cache':
+            user = user_cache.get(user_id, options['USER_CACHE_TTL'])
+            if user is None:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            if not user.is_active:
+                raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+            return user
+        return jwt_settings.TOKEN_USER_CLASS(validated_token)
@@ -0,0 +1,9 @@
+"""
+Нагрузочные замеры на синтетических графах блоков.
+
+    python manage.py generate_block_graph --shape dag --size 100000
+    python manage.py run_block_benchmarks --output bench.json --compare previous.json
+
+generator строит графы в текущей базе, runner замеряет чтение дерева и изменения блоков
+и пишет результаты в JSON, пригодный для сравнения между коммитами.
+"""
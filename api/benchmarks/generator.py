@@ -0,0 +1,130 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from ..access import refresh_block_access
+from ..hierarchy import add_block_paths, link_block_paths
+from ..models import Block, Profile
+
+User = get_user_model()
+
+BENCH_USER_PREFIX = 'bench_'
+SIZES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+
+# Сколько детей у блока и сколько дополнительных родителей у ребёнка (общие дети в DAG)
+SHAPES = {
+    'wide': {'fanout': 200, 'extra_parents': 0},
+    'deep': {'fanout': 2, 'extra_parents': 0},
+    'dag': {'fanout': 8, 'extra_parents': 2},
+}
+ACCESS_TYPE_WEIGHTS = {'inherited': 70, 'private': 10, 'public': 15, 'public_ed': 5}
+# Доля блоков с явными правами для других пользователей графа
+GRANT_RATIO = 0.02
+GRAPH_USERS = 5
+BATCH_SIZE = 5000
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _analyze(*tables):
+    """
+    Статистика по таблицам, заполняемым внутри транзакции генерации: автоанализ её строк не видит,
+    и планировщик выбирал бы для запросов BlockPath план по размерам до генерации.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'ANALYZE {", ".join(tables)}')
+
+
+def _levels(size, fanout):
+    """Размеры уровней дерева: корень, затем каждый уровень в fanout раз шире, пока не наберётся size блоков."""
+    levels, total, width = [], 0, 1
+    while total < size:
+        width = min(width, size - total)
+        levels.append(width)
+        total += width
+        width *= fanout
+    return levels
+
+
+def generate_block_graph(shape, size, seed=0, stdout=None):
+    """
+    Создаёт пользователей графа и size блоков формы shape. Возвращает (user_id, root_id).
+    Связи, пути BlockPath и права заполняются пакетно, минуя сигналы одиночных изменений.
+    """
+    params = SHAPES[shape]
+    rng = random.Random(seed)
+    access_types, weights = zip(*ACCESS_TYPE_WEIGHTS.items())
+
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    with transaction.atomic():
+        suffix = User.objects.filter(username__startswith=f'{BENCH_USER_PREFIX}{shape}_{size}_',
+                                     username__endswith='_0').count()
+        users = [User.objects.create_user(username=f'{BENCH_USER_PREFIX}{shape}_{size}_{suffix}_{index}',
+                                          password=None)
+                 for index in range(GRAPH_USERS)]
+        owner = users[0]
+
+        levels = []
+        for depth, width in enumerate(_levels(size, params['fanout'])):
+            blocks = [Block(creator=owner,
+                            text=f'{shape} block {depth}.{index} lorem ipsum dolor sit amet',
+                            access_type='private' if depth == 0 else rng.choices(access_types, weights)[0])
+                      for index in range(width)]
+            created = []
+            for chunk in _chunks(blocks):
+                created.extend(Block.objects.bulk_create(chunk))
+            levels.append([block.pk for block in created])
+            add_block_paths(levels[-1])
+            log(f'level {depth}: {width} blocks')
+
+        root_id = levels[0][0]
+        Profile.objects.create(user=owner, root_block_id=root_id)
+        through = Block.children.through
+        for parents, children in zip(levels, levels[1:]):
+            edges = [(parents[index // params['fanout']], child_id) for index, child_id in enumerate(children)]
+            for child_id in children:
+                for _ in range(params['extra_parents']):
+                    edges.append((rng.choice(parents), child_id))
+            edges = list(dict.fromkeys(edges))
+            for chunk in _chunks(edges):
+                through.objects.bulk_create([through(from_block_id=parent_id, to_block_id=child_id)
+                                             for parent_id, child_id in chunk])
+            # Уровень связывается целиком после предыдущего: у детей ещё нет потомков,
+            # поэтому link_block_paths получает полный набор путей к ним. Рёбра одного ребёнка идут
+            # в одну пачку, чтобы строки BlockPath с общими предками сложились при вставке, а не обновлением
+            _analyze('api_blockpath')
+            for chunk in _chunks(sorted(edges, key=lambda edge: edge[1])):
+                link_block_paths(chunk)
+
+        all_ids = [block_id for level in levels for block_id in level]
+        # Создатель получает права на каждый блок, как в Block.save, остальные - на часть блоков
+        visible = [(block_id, owner.pk) for block_id in all_ids]
+        visible += [(block_id, rng.choice(users[1:]).pk)
+                    for block_id in rng.sample(all_ids, int(len(all_ids) * GRANT_RATIO))]
+        for field, grants in ((Block.visible_to_users, visible),
+                              (Block.editable_by_users, [(block_id, owner.pk) for block_id in all_ids])):
+            for chunk in _chunks(grants):
+                field.through.objects.bulk_create([field.through(block_id=block_id, user_id=user_id)
+                                                   for block_id, user_id in chunk])
+        _analyze('api_block', 'api_block_children', 'api_block_visible_to_users', 'api_block_editable_by_users',
+                 'api_blockaccess', 'api_blockpath')
+        refresh_block_access(all_ids)
+        log(f'{shape}/{size}: {len(all_ids)} blocks, depth {len(levels)}, root {root_id}, user {owner.pk}')
+    return owner.pk, root_id
+
+
+def find_block_graphs():
+    """Сгенерированные графы: [(username, user_id, root_id)]. Корень - Profile.root_block владельца, как в RootBlockView."""
+    graphs = []
+    for profile in (Profile.objects.filter(user__username__startswith=BENCH_USER_PREFIX,
+                                           user__username__endswith='_0', root_block__isnull=False)
+                    .select_related('user').order_by('user_id')):
+        graphs.append((profile.user.username[:-len('_0')], profile.user_id, profile.root_block_id))
+    return graphs
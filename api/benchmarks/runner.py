@@ -0,0 +1,166 @@
+import json
+import math
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ..cache import get_tree_cache
+from ..models import Block, BlockPath, DEFAULT_TREE_DEPTH
+from ..views import BlockView, DeleteBlockView
+
+User = get_user_model()
+
+SCENARIOS = ('tree_cold', 'tree_warm', 'patch', 'post', 'delete')
+# Сколько блоков поддерева берётся кандидатами для изменений
+TARGET_SAMPLE = 1000
+
+
+def percentile(samples, percent):
+    """Перцентиль по ближайшему рангу."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def summarize(timings, query_counts):
+    return {
+        'iterations': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'queries_p50': percentile(query_counts, 50),
+        'queries_max': max(query_counts),
+    }
+
+
+class GraphBenchmark:
+    """
+    Замеры для одного графа. Изменения выполняются в транзакции, которая откатывается,
+    поэтому граф не меняется между итерациями и прогонами (on_commit-обработчики при этом не вызываются).
+    """
+
+    def __init__(self, user_id, root_id, depth=DEFAULT_TREE_DEPTH, seed=0):
+        self.user = User.objects.get(pk=user_id)
+        self.root_id = root_id
+        self.depth = depth
+        self.rng = random.Random(seed)
+        self.factory = APIRequestFactory()
+        descendant_ids = list(BlockPath.objects
+                              .filter(ancestor_id=root_id, depth__gte=1, depth__lt=depth)
+                              .values_list('descendant_id', flat=True)
+                              .distinct()[:TARGET_SAMPLE])
+        self.block_ids = descendant_ids or [root_id]
+        self.edges = list(Block.children.through.objects
+                          .filter(from_block_id__in=[root_id] + descendant_ids)
+                          .values_list('from_block_id', 'to_block_id')[:TARGET_SAMPLE])
+
+    def run(self, scenario, iterations):
+        timings, query_counts = [], []
+        action = getattr(self, f'_{scenario}')
+        for _ in range(iterations):
+            prepare = getattr(self, f'_prepare_{scenario}', None)
+            if prepare is not None:
+                prepare()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                action()
+                timings.append((time.perf_counter() - started) * 1000)
+            query_counts.append(len(queries))
+        return summarize(timings, query_counts)
+
+    # Дерево читается через BlockView.get, как клиентом: ETag, кэш и ответ с готовым JSON
+    def _prepare_tree_cold(self):
+        get_tree_cache().invalidate([self.root_id])
+
+    def _tree_cold(self):
+        self._get_tree()
+
+    def _prepare_tree_warm(self):
+        self._get_tree()
+
+    def _tree_warm(self):
+        self._get_tree()
+
+    def _get_tree(self):
+        request = self.factory.get(f'/api/block/{self.root_id}/', {'depth': self.depth})
+        force_authenticate(request, user=self.user)
+        response = BlockView.as_view()(request, pk=self.root_id)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {request.path} -> {response.status_code}')
+
+    def _patch(self):
+        block_id = self.rng.choice(self.block_ids)
+        request = self.factory.patch(f'/api/block/{block_id}/', {'text': 'benchmark patch'}, format='json')
+        self._call(BlockView.as_view(), request, pk=block_id)
+
+    def _post(self):
+        request = self.factory.post('/api/block/', {'text': 'benchmark post'}, format='json')
+        self._call(BlockView.as_view(), request)
+
+    def _delete(self):
+        parent_id, child_id = self.rng.choice(self.edges)
+        parent = Block.objects.get(pk=parent_id)
+        children = [block_id for block_id in parent.children.values_list('id', flat=True) if block_id != child_id]
+        data = {'parent': {'id': parent_id, 'classList': parent.classList or ['benchmark'], 'children': children},
+                'child': {'id': child_id}}
+        request = self.factory.delete('/api/remove-block/', data, format='json')
+        self._call(DeleteBlockView.as_view(), request)
+
+    def _call(self, view, request, **kwargs):
+        force_authenticate(request, user=self.user)
+        with transaction.atomic():
+            response = view(request, **kwargs)
+            transaction.set_rollback(True)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{request.method} {request.path} -> {response.status_code}: {response.data}')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(graphs, scenarios=SCENARIOS, iterations=50, depth=DEFAULT_TREE_DEPTH):
+    """graphs - [(name, user_id, root_id)]. Возвращает словарь для файла результатов."""
+    results = []
+    for name, user_id, root_id in graphs:
+        benchmark = GraphBenchmark(user_id, root_id, depth)
+        blocks = BlockPath.objects.filter(ancestor_id=root_id).values('descendant_id').distinct().count()
+        for scenario in scenarios:
+            results.append({'graph': name, 'blocks': blocks, 'scenario': scenario,
+                            **benchmark.run(scenario, iterations)})
+    return {
+        'revision': git_revision(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'database': f'{connection.vendor} {connection.pg_version if connection.vendor == "postgresql" else ""}'.strip(),
+        'depth': depth,
+        'results': results,
+    }
+
+
+def compare_results(current, baseline):
+    """Изменение p50/p95/p99 и числа запросов относительно baseline: [(graph, scenario, metric, было, стало, %)]."""
+    previous = {(row['graph'], row['scenario']): row for row in baseline['results']}
+    changes = []
+    for row in current['results']:
+        old = previous.get((row['graph'], row['scenario']))
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_p50'):
+            delta = (row[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            changes.append((row['graph'], row['scenario'], metric, old[metric], row[metric], round(delta, 1)))
+    return changes
+
+
+def write_results(path, data):
+    with open(path, 'w') as output:
+        json.dump(data, output, indent=2)
@@ -0,0 +1,203 @@
+"""
+Кэш деревьев get_flat_map_json.
+
+Записи хранятся по ключу (user_id, block_id, depth, ..., etag). ETag поддерева входит в ключ, поэтому
+свежий ETag никогда не отдаётся со старым телом, даже если сброс до этого процесса не дошёл.
+Для каждой записи запоминается набор блоков, из которых она собрана (обратный индекс
+block_id -> ключи), чтобы при изменении любого блока сбрасывать только затронутые поддеревья.
+
+Бэкенд задаётся настройкой BLOCK_TREE_CACHE:
+
+    BLOCK_TREE_CACHE = {
+        'BACKEND': 'api.cache.LocMemTreeCache',
+        'OPTIONS': {'max_bytes': 64 * 1024 * 1024, 'timeout': 60},
+    }
+
+LocMemTreeCache живёт внутри процесса: сброс после изменения доходит только до своего воркера,
+в остальных запись живёт не дольше timeout (для ответов без ETag, например информационного блока).
+При нескольких воркерах лучше SharedTreeCache поверх одного из django CACHES
+(в тестах его можно направить на locmem-алиас).
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class TreeCache:
+    def generation(self):
+        """Текущее поколение кэша, берётся до чтения из базы и передаётся в set()."""
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, block_ids, generation):
+        """Не сохраняет value, если после generation была инвалидация."""
+        raise NotImplementedError
+
+    def invalidate(self, block_ids):
+        raise NotImplementedError
+
+
+class LocMemTreeCache(TreeCache):
+    def __init__(self, max_bytes=64 * 1024 * 1024, timeout=60):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._entries = OrderedDict()  # key -> (payload, block_ids, expires_at)
+        self._index = {}  # block_id -> set(keys)
+        self._size = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            payload = entry[0]
+        return pickle.loads(payload)
+
+    def set(self, key, value, block_ids, generation):
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        block_ids = frozenset(block_ids)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._discard(key)
+            self._entries[key] = (payload, block_ids, time.monotonic() + self.timeout)
+            self._size += len(payload)
+            for block_id in block_ids:
+                self._index.setdefault(block_id, set()).add(key)
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, block_ids):
+        with self._lock:
+            self._generation += 1
+            for block_id in block_ids:
+                for key in list(self._index.get(block_id, ())):
+                    self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        payload, block_ids, _ = entry
+        self._size -= len(payload)
+        for block_id in block_ids:
+            keys = self._index.get(block_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[block_id]
+
+
+class SharedTreeCache(TreeCache):
+    """
+    Кэш поверх django.core.cache. У каждого блока свой счётчик изменений, invalidate() увеличивает
+    его атомарным incr. Запись хранит счётчики своих блоков на момент сохранения и при чтении
+    сверяет их с текущими: обратного индекса и его read-modify-write нет, устаревшая запись просто
+    не отдаётся и истекает по timeout.
+
+    Порядок важен: set() берёт счётчики блоков, потом сверяет общее поколение с тем, что было до чтения
+    из базы; invalidate() увеличивает сначала общее поколение, потом счётчики блоков. Поэтому изменение,
+    закоммиченное после чтения из базы, либо не даст сохранить запись, либо сменит счётчик после того,
+    как запись его запомнила.
+    """
+    prefix = 'blocktree'
+
+    def __init__(self, alias='default', timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation(self):
+        return self.cache.get_or_set(self._generation_key(), 0, None)
+
+    def get(self, key):
+        entry = self.cache.get(self._entry_key(key))
+        if entry is None:
+            return None
+        value, counters = entry
+        if self.cache.get_many(counters.keys()) != counters:
+            return None
+        return value
+
+    def set(self, key, value, block_ids, generation):
+        counters = self._block_counters(block_ids)
+        if self.generation() != generation:
+            return
+        self.cache.set(self._entry_key(key), (value, counters), self.timeout)
+
+    def invalidate(self, block_ids):
+        self._incr(self._generation_key())
+        for block_id in block_ids:
+            self._incr(self._counter_key(block_id))
+
+    def _block_counters(self, block_ids):
+        keys = [self._counter_key(block_id) for block_id in block_ids]
+        counters = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in counters]
+        if missing:
+            # add не перезапишет счётчик, который успели увеличить
+            for key in missing:
+                self.cache.add(key, 0, None)
+            counters.update(self.cache.get_many(missing))
+        return counters
+
+    def _incr(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, 0, None)
+            self.cache.incr(key)
+
+    def _generation_key(self):
+        return f'{self.prefix}:generation'
+
+    def _entry_key(self, key):
+        return f'{self.prefix}:entry:' + ':'.join(str(part) for part in key)
+
+    def _counter_key(self, block_id):
+        return f'{self.prefix}:block:{block_id}'
+
+
+_tree_cache = None
+_tree_cache_lock = threading.Lock()
+
+
+def get_tree_cache():
+    global _tree_cache
+    if _tree_cache is None:
+        with _tree_cache_lock:
+            if _tree_cache is None:
+                config = getattr(settings, 'BLOCK_TREE_CACHE', {})
+                backend = import_string(config.get('BACKEND', 'api.cache.LocMemTreeCache'))
+                _tree_cache = backend(**config.get('OPTIONS', {}))
+    return _tree_cache
+
+
+def invalidate_trees(block_ids):
+    """Сбрасывает закэшированные поддеревья, содержащие block_ids, после коммита текущей транзакции."""
+    block_ids = set(block_ids)
+    if block_ids:
+        transaction.on_commit(partial(get_tree_cache().invalidate, block_ids))
@@ -0,0 +1,123 @@
+"""
+История изменений блоков.
+
+Запрос не пишет в api_blockchangelog напрямую. Изменения блоков (только поменявшиеся поля)
+собираются в памяти, пока открыт capture_changes(user_id), и в конце одним bulk_create
+попадают в api_blockchangeoutbox в той же транзакции, что и сами изменения. В историю их
+пачками переносит flush_changelog(): фоновый поток процесса (после коммита его будят)
+или команда ./manage.py flush_changelog. Если процесс упадёт, записи останутся в outbox
+и перенесутся следующим flush.
+"""
+import contextlib
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
+
+from .models import BlockChangeOutbox
+from .query import flush_changelog_query
+
+logger = logging.getLogger(__name__)
+
+TRACKED_FIELDS = ('text', 'content_classList', 'classList', 'children_position', 'layout', 'color', 'properties',
+                  'access_type', 'image')
+
+_local = threading.local()
+
+
+def block_diff(block):
+    """{'old_data': {...}, 'new_data': {...}} по полям, изменившимся с момента загрузки блока из базы."""
+    loaded_values = getattr(block, '_loaded_values', {})
+    old_data, new_data = {}, {}
+    for name in TRACKED_FIELDS:
+        if block.field_changed(name):
+            old_data[name] = _plain(loaded_values[name])
+            new_data[name] = _plain(getattr(block, name))
+    if not new_data:
+        return None
+    return {'old_data': old_data, 'new_data': new_data}
+
+
+@contextlib.contextmanager
+def capture_changes(user_id):
+    """Собирает изменения блоков, сохранённых внутри блока with; использовать внутри transaction.atomic()."""
+    previous = getattr(_local, 'capture', None)
+    _local.capture = (user_id, [])
+    try:
+        yield
+        entries = _local.capture[1]
+    finally:
+        _local.capture = previous
+    if entries:
+        BlockChangeOutbox.objects.bulk_create(entries)
+        transaction.on_commit(wake_flusher)
+
+
+def record_change(block):
+    """Запоминает изменения block, если сейчас открыт capture_changes."""
+    capture = getattr(_local, 'capture', None)
+    if capture is None:
+        return
+    diff = block_diff(block)
+    if diff is not None:
+        user_id, entries = capture
+        entries.append(BlockChangeOutbox(block_id=block.pk, changed_by_id=user_id, changed_at=timezone.now(),
+                                         content_change=diff))
+
+
+def flush_changelog(batch_size=None):
+    """Переносит до batch_size записей из outbox в историю, возвращает число обработанных записей."""
+    batch_size = batch_size or _options()['BATCH_SIZE']
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(flush_changelog_query, {'limit': batch_size})
+        return cursor.fetchone()[0]
+
+
+class ChangelogFlusher(threading.Thread):
+    def __init__(self, interval, batch_size):
+        super().__init__(name='changelog-flusher', daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.wake = threading.Event()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            close_old_connections()
+            try:
+                while flush_changelog(self.batch_size) == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception('Changelog flush failed')
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def wake_flusher():
+    global _flusher
+    options = _options()
+    if not options['BACKGROUND_FLUSH']:
+        return
+    if _flusher is None:
+        with _flusher_lock:
+            if _flusher is None:
+                _flusher = ChangelogFlusher(options['FLUSH_INTERVAL'], options['BATCH_SIZE'])
+                _flusher.start()
+    _flusher.wake.set()
+
+
+def _options():
+    return {'BACKGROUND_FLUSH': True, 'FLUSH_INTERVAL': 5.0, 'BATCH_SIZE': 500,
+            **getattr(settings, 'BLOCK_CHANGELOG', {})}
+
+
+def _plain(value):
+    if isinstance(value, FieldFile):
+        return value.name or None
+    return value
@@ -0,0 +1,209 @@
+"""
+События изменений блоков для подписчиков (SSE, api/async_views.block_events).
+
+Событие - компактный dict: {'type': ..., 'block_id' / 'parent_id' / ..., 'ancestors': [...]}.
+ancestors - предки затронутого блока из BlockPath (включая его самого); по ним подписчик на корень
+решает, относится ли событие к его дереву. Сами данные клиент догружает через
+GET /block/<pk>/changes/.
+
+EventSource не умеет передавать заголовки, поэтому вместо JWT в адресе подписки передаётся билет
+(POST /block/<pk>/events/ticket/): подписанные user_id и block_id, годные EVENTS_TICKET_MAX_AGE секунд
+и только для подписки на этот блок. Так в логи попадает билет, а не токен.
+
+Брокер задаётся настройкой BLOCK_EVENTS_BROKER:
+    InProcessBroker - рассылка внутри процесса (тесты, один воркер);
+    PostgresBroker - через LISTEN/NOTIFY, для нескольких воркеров.
+"""
+import asyncio
+import contextlib
+import json
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core import signing
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from .query import block_ancestors_query, block_events_listeners_query
+
+SUBSCRIBER_QUEUE_SIZE = 1000
+EVENTS_TICKET_MAX_AGE = 30
+EVENTS_TICKET_SALT = 'api.events.ticket'
+
+
+class BaseBroker:
+    def publish(self, event):
+        """Вызывается из синхронного кода (после коммита)."""
+        raise NotImplementedError
+
+    def subscribe(self):
+        """Асинхронный контекстный менеджер, отдающий asyncio.Queue с событиями."""
+        raise NotImplementedError
+
+    def has_subscribers(self):
+        """Есть ли кому слать события; без подписчиков события не собираются вовсе."""
+        return True
+
+
+class InProcessBroker(BaseBroker):
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, event)
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    @staticmethod
+    def _put(queue, event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Медленный подписчик: отбрасываем накопленное, клиент перечитает дерево целиком
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({'type': 'resync'})
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    publish делает NOTIFY, каждый воркер слушает канал одним соединением psycopg 3
+    и раздаёт события своим подписчикам. Соединение открыто, только пока у воркера есть подписчики,
+    поэтому о подписчиках в других воркерах можно узнать по слушающим соединениям в pg_stat_activity.
+    """
+    # Лимит NOTIFY - 8000 байт
+    max_payload = 7900
+    # Сколько секунд помнить результат проверки подписчиков
+    subscribers_check_seconds = 1.0
+
+    def __init__(self, channel='block_events', queue_size=SUBSCRIBER_QUEUE_SIZE):
+        super().__init__(queue_size)
+        self.channel = channel
+        self._listener = None
+        self._listeners_checked = (None, False)  # (время проверки, есть ли слушатели)
+
+    def has_subscribers(self):
+        if super().has_subscribers():
+            return True
+        checked_at, listening = self._listeners_checked
+        now = time.monotonic()
+        if checked_at is None or now - checked_at > self.subscribers_check_seconds:
+            with connection.cursor() as cursor:
+                cursor.execute(block_events_listeners_query, {'listen': f'LISTEN {self.channel}'})
+                listening = cursor.fetchone()[0]
+            self._listeners_checked = (now, listening)
+        return listening
+
+    def publish(self, event):
+        payload = json.dumps(event)
+        if len(payload) > self.max_payload:
+            # Без предков событие получат все подписчики, лишнее клиент проигнорирует
+            payload = json.dumps({**event, 'ancestors': None})
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        try:
+            async with super().subscribe() as queue:
+                yield queue
+        finally:
+            if not super().has_subscribers() and self._listener is not None:
+                # Последний подписчик воркера ушёл: закрываем LISTEN, чтобы не собирать события впустую
+                self._listener.cancel()
+                self._listener = None
+
+    async def _listen(self):
+        from psycopg import AsyncConnection
+        from .async_db import get_pool
+
+        pool = await get_pool()
+        async with await AsyncConnection.connect(pool.conninfo, autocommit=True) as listener:
+            await listener.execute(f'LISTEN {self.channel}')
+            async for notify in listener.notifies():
+                super().publish(json.loads(notify.payload))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = getattr(settings, 'BLOCK_EVENTS_BROKER', {})
+                backend = import_string(config.get('BACKEND', 'api.events.InProcessBroker'))
+                _broker = backend(**config.get('OPTIONS', {}))
+    return _broker
+
+
+def block_ancestors(block_ids):
+    """{block_id: [id предков, включая сам блок]} по BlockPath."""
+    if not block_ids:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(block_ancestors_query, {'block_ids': list(block_ids)})
+        return dict(cursor.fetchall())
+
+
+def make_events_ticket(user_id, block_id):
+    return signing.dumps({'user_id': user_id, 'block_id': block_id}, salt=EVENTS_TICKET_SALT, compress=True)
+
+
+def read_events_ticket(ticket, block_id):
+    """user_id из билета на подписку на block_id или None, если билет чужой, испорчен или истёк."""
+    try:
+        data = signing.loads(ticket, salt=EVENTS_TICKET_SALT, max_age=EVENTS_TICKET_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if data.get('block_id') != block_id:
+        return None
+    return data.get('user_id')
+
+
+def has_block_subscribers():
+    return get_broker().has_subscribers()
+
+
+def publish_block_events(events, ancestors=None):
+    """
+    events - список пар (id блока, по которому ищутся предки, событие).
+    Рассылаются после коммита; ancestors можно передать заранее (например, до удаления блока).
+    Без подписчиков ничего не делает, в том числе не ищет предков.
+    """
+    if not events or not has_block_subscribers():
+        return
+    if ancestors is None:
+        ancestors = block_ancestors({block_id for block_id, _ in events})
+    prepared = [{**event, 'ancestors': ancestors.get(block_id, [block_id])} for block_id, event in events]
+    transaction.on_commit(partial(_publish, prepared))
+
+
+def _publish(events):
+    broker = get_broker()
+    for event in events:
+        broker.publish(event)
@@ -0,0 +1,174 @@
+from django.db import connection
+from django.db.models import F
+
+from .models import Block, BLOCK_PATH_MAX_DEPTH
+from .query import (add_block_paths_query,
+                    link_block_paths_query,
+                    unlink_block_paths_query,
+                    drop_block_paths_query,
+                    edges_overlap_query,
+                    insert_block_children_query,
+                    delete_block_children_query,
+                    is_block_ancestor_query,
+                    block_roots_query,
+                    lock_block_roots_query,
+                    add_block_tombstones_query)
+
+
+class BlockCycleError(Exception):
+    pass
+
+
+def add_block_paths(block_ids):
+    """Пути нулевой длины для новых блоков."""
+    if not block_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(add_block_paths_query, {'block_ids': list(block_ids)})
+
+
+def link_block_paths(edges):
+    """edges - пары (parent_id, child_id), которые только что добавлены в Block.children."""
+    if not edges:
+        return
+    parent_ids, child_ids = zip(*edges)
+    with connection.cursor() as cursor:
+        _count_edge_paths(cursor, link_block_paths_query, edges)
+        cursor.execute(add_block_tombstones_query, {'kind': 'linked',
+                                                    'block_ids': list(child_ids),
+                                                    'parent_ids': list(parent_ids)})
+
+
+def unlink_block_paths(edges):
+    """edges - пары (parent_id, child_id), которые удаляются из Block.children."""
+    if not edges:
+        return
+    parent_ids, child_ids = zip(*edges)
+    with connection.cursor() as cursor:
+        _count_edge_paths(cursor, unlink_block_paths_query, edges)
+        cursor.execute(add_block_tombstones_query, {'kind': 'unlinked',
+                                                    'block_ids': list(child_ids),
+                                                    'parent_ids': list(parent_ids)})
+
+
+def _count_edge_paths(cursor, query, edges):
+    """
+    Добавляет (или вычитает) в BlockPath пути через рёбра edges. Если путь может пройти через два ребра
+    из набора, рёбра обрабатываются по одному, чтобы каждый такой путь посчитался ровно один раз.
+    """
+    parent_ids, child_ids = zip(*edges)
+    params = {'parent_ids': list(parent_ids), 'child_ids': list(child_ids), 'max_depth': BLOCK_PATH_MAX_DEPTH}
+    if len(edges) > 1:
+        cursor.execute(edges_overlap_query, params)
+        if cursor.fetchone()[0]:
+            for parent_id, child_id in edges:
+                cursor.execute(query, {'parent_ids': [parent_id], 'child_ids': [child_id],
+                                       'max_depth': BLOCK_PATH_MAX_DEPTH})
+            return
+    cursor.execute(query, params)
+
+
+def existing_edges(edges):
+    """Пары (parent_id, child_id) из edges, которые есть в Block.children."""
+    if not edges:
+        return []
+    parent_ids, child_ids = zip(*edges)
+    existing = set(Block.children.through.objects
+                   .filter(from_block_id__in=set(parent_ids), to_block_id__in=set(child_ids))
+                   .values_list('from_block_id', 'to_block_id'))
+    return [edge for edge in edges if edge in existing]
+
+
+def insert_children(edges):
+    """
+    Добавляет пары (parent_id, child_id) в Block.children в обход m2m_changed, вместе с путями BlockPath.
+    Возвращает добавленные пары в порядке edges (уже существовавшие пропускаются).
+    """
+    return _change_children(insert_block_children_query, edges, link_block_paths)
+
+
+def delete_children(edges):
+    """Удаляет пары из Block.children вместе с путями и надгробиями, возвращает реально удалённые в порядке edges."""
+    return _change_children(delete_block_children_query, edges, unlink_block_paths)
+
+
+def _change_children(query, edges, update_paths):
+    if not edges:
+        return []
+    parent_ids, child_ids = zip(*edges)
+    with connection.cursor() as cursor:
+        cursor.execute(query, {'parent_ids': list(parent_ids), 'child_ids': list(child_ids)})
+        changed = set(cursor.fetchall())
+    changed = [edge for edge in edges if edge in changed]
+    update_paths(changed)
+    return changed
+
+
+def drop_block_paths(block_ids):
+    """Убирает из BlockPath удаляемые блоки и пути через них, возвращает число удалённых строк."""
+    block_ids = set(block_ids)
+    deleted = 0
+    with connection.cursor() as cursor:
+        while block_ids:
+            # За запрос - блоки без предков среди оставшихся, начиная с верхних
+            cursor.execute(drop_block_paths_query, {'block_ids': list(block_ids), 'max_depth': BLOCK_PATH_MAX_DEPTH})
+            layer_ids, rows = cursor.fetchone()
+            if not layer_ids:
+                break
+            block_ids.difference_update(layer_ids)
+            deleted += rows
+    return deleted
+
+
+def add_deleted_tombstones(block_id, parent_ids):
+    """Запоминает удаление блока для каждого бывшего родителя (или без родителя, если их не было)."""
+    parent_ids = list(parent_ids) or [None]
+    with connection.cursor() as cursor:
+        cursor.execute(add_block_tombstones_query, {'kind': 'deleted',
+                                                    'block_ids': [block_id] * len(parent_ids),
+                                                    'parent_ids': parent_ids})
+
+
+def bump_block_revisions(block_ids):
+    """Отмечает изменение связей или прав блоков, чтобы сменился ETag содержащих их поддеревьев."""
+    if not block_ids:
+        return
+    Block.objects.filter(pk__in=list(block_ids)).update(revision=F('revision') + 1)
+
+
+def is_ancestor(ancestor_id, block_id):
+    """Лежит ли block_id в поддереве ancestor_id (включая сам ancestor_id)."""
+    with connection.cursor() as cursor:
+        cursor.execute(is_block_ancestor_query, {'ancestor_id': ancestor_id,
+                                                 'block_id': block_id,
+                                                 'max_depth': BLOCK_PATH_MAX_DEPTH})
+        return cursor.fetchone()[0]
+
+
+def check_new_edges(edges):
+    """
+    Проверяет перед добавлением пар (parent_id, child_id) в Block.children, что ни одна не замыкает цикл
+    (иначе BlockCycleError). Вызывается внутри транзакции, которая добавит связи: корни затронутых
+    иерархий блокируются до её конца, так что два встречных изменения одной иерархии не пройдут
+    проверку одновременно, а изменения разных иерархий друг друга не ждут.
+    """
+    if not edges:
+        return
+    lock_block_roots({block_id for edge in edges for block_id in edge})
+    for parent_id, child_id in edges:
+        if is_ancestor(child_id, parent_id):
+            raise BlockCycleError(f'Block {child_id} cannot become a child of its own descendant {parent_id}.')
+
+
+def lock_block_roots(block_ids):
+    """Блокирует (до конца транзакции) корни иерархий block_ids."""
+    locked = set()
+    with connection.cursor() as cursor:
+        while True:
+            # Пока мы ждали блокировку, у корня мог появиться родитель - тогда блокируется и новый корень
+            cursor.execute(block_roots_query, {'block_ids': list(block_ids), 'max_depth': BLOCK_PATH_MAX_DEPTH})
+            root_ids = [row[0] for row in cursor.fetchall() if row[0] not in locked]
+            if not root_ids:
+                return
+            cursor.execute(lock_block_roots_query, {'root_ids': root_ids})
+            locked.update(root_ids)
@@ -0,0 +1,148 @@
+"""
+Картинки блоков (Block.image).
+
+Оригиналы хранятся по хэшу содержимого (images/originals/<xx>/<sha256>.<ext>), поэтому одинаковые
+загрузки лежат на диске один раз. После сохранения блока уменьшенные копии в WebP (IMAGE_VARIANTS)
+строятся в пуле потоков, вне запроса. Адрес копии выводится из имени оригинала:
+
+    images/variants/<вариант>/<имя оригинала>.webp
+
+так что его можно собрать прямо в SQL дерева. serve_media - только для разработки (подключается
+при DEBUG): отдаёт оригиналы и копии с заголовками для вечного кэширования (содержимое по адресу
+не меняется), а если копия ещё не готова, ставит её в очередь и временно перенаправляет на оригинал.
+В продакшене MEDIA_URL раздаёт nginx с теми же заголовками.
+
+    BLOCK_IMAGES = {'WORKERS': 2, 'QUALITY': 80}
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponseRedirect
+from django.utils.deconstruct import deconstructible
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# Имя варианта -> наибольшая сторона, px. Имена вариантов также перечислены в get_blocks_query
+IMAGE_VARIANTS = {'thumb': 256, 'medium': 1024}
+ORIGINALS_DIR = 'images/originals'
+VARIANTS_DIR = 'images/variants'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_executor = None
+_executor_lock = threading.Lock()
+# Оригиналы, для которых построение вариантов уже в очереди
+_pending = set()
+
+
+def _options():
+    return {'WORKERS': 2, 'QUALITY': 80, **getattr(settings, 'BLOCK_IMAGES', {})}
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Сохраняет файл под именем из sha256 содержимого; если такой файл уже есть, второй раз не пишет."""
+
+    def save(self, name, content, max_length=None):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        digest = digest.hexdigest()
+        name = f'{ORIGINALS_DIR}/{digest[:2]}/{digest}{os.path.splitext(name)[1].lower()}'
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+def variant_name(original_name, variant):
+    return f'{VARIANTS_DIR}/{variant}/{original_name}.webp'
+
+
+def generate_variants(original_name, variants=None):
+    """Строит недостающие варианты картинки. Возвращает имена созданных файлов."""
+    created = []
+    for variant in variants or IMAGE_VARIANTS:
+        name = variant_name(original_name, variant)
+        if default_storage.exists(name):
+            continue
+        size = IMAGE_VARIANTS[variant]
+        with default_storage.open(original_name) as original, Image.open(original) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+            image.thumbnail((size, size))
+            output = BytesIO()
+            image.save(output, 'WEBP', quality=_options()['QUALITY'], method=4)
+        created.append(default_storage.save(name, ContentFile(output.getvalue())))
+    return created
+
+
+def _generate_variants_logged(original_name):
+    try:
+        generate_variants(original_name)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.exception('Failed to build image variants for %s', original_name)
+    finally:
+        with _executor_lock:
+            _pending.discard(original_name)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_options()['WORKERS'], thread_name_prefix='image-variants')
+    return _executor
+
+
+def _submit_variants(original_name):
+    executor = _get_executor()
+    with _executor_lock:
+        if original_name in _pending:
+            return
+        _pending.add(original_name)
+    executor.submit(_generate_variants_logged, original_name)
+
+
+def schedule_variants(original_name):
+    """Ставит построение вариантов в очередь после коммита текущей транзакции."""
+    transaction.on_commit(lambda: _submit_variants(original_name))
+
+
+def serve_media(request, path):
+    """
+    Отдаёт картинки из MEDIA_ROOT (только при DEBUG, см. block_api/urls.py). Недостающий вариант
+    строится в фоне, а пока запрос перенаправляется на оригинал без кэширования.
+    """
+    if not path.startswith('images/'):
+        raise Http404
+    try:
+        if not default_storage.exists(path):
+            variant, _, original_name = path[len(VARIANTS_DIR) + 1:].partition('/')
+            if (not path.startswith(VARIANTS_DIR + '/') or variant not in IMAGE_VARIANTS
+                    or not original_name.endswith('.webp')):
+                raise Http404
+            original_name = original_name[:-len('.webp')]
+            if not default_storage.exists(original_name):
+                raise Http404
+            _submit_variants(original_name)
+            response = HttpResponseRedirect(default_storage.url(original_name))
+            response['Cache-Control'] = 'no-cache'
+            return response
+        response = FileResponse(default_storage.open(path))
+    except SuspiciousFileOperation:
+        raise Http404
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
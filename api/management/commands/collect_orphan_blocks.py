@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.orphans import DEFAULT_BATCH_SIZE, DEFAULT_MIN_AGE, collect_orphan_blocks
+
+
+class Command(BaseCommand):
+    help = 'Удаляет блоки, недостижимые ни из одного корневого блока пользователя'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--min-age-hours', type=float, default=DEFAULT_MIN_AGE.total_seconds() / 3600,
+                            help='Не трогать блоки моложе этого возраста')
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать недостижимые блоки')
+
+    def handle(self, *args, **options):
+        stats = collect_orphan_blocks(batch_size=options['batch_size'],
+                                      min_age=timedelta(hours=options['min_age_hours']),
+                                      max_batches=options['max_batches'],
+                                      dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f'Found {stats["orphans"]} orphan blocks, about {stats["bytes"]} bytes')
+        else:
+            self.stdout.write(f'Found {stats["orphans"]} orphan blocks, deleted {stats["blocks"]} blocks, '
+                              f'{stats["rows"]} rows in total, about {stats["bytes"]} bytes reclaimed')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api.changelog import flush_changelog
+
+
+class Command(BaseCommand):
+    help = 'Переносит накопленные изменения блоков из outbox в историю (BlockChangeLog)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            moved = flush_changelog(options['batch_size'])
+            total += moved
+            if moved < options['batch_size']:
+                break
+        self.stdout.write(f'Flushed {total} changelog entries')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.benchmarks.generator import SHAPES, SIZES, generate_block_graph
+
+
+class Command(BaseCommand):
+    help = 'Создаёт синтетический граф блоков для нагрузочных замеров (см. api/benchmarks)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shape', choices=sorted(SHAPES), default='dag')
+        parser.add_argument('--size', default='1k', help=f'{", ".join(SIZES)} или число блоков')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        size = SIZES.get(options['size'].lower()) or int(options['size'])
+        user_id, root_id = generate_block_graph(options['shape'], size, options['seed'], stdout=self.stdout)
+        self.stdout.write(f'Generated {options["shape"]} graph: user {user_id}, root block {root_id}')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from PIL import Image, UnidentifiedImageError
+
+from api.images import generate_variants
+from api.models import Block
+
+
+class Command(BaseCommand):
+    help = 'Строит недостающие уменьшенные копии картинок блоков (для картинок, загруженных до api/images.py)'
+
+    def handle(self, *args, **options):
+        names = Block.objects.exclude(image='').exclude(image__isnull=True).values_list('image', flat=True).distinct()
+        created = failed = 0
+        for name in names.iterator():
+            try:
+                created += len(generate_variants(name))
+            except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as error:
+                failed += 1
+                self.stderr.write(f'{name}: {error}')
+        self.stdout.write(f'Created {created} image variants, {failed} images failed')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.middleware import get_instrumentation_config, set_instrumentation_config
+
+
+class Command(BaseCommand):
+    help = 'Включает и выключает замеры запросов (RequestInstrumentationMiddleware) без перезапуска'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('on', 'off', 'reset', 'status'))
+        parser.add_argument('--slow-ms', type=float, help='Порог медленного запроса, мс')
+        parser.add_argument('--explain-sample-rate', type=float, help='Доля get_blocks_query с EXPLAIN, 0..1')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'reset':
+            set_instrumentation_config(None)
+        elif action != 'status':
+            overrides = {'ENABLED': action == 'on'}
+            if options['slow_ms'] is not None:
+                overrides['SLOW_REQUEST_MS'] = options['slow_ms']
+            if options['explain_sample_rate'] is not None:
+                overrides['EXPLAIN_SAMPLE_RATE'] = options['explain_sample_rate']
+            set_instrumentation_config(overrides)
+
+        config = get_instrumentation_config()
+        self.stdout.write(f'enabled={config["ENABLED"]} slow_ms={config["SLOW_REQUEST_MS"]} '
+                          f'explain_sample_rate={config["EXPLAIN_SAMPLE_RATE"]}')
@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmarks.generator import find_block_graphs
+from api.benchmarks.runner import SCENARIOS, compare_results, run_benchmarks, write_results
+from api.models import DEFAULT_TREE_DEPTH
+
+
+class Command(BaseCommand):
+    help = 'Замеряет чтение дерева и изменения блоков на сгенерированных графах и пишет результаты в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--graph', action='append', help='Имя графа (по умолчанию все сгенерированные)')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--depth', type=int, default=DEFAULT_TREE_DEPTH)
+        parser.add_argument('--output', default='bench_results.json')
+        parser.add_argument('--compare', help='Файл результатов предыдущего прогона')
+
+    def handle(self, *args, **options):
+        graphs = find_block_graphs()
+        if options['graph']:
+            graphs = [graph for graph in graphs if graph[0] in options['graph']]
+        if not graphs:
+            raise CommandError('No benchmark graphs found, run generate_block_graph first.')
+
+        data = run_benchmarks(graphs, options['scenario'] or SCENARIOS, options['iterations'], options['depth'])
+        write_results(options['output'], data)
+        for row in data['results']:
+            self.stdout.write(f'{row["graph"]:<24} {row["scenario"]:<10} p50 {row["p50_ms"]:>9.2f} ms  '
+                              f'p95 {row["p95_ms"]:>9.2f} ms  p99 {row["p99_ms"]:>9.2f} ms  '
+                              f'queries {row["queries_p50"]}')
+
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                changes = compare_results(data, json.load(baseline))
+            for graph, scenario, metric, old, new, delta in changes:
+                self.stdout.write(f'{graph:<24} {scenario:<10} {metric:<12} {old} -> {new} ({delta:+.1f}%)')
+        self.stdout.write(f'Results written to {options["output"]}')
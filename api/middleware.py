@@ -0,0 +1,191 @@
+"""
+Замеры запросов: число SQL-запросов, время в базе, время рендера ответа и его размер.
+
+Результат уходит в заголовок Server-Timing и в лог api.middleware (поля записи в extra).
+Для запросов дольше SLOW_REQUEST_MS в лог пишутся самые медленные SQL-запросы, а для части
+из них (EXPLAIN_SAMPLE_RATE) - план запроса дерева через EXPLAIN (ANALYZE, BUFFERS).
+
+Настройки по умолчанию в REQUEST_INSTRUMENTATION, во время работы их переопределяет
+./manage.py instrumentation (строка InstrumentationConfig в базе, её видят все воркеры).
+"""
+import logging
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from .models import InstrumentationConfig
+from .prepared import blocks_statement, columnar_tree_statement, flat_map_json_statement
+
+# Запросы дерева (обычным текстом и через EXECUTE), для которых снимается план
+TREE_QUERIES = frozenset(sql for statement in (blocks_statement, flat_map_json_statement, columnar_tree_statement)
+                         for sql in (statement.query, statement.execute_sql))
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PK = 1
+# Как часто воркер перечитывает переопределённые настройки из базы
+CONFIG_REFRESH_SECONDS = 5.0
+SLOW_QUERIES_LOGGED = 5
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,
+    'EXPLAIN_SAMPLE_RATE': 0.0,
+}
+
+_config_lock = threading.Lock()
+_config = None
+_config_loaded_at = 0.0
+
+
+def _base_config():
+    return {**DEFAULTS, **getattr(settings, 'REQUEST_INSTRUMENTATION', {})}
+
+
+def get_instrumentation_config():
+    global _config, _config_loaded_at
+    now = time.monotonic()
+    if _config is None or now - _config_loaded_at > CONFIG_REFRESH_SECONDS:
+        with _config_lock:
+            config = _base_config()
+            config.update(InstrumentationConfig.objects.filter(pk=CONFIG_PK)
+                          .values_list('overrides', flat=True).first() or {})
+            _config, _config_loaded_at = config, now
+    return _config
+
+
+def set_instrumentation_config(overrides):
+    """Переопределяет настройки для всех воркеров; overrides=None возвращает значения из settings."""
+    global _config
+    if overrides is None:
+        InstrumentationConfig.objects.filter(pk=CONFIG_PK).delete()
+    else:
+        with transaction.atomic():
+            config, _ = InstrumentationConfig.objects.select_for_update().get_or_create(pk=CONFIG_PK)
+            config.overrides = {**config.overrides, **overrides}
+            config.save()
+    _config = None
+
+
+class QueryRecorder:
+    """execute_wrapper: считает запросы и время в базе, запоминает запросы дерева для EXPLAIN."""
+
+    def __init__(self, explain_sample_rate):
+        self.explain_sample_rate = explain_sample_rate
+        self.queries = []  # (duration_ms, sql)
+        self.explain_candidates = []  # (duration_ms, sql, params)
+        self.db_ms = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.perf_counter() - started) * 1000
+            self.db_ms += duration
+            self.queries.append((duration, sql))
+            if sql in TREE_QUERIES and random.random() < self.explain_sample_rate:
+                self.explain_candidates.append((duration, sql, params))
+
+
+class RequestInstrumentationMiddleware:
+    """
+    Работает и в синхронной, и в асинхронной цепочке, чтобы под ASGI не переводить асинхронные вью
+    в поток. Асинхронные вью ходят в базу через свой пул (api/async_db.py), их запросы здесь не видны.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        config = get_instrumentation_config()
+        if not config['ENABLED']:
+            return self.get_response(request)
+
+        recorder = QueryRecorder(config['EXPLAIN_SAMPLE_RATE'])
+        request._render_ms = 0.0
+        started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        fields = self._finish(request, response, recorder, started)
+        if fields['total_ms'] > config['SLOW_REQUEST_MS']:
+            self._log_slow_request(fields, recorder)
+        return response
+
+    async def __acall__(self, request):
+        config = await sync_to_async(get_instrumentation_config)()
+        if not config['ENABLED']:
+            return await self.get_response(request)
+
+        recorder = QueryRecorder(config['EXPLAIN_SAMPLE_RATE'])
+        request._render_ms = 0.0
+        started = time.perf_counter()
+        # Соединение общее с синхронными вью, которые Django вызывает через sync_to_async
+        with connection.execute_wrapper(recorder):
+            response = await self.get_response(request)
+        fields = self._finish(request, response, recorder, started)
+        if fields['total_ms'] > config['SLOW_REQUEST_MS']:
+            await sync_to_async(self._log_slow_request)(fields, recorder)
+        return response
+
+    def _finish(self, request, response, recorder, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        size = None if response.streaming else len(response.content)
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={recorder.db_ms:.1f};desc="{len(recorder.queries)} queries"',
+            f'render;dur={request._render_ms:.1f}',
+            f'total;dur={total_ms:.1f}',
+        ])
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': len(recorder.queries),
+            'db_ms': round(recorder.db_ms, 1),
+            'render_ms': round(request._render_ms, 1),
+            'total_ms': round(total_ms, 1),
+            'bytes': size,
+        }
+        logger.info(' '.join(f'{key}={value}' for key, value in fields.items()), extra=fields)
+        return fields
+
+    def process_template_response(self, request, response):
+        # DRF Response рендерится сразу после этого хука
+        if hasattr(request, '_render_ms'):
+            started = time.perf_counter()
+
+            def rendered(response):
+                request._render_ms += (time.perf_counter() - started) * 1000
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def _log_slow_request(self, fields, recorder):
+        slowest = sorted(recorder.queries, key=lambda query: query[0], reverse=True)[:SLOW_QUERIES_LOGGED]
+        for duration, sql in slowest:
+            logger.warning('slow request %s %s: query %.1f ms: %s', fields['method'], fields['path'],
+                           duration, ' '.join(sql.split()), extra={**fields, 'query_ms': round(duration, 1)})
+        if recorder.explain_candidates:
+            duration, sql, params = max(recorder.explain_candidates, key=lambda candidate: candidate[0])
+            try:
+                with connection.cursor() as cursor:
+                    # EXPLAIN работает и для EXECUTE подготовленного запроса
+                    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+                    plan = '\n'.join(row[0] for row in cursor.fetchall())
+            except DatabaseError:
+                logger.exception('EXPLAIN for tree query failed')
+                return
+            logger.warning('slow request %s %s: tree query %.1f ms plan:\n%s',
+                           fields['method'], fields['path'], duration, plan,
+                           extra={**fields, 'query_ms': round(duration, 1)})
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.5 on 2026-10-18 15:40
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_alter_block_children_position_alter_block_classlist_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('path', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_paths', to='api.block')),
+                ('descendant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_paths', to='api.block')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['ancestor', 'depth'], name='api_blockpath_ancestor_depth'),
+                    models.Index(fields=['descendant', 'depth'], name='api_blockpath_descendant_depth'),
+                    django.contrib.postgres.indexes.GinIndex(fields=['path'], name='api_blockpath_path_gin'),
+                ],
+                'constraints': [
+                    models.UniqueConstraint(fields=('path',), name='api_blockpath_unique_path'),
+                ],
+            },
+        ),
+        migrations.RunSQL(
+            sql='''
+            WITH RECURSIVE paths AS (SELECT b.id AS ancestor_id, b.id AS descendant_id, 0 AS depth, ARRAY [b.id] AS path
+                                     FROM api_block b
+                                     UNION ALL
+                                     SELECT p.ancestor_id, bc.to_block_id, p.depth + 1, p.path || bc.to_block_id
+                                     FROM paths p
+                                              JOIN api_block_children bc ON bc.from_block_id = p.descendant_id
+                                     WHERE p.depth < 10
+                                       AND NOT bc.to_block_id = ANY (p.path))
+            INSERT INTO api_blockpath (ancestor_id, descendant_id, depth, path)
+            SELECT ancestor_id, descendant_id, depth, path
+            FROM paths;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_blockpath'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('can_edit', models.BooleanField(default=False)),
+                ('block', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='access', to='api.block')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='block_access', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['user', 'block'], name='api_blockaccess_user_block'),
+                ],
+                'constraints': [
+                    models.UniqueConstraint(fields=('block', 'user'), name='api_blockaccess_unique_block_user'),
+                ],
+            },
+        ),
+        migrations.RunSQL(
+            sql='''
+            WITH RECURSIVE grants(block_id, user_id, can_edit) AS (SELECT bv.block_id, bv.user_id, false
+                                                                   FROM api_block_visible_to_users bv
+                                                                   UNION
+                                                                   SELECT be.block_id, be.user_id, true
+                                                                   FROM api_block_editable_by_users be
+                                                                   UNION
+                                                                   SELECT bc.to_block_id, g.user_id, g.can_edit
+                                                                   FROM grants g
+                                                                            JOIN api_block_children bc ON bc.from_block_id = g.block_id
+                                                                            JOIN api_block c ON c.id = bc.to_block_id AND c.access_type = 'inherited')
+            INSERT INTO api_blockaccess (block_id, user_id, can_edit)
+            SELECT block_id, user_id, bool_or(can_edit)
+            FROM grants
+            GROUP BY block_id, user_id;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_blockaccess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='revision',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.5 on 2026-10-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_block_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(fields=['change_seq'], name='api_block_change_seq_idx'),
+        ),
+        migrations.CreateModel(
+            name='BlockTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('unlinked', 'Unlinked'), ('deleted', 'Deleted')], max_length=10)),
+                ('block_id', models.BigIntegerField()),
+                ('parent_id', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['seq'], name='api_blocktombstone_seq')],
+            },
+        ),
+        migrations.RunSQL(
+            sql='''
+            CREATE SEQUENCE api_block_change_seq;
+
+            -- Существующие блоки получают 0 до создания триггера, иначе каждая строка заберёт nextval
+            UPDATE api_block SET change_seq = 0;
+
+            CREATE FUNCTION api_block_set_change_seq() RETURNS trigger AS $$
+            BEGIN
+                NEW.change_seq := nextval('api_block_change_seq');
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER api_block_change_seq
+                BEFORE INSERT OR UPDATE ON api_block
+                FOR EACH ROW EXECUTE FUNCTION api_block_set_change_seq();
+            ''',
+            reverse_sql='''
+            DROP TRIGGER api_block_change_seq ON api_block;
+            DROP FUNCTION api_block_set_change_seq();
+            DROP SEQUENCE api_block_change_seq;
+            ''',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.5 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_block_change_seq_blocktombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockChangeOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('block_id', models.BigIntegerField()),
+                ('changed_by_id', models.IntegerField()),
+                ('changed_at', models.DateTimeField()),
+                ('content_change', models.JSONField(default=dict)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='blockchangelog',
+            index=models.Index(fields=['block', '-changed_at', '-id'], name='api_blockchangelog_block_time'),
+        ),
+    ]
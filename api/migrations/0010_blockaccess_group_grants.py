@@ -0,0 +1,36 @@
+# Generated by Django 5.0.5 on 2026-10-18 19:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_blockchangeoutbox_blockchangelog_index'),
+    ]
+
+    operations = [
+        # Права групп раскрываются в api_blockaccess по участникам, права пользователей уже там
+        migrations.RunSQL(
+            sql='''
+            WITH RECURSIVE grants(block_id, user_id, can_edit) AS (SELECT gv.block_id, gm.user_id, false
+                                                                   FROM api_group_visible_blocks gv
+                                                                            JOIN api_group_members gm ON gm.group_id = gv.group_id
+                                                                   UNION
+                                                                   SELECT ge.block_id, gm.user_id, true
+                                                                   FROM api_group_editable_blocks ge
+                                                                            JOIN api_group_members gm ON gm.group_id = ge.group_id
+                                                                   UNION
+                                                                   SELECT bc.to_block_id, g.user_id, g.can_edit
+                                                                   FROM grants g
+                                                                            JOIN api_block_children bc ON bc.from_block_id = g.block_id
+                                                                            JOIN api_block c ON c.id = bc.to_block_id AND c.access_type = 'inherited')
+            INSERT INTO api_blockaccess (block_id, user_id, can_edit)
+            SELECT block_id, user_id, bool_or(can_edit)
+            FROM grants
+            GROUP BY block_id, user_id
+            ON CONFLICT (block_id, user_id) DO UPDATE SET can_edit = api_blockaccess.can_edit OR EXCLUDED.can_edit;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.5 on 2026-10-18 19:40
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_blockaccess_group_grants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            sql='''
+            CREATE TRIGGER api_block_search_vector
+                BEFORE INSERT OR UPDATE ON api_block
+                FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.simple', text);
+
+            -- Заполнение существующих строк не должно выглядеть как их изменение для delta sync
+            ALTER TABLE api_block DISABLE TRIGGER api_block_change_seq;
+            UPDATE api_block SET search_vector = to_tsvector('pg_catalog.simple', COALESCE(text, ''));
+            ALTER TABLE api_block ENABLE TRIGGER api_block_change_seq;
+            ''',
+            reverse_sql='''
+            DROP TRIGGER api_block_search_vector ON api_block;
+            ''',
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='api_block_search_vector_gin'),
+        ),
+    ]
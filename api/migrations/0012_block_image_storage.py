@@ -0,0 +1,19 @@
+# Generated by Django 5.0.5 on 2026-10-18 21:05
+
+import api.images
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_block_search_vector'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='block',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=api.images.ContentAddressedStorage(), upload_to='images/'),
+        ),
+    ]
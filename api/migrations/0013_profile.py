@@ -0,0 +1,33 @@
+# Generated by Django 5.0.5 on 2026-10-18 21:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_block_image_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='profile', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('root_block', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.block')),
+            ],
+        ),
+        # Корнем существующих пользователей считался их первый созданный блок
+        migrations.RunSQL(
+            sql='''
+            INSERT INTO api_profile (user_id, root_block_id)
+            SELECT u.id, (SELECT min(b.id) FROM api_block b WHERE b.creator_id = u.id)
+            FROM auth_user u
+            ON CONFLICT (user_id) DO NOTHING;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='change_xid',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blocktombstone',
+            name='xid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            sql='''
+            CREATE OR REPLACE FUNCTION api_block_set_change_seq() RETURNS trigger AS $$
+            BEGIN
+                NEW.change_seq := nextval('api_block_change_seq');
+                NEW.change_xid := pg_current_xact_id()::text::bigint;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            ''',
+            reverse_sql='''
+            CREATE OR REPLACE FUNCTION api_block_set_change_seq() RETURNS trigger AS $$
+            BEGIN
+                NEW.change_seq := nextval('api_block_change_seq');
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            ''',
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(fields=['change_xid'], name='api_block_change_xid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='blocktombstone',
+            index=models.Index(fields=['xid'], name='api_blocktombstone_xid'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_block_change_xid'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blocktombstone',
+            name='kind',
+            field=models.CharField(choices=[('unlinked', 'Unlinked'), ('linked', 'Linked'), ('deleted', 'Deleted')], max_length=10),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_blocktombstone_linked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstrumentationConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('overrides', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.5 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_deleteduser'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='blockpath',
+            name='api_blockpath_unique_path',
+        ),
+        migrations.RemoveIndex(
+            model_name='blockpath',
+            name='api_blockpath_ancestor_depth',
+        ),
+        migrations.RemoveIndex(
+            model_name='blockpath',
+            name='api_blockpath_path_gin',
+        ),
+        migrations.AddField(
+            model_name='blockpath',
+            name='paths',
+            field=models.BigIntegerField(default=1),
+        ),
+        migrations.RemoveField(
+            model_name='blockpath',
+            name='path',
+        ),
+        # Строки путей сворачиваются в строку на (ancestor, descendant, depth) с числом путей.
+        # Без INSERT: проверки внешних ключей отложены и не дали бы потом изменить таблицу в этой же транзакции
+        migrations.RunSQL(
+            sql='''
+                UPDATE api_blockpath bp
+                SET paths = g.paths
+                FROM (SELECT min(id) AS id, count(*) AS paths
+                      FROM api_blockpath
+                      GROUP BY ancestor_id, descendant_id, depth
+                      HAVING count(*) > 1) g
+                WHERE bp.id = g.id;
+                DELETE
+                FROM api_blockpath bp
+                    USING (SELECT id,
+                                  row_number() OVER (PARTITION BY ancestor_id, descendant_id, depth ORDER BY id) AS rn
+                           FROM api_blockpath) r
+                WHERE bp.id = r.id
+                  AND r.rn > 1;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='blockpath',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'depth', 'descendant'), name='api_blockpath_unique_pair'),
+        ),
+    ]
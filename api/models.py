@@ -1,11 +1,20 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
+from .images import ContentAddressedStorage
+
 LAYOUT_CHOICES = (('default', 'Default'), ('horizontal', 'Horizontal'), ('vertical', 'Vertical'), ('table', 'Table'))
 ACCESS_TYPE_CHOICES = (('private', 'Private'),
                        ('public', 'Public'),
                        ('inherited', 'Inherited'),
                        ('public_ed', 'Public Editable'))
 
+# Максимальная длина путей (в рёбрах), которые хранятся в BlockPath
+BLOCK_PATH_MAX_DEPTH = 10
+# Глубина дерева, которое отдаётся по умолчанию (в уровнях, включая корень)
+DEFAULT_TREE_DEPTH = 5
+
 
 def default_content_class_list():
     return ['grid-row_1', 'grid-column_1-M1']
@@ -27,7 +36,8 @@ class Block(models.Model):
 
     text = models.TextField(null=True, blank=True, default='')
     content_classList = models.JSONField(blank=True, null=True, default=default_content_class_list)
-    image = models.ImageField(upload_to='images/', null=True, blank=True)
+    # Имя файла - хэш содержимого, см. api/images.py
+    image = models.ImageField(upload_to='images/', storage=ContentAddressedStorage(), null=True, blank=True)
 
     classList = models.JSONField(blank=True, null=True, default=default_class_list)
 
@@ -38,14 +48,110 @@ class Block(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     properties = models.JSONField(blank=True, null=True, default=dict)
+    # Счётчик изменений связей и прав блока, которые не меняют updated_at (для ETag поддеревьев)
+    revision = models.PositiveBigIntegerField(default=0)
+    # Номер последнего изменения строки, ставится триггером из api_block_change_seq (см. миграцию 0008)
+    change_seq = models.BigIntegerField(default=0, editable=False)
+    # Транзакция (xid8), которая последней меняла строку, ставится тем же триггером (см. миграцию 0014).
+    # По ней ведётся delta sync: версия для клиента - xmin снимка, см. views.get_block_changes
+    change_xid = models.BigIntegerField(default=0, editable=False)
+    # Поисковый вектор по text, заполняется триггером (см. миграцию 0011)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['change_seq'], name='api_block_change_seq_idx'),
+            models.Index(fields=['change_xid'], name='api_block_change_xid_idx'),
+            GinIndex(fields=['search_vector'], name='api_block_search_vector_gin'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Значения из базы, чтобы в сигналах видеть, какие поля поменялись
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def field_changed(self, name):
+        loaded_values = getattr(self, '_loaded_values', {})
+        return name in loaded_values and loaded_values[name] != getattr(self, name)
 
     def save(self, *args, **kwargs):
         is_new = self._state.adding
         super().save(*args, **kwargs)  # Сначала сохраняем, чтобы объект имел ID
         if is_new:
-            self.visible_to_users.add(self.creator)
-            self.editable_by_users.add(self.creator)
-            # super().save(*args, **kwargs)  # Сохраняем объект снова, если нужно сохранить изменения после добавления M2M
+            from .access import refresh_block_access
+            from .hierarchy import add_block_paths
+            add_block_paths([self.pk])
+            # Права создателя пишутся напрямую, без m2m_changed, и пересчитываются одним запросом
+            Block.visible_to_users.through.objects.create(block_id=self.pk, user_id=self.creator_id)
+            Block.editable_by_users.through.objects.create(block_id=self.pk, user_id=self.creator_id)
+            refresh_block_access([self.pk])
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
+
+class BlockPath(models.Model):
+    """
+    Индекс иерархии (closure table): строка на каждую пару ancestor -> descendant и длину depth
+    (не больше BLOCK_PATH_MAX_DEPTH, включая нулевую - блок сам к себе), paths - число простых путей
+    такой длины. Сами пути не хранятся: на DAG их число растёт экспоненциально, а пар - нет.
+    Пути для ответа собираются при чтении по api_block_children (get_blocks_query).
+    Поддерживается сигналами на Block.children, см. api/hierarchy.py.
+    """
+    ancestor = models.ForeignKey(Block, related_name='descendant_paths', on_delete=models.CASCADE, db_index=False)
+    descendant = models.ForeignKey(Block, related_name='ancestor_paths', on_delete=models.CASCADE, db_index=False)
+    depth = models.PositiveSmallIntegerField()
+    paths = models.BigIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['descendant', 'depth'], name='api_blockpath_descendant_depth'),
+        ]
+        constraints = [
+            # Заодно индекс для выборки поддерева по ancestor и depth
+            models.UniqueConstraint(fields=['ancestor', 'depth', 'descendant'], name='api_blockpath_unique_pair'),
+        ]
+
+
+class BlockAccess(models.Model):
+    """
+    Эффективные права пользователя на блок: прямые (visible_to_users / editable_by_users)
+    и унаследованные inherited-блоком от родителей. Пересчитывается в api/access.py.
+    Доступ всем (public, public_ed) здесь не хранится, он определяется по access_type.
+    """
+    block = models.ForeignKey(Block, related_name='access', on_delete=models.CASCADE, db_index=False)
+    user = models.ForeignKey('auth.User', related_name='block_access', on_delete=models.CASCADE, db_index=False)
+    can_edit = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'block'], name='api_blockaccess_user_block'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['block', 'user'], name='api_blockaccess_unique_block_user'),
+        ]
+
+
+class BlockTombstone(models.Model):
+    """
+    Удаления блоков, удаления и добавления связей для дельта-синхронизации. seq берётся из той же
+    последовательности, что Block.change_seq. По linked / unlinked поддерево child отдаётся заново:
+    пути его блоков изменились, хотя сами строки нет.
+    """
+    KIND_CHOICES = (('unlinked', 'Unlinked'), ('linked', 'Linked'), ('deleted', 'Deleted'))
+
+    seq = models.BigIntegerField()
+    # Транзакция, записавшая надгробие, как Block.change_xid
+    xid = models.BigIntegerField(default=0)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    block_id = models.BigIntegerField()
+    parent_id = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['seq'], name='api_blocktombstone_seq'),
+            models.Index(fields=['xid'], name='api_blocktombstone_xid'),
+        ]
 
 
 class BlockChangeLog(models.Model):
@@ -54,9 +160,46 @@ class BlockChangeLog(models.Model):
     changed_at = models.DateTimeField(auto_now_add=True)
     content_change = models.JSONField(blank=True, null=True, default=dict)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['block', '-changed_at', '-id'], name='api_blockchangelog_block_time'),
+        ]
+
+
+class BlockChangeOutbox(models.Model):
+    """Изменения, ещё не перенесённые в BlockChangeLog (см. api/changelog.py). Без внешних ключей и индексов."""
+    block_id = models.BigIntegerField()
+    changed_by_id = models.IntegerField()
+    changed_at = models.DateTimeField()
+    content_change = models.JSONField(default=dict)
+
 
 class Group(models.Model):
     name = models.CharField(max_length=100)
     members = models.ManyToManyField('auth.User', related_name='user_groups')
     visible_blocks = models.ManyToManyField(Block, related_name='group_visible_blocks')
     editable_blocks = models.ManyToManyField(Block, related_name='group_editable_blocks')
+
+
+class Profile(models.Model):
+    user = models.OneToOneField('auth.User', related_name='profile', on_delete=models.CASCADE, primary_key=True)
+    # Корневой блок пользователя, создаётся при регистрации (RegisterView)
+    root_block = models.ForeignKey(Block, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+
+
+class InstrumentationConfig(models.Model):
+    """
+    Переопределения REQUEST_INSTRUMENTATION для всех воркеров (одна строка, pk=1), их пишет
+    ./manage.py instrumentation, а api/middleware.py перечитывает раз в несколько секунд.
+    """
+    overrides = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class DeletedUser(models.Model):
+    """
+    Удалённые пользователи, чьи access-токены ещё не истекли (см. api/authentication.py).
+    Строки старше ACCESS_TOKEN_LIFETIME удаляются при следующем удалении пользователя.
+    """
+    user_id = models.IntegerField(primary_key=True)
+    deleted_at = models.DateTimeField(db_index=True)
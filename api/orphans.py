@@ -0,0 +1,86 @@
+"""
+Сборка мусора: удаление блоков, недостижимых ни из одного корневого блока пользователя.
+
+При удалении блока без родителей его дети остаются в api_block. collect_orphan_blocks один раз
+строит снимок недостижимых блоков (рекурсивный запрос по api_block_children во временную
+таблицу) и удаляет их пачками по batch_size, каждую в своей транзакции, запросами по всей пачке
+сразу, без ORM и сигналов на каждую строку: пути, связи, права, надгробия и сами блоки.
+Права пересчитываются только у уцелевших детей, потерявших родителя. Перед каждой пачкой из снимка
+убираются блоки, которые за это время снова привязали к дереву. Блоки моложе min_age не трогаются.
+
+Запускается командой ./manage.py collect_orphan_blocks (например, по cron).
+"""
+import logging
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .access import refresh_block_access
+from .cache import invalidate_trees
+from .events import publish_block_events
+from .hierarchy import bump_block_revisions, drop_block_paths
+from .query import (orphan_blocks_snapshot_query,
+                    rescue_orphan_blocks_query,
+                    block_rows_size_query,
+                    delete_orphan_blocks_query)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MIN_AGE = timedelta(days=1)
+
+
+def collect_orphan_blocks(batch_size=DEFAULT_BATCH_SIZE, min_age=DEFAULT_MIN_AGE, max_batches=None, dry_run=False):
+    """
+    Возвращает {'orphans': найдено блоков, 'blocks': удалено блоков, 'rows': удалено строк всего
+    (с каскадом), 'bytes': примерный объём удалённых строк}. dry_run - только посчитать.
+    """
+    stats = {'orphans': 0, 'blocks': 0, 'rows': 0, 'bytes': 0}
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS gc_orphan_blocks')
+        cursor.execute(orphan_blocks_snapshot_query, {'min_created_at': timezone.now() - min_age})
+        cursor.execute('ALTER TABLE gc_orphan_blocks ADD PRIMARY KEY (id)')
+        cursor.execute('SELECT count(*) FROM gc_orphan_blocks')
+        stats['orphans'] = cursor.fetchone()[0]
+        try:
+            if dry_run:
+                cursor.execute('SELECT id FROM gc_orphan_blocks')
+                stats['bytes'] = _rows_size(cursor, [row[0] for row in cursor.fetchall()])
+                return stats
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                if not _delete_batch(cursor, batch_size, stats):
+                    break
+                batches += 1
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS gc_orphan_blocks')
+    logger.info('orphan blocks collected: %s', stats, extra=stats)
+    return stats
+
+
+def _delete_batch(cursor, batch_size, stats):
+    with transaction.atomic():
+        cursor.execute(rescue_orphan_blocks_query)
+        cursor.execute('SELECT id FROM gc_orphan_blocks ORDER BY id LIMIT %s', [batch_size])
+        block_ids = [row[0] for row in cursor.fetchall()]
+        if not block_ids:
+            return False
+        stats['bytes'] += _rows_size(cursor, block_ids)
+        stats['rows'] += drop_block_paths(block_ids)
+        cursor.execute(delete_orphan_blocks_query, {'block_ids': block_ids})
+        blocks, rows, child_ids = cursor.fetchone()
+        stats['blocks'] += blocks
+        stats['rows'] += rows
+        cursor.execute('DELETE FROM gc_orphan_blocks WHERE id = ANY (%s::bigint[])', [block_ids])
+        # Дети, уцелевшие благодаря другим родителям, теряют права, унаследованные через удалённые блоки
+        changed_ids = refresh_block_access(child_ids)
+        bump_block_revisions(changed_ids)
+        invalidate_trees(set(block_ids) | changed_ids)
+        publish_block_events([(block_id, {'type': 'access', 'block_id': block_id}) for block_id in changed_ids])
+    return True
+
+
+def _rows_size(cursor, block_ids):
+    cursor.execute(block_rows_size_query, {'block_ids': block_ids})
+    return cursor.fetchone()[0]
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.request import Request
+
+
+class ChangeLogPagination(CursorPagination):
+    """Keyset-пагинация истории по индексу (block, changed_at, id)."""
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = ('-changed_at', '-id')
+
+
+class ChangeLogKeysetPagination(ChangeLogPagination):
+    """
+    Та же пагинация для асинхронной вью, которая читает историю запросом без ORM
+    (block_changelog_query / block_changelog_before_query). Курсор передаётся в том же параметре,
+    позиция в нём - пара (changed_at, id) крайней записи страницы.
+    """
+    # Позиция до первой страницы: все записи идут раньше неё
+    start_position = ('infinity', 2 ** 63 - 1)
+
+    def get_page_params(self, request):
+        """Разбирает параметры запроса. Возвращает (reverse, params), reverse - нужна предыдущая страница."""
+        request = Request(request)
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            changed_at, id = self.start_position
+        else:
+            changed_at, id = self._parse_position(self.cursor.position)
+        reverse = self.cursor is not None and self.cursor.reverse
+        return reverse, {'changed_at': changed_at, 'id': id, 'limit': self.page_size + 1}
+
+    def get_paginated_data(self, rows, reverse):
+        """rows - записи из запроса (с одной лишней), у каждой ключи changed_at и id."""
+        has_following = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_following
+        else:
+            has_next, has_previous = has_following, self.cursor is not None
+        next_link = previous_link = None
+        if rows and has_next:
+            next_link = self.encode_cursor(Cursor(offset=0, reverse=False, position=self._position(rows[-1])))
+        if rows and has_previous:
+            previous_link = self.encode_cursor(Cursor(offset=0, reverse=True, position=self._position(rows[0])))
+        return {'next': next_link, 'previous': previous_link, 'results': rows}
+
+    @staticmethod
+    def _position(row):
+        return f"{row['changed_at'].isoformat()}|{row['id']}"
+
+    def _parse_position(self, position):
+        changed_at, _, id = (position or '').rpartition('|')
+        try:
+            return datetime.fromisoformat(changed_at), int(id)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
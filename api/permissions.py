@@ -0,0 +1,54 @@
+"""
+Проверка прав на блоки. Один запрос на любой набор блоков, ответы запоминаются
+на время запроса: get_block_permissions(request) отдаёт один и тот же объект.
+"""
+from django.db import connection
+
+from .prepared import block_permissions_statement
+
+
+class BlockPermissions:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._can_view = {}
+        self._can_edit = {}
+
+    def can_view(self, block_id):
+        return block_id in self.viewable([block_id])
+
+    def can_edit(self, block_id):
+        return block_id in self.editable([block_id])
+
+    def viewable(self, block_ids):
+        """Подмножество block_ids, которые пользователь может видеть."""
+        self._load(block_ids)
+        return {block_id for block_id in block_ids if self._can_view[block_id]}
+
+    def editable(self, block_ids):
+        """Подмножество block_ids, которые пользователь может редактировать."""
+        self._load(block_ids)
+        return {block_id for block_id in block_ids if self._can_edit[block_id]}
+
+    def _load(self, block_ids):
+        missing = {block_id for block_id in block_ids if block_id not in self._can_view}
+        if not missing:
+            return
+        for block_id in missing:
+            # Несуществующие блоки недоступны
+            self._can_view[block_id] = self._can_edit[block_id] = False
+        with connection.cursor() as cursor:
+            block_permissions_statement.execute(cursor, {'user_id': self.user_id, 'block_ids': list(missing)})
+            for block_id, access_type, has_access, can_edit in cursor.fetchall():
+                self._can_view[block_id] = access_type in ('public', 'public_ed') or has_access
+                self._can_edit[block_id] = access_type == 'public_ed' or can_edit
+
+
+def get_block_permissions(request):
+    """BlockPermissions текущего пользователя, общий для всего запроса (и DRF Request, и HttpRequest)."""
+    http_request = getattr(request, '_request', request)
+    user_id = request.user.id if request.user.is_authenticated else None
+    permissions = getattr(http_request, '_block_permissions', None)
+    if permissions is None or permissions.user_id != user_id:
+        permissions = BlockPermissions(user_id)
+        http_request._block_permissions = permissions
+    return permissions
@@ -0,0 +1,77 @@
+"""
+Серверные prepared statements для самых частых запросов: дерево, версия поддерева (ETag) и права.
+
+Текст запроса разбирается и планируется Postgres один раз на соединение (PREPARE), дальше
+выполняется EXECUTE с параметрами. Postgres сам переходит на общий (generic) план, когда он
+не хуже планов под конкретные параметры (plan_cache_mode = auto), поэтому для запросов
+с массивами разной длины план по-прежнему подбирается под параметры.
+
+Имеет смысл вместе с постоянными соединениями (CONN_MAX_AGE): подготовленные запросы живут
+столько же, сколько соединение. Не совместимо с pgbouncer в режиме transaction pooling -
+тогда PREPARED_STATEMENTS = False.
+"""
+import re
+
+from django.conf import settings
+
+from .query import (get_blocks_query,
+                    flat_map_json_query,
+                    columnar_tree_query,
+                    subtree_version_query,
+                    block_permissions_query)
+
+_PARAM = re.compile(r'%\((\w+)\)s')
+
+TREE_PARAM_TYPES = {'user_id': 'integer',
+                    'block_ids': 'bigint[]',
+                    'max_depth': 'integer',
+                    'max_children': 'integer',
+                    'only_ids': 'bigint[]',
+                    'media_url': 'text'}
+
+
+class PreparedQuery:
+    def __init__(self, name, query, types):
+        """query - запрос с параметрами %(name)s, types - {имя параметра: тип в Postgres}."""
+        self.name = name
+        self.query = query
+        self.params = []
+        body = _PARAM.sub(self._placeholder, query).strip().rstrip(';')
+        self.prepare_sql = f'PREPARE {name} ({", ".join(types[param] for param in self.params)}) AS {body}'
+        self.execute_sql = f'EXECUTE {name} ({", ".join(["%s"] * len(self.params))})'
+
+    def _placeholder(self, match):
+        param = match.group(1)
+        if param not in self.params:
+            self.params.append(param)
+        return f'${self.params.index(param) + 1}'
+
+    def execute(self, cursor, params):
+        """Выполняет запрос на cursor (Django), при необходимости подготовив его на этом соединении."""
+        if not getattr(settings, 'PREPARED_STATEMENTS', True):
+            cursor.execute(self.query, params)
+            return
+        prepared = _prepared_statements(cursor.db)
+        if self.name not in prepared:
+            cursor.execute(self.prepare_sql)
+            prepared.add(self.name)
+        cursor.execute(self.execute_sql, [params[param] for param in self.params])
+
+
+def _prepared_statements(db):
+    """Имена запросов, подготовленных на текущем соединении db; после переподключения набор пустой."""
+    raw_connection = db.connection
+    state = getattr(db, '_prepared_statements', None)
+    if state is None or state[0] is not raw_connection:
+        state = (raw_connection, set())
+        db._prepared_statements = state
+    return state[1]
+
+
+blocks_statement = PreparedQuery('api_get_blocks', get_blocks_query, TREE_PARAM_TYPES)
+flat_map_json_statement = PreparedQuery('api_flat_map_json', flat_map_json_query, TREE_PARAM_TYPES)
+columnar_tree_statement = PreparedQuery('api_columnar_tree', columnar_tree_query, TREE_PARAM_TYPES)
+subtree_version_statement = PreparedQuery('api_subtree_version', subtree_version_query,
+                                          {'user_id': 'integer', 'block_id': 'bigint', 'max_depth': 'integer'})
+block_permissions_statement = PreparedQuery('api_block_permissions', block_permissions_query,
+                                            {'user_id': 'integer', 'block_ids': 'bigint[]'})
@@ -0,0 +1,31 @@
+"""
+Корневой блок пользователя.
+
+Хранится в Profile.root_block и дублируется в поле root_block_id JWT, так что для запросов
+с TokenUser (api/authentication.py) корень известен без запроса к базе.
+"""
+from .models import Profile
+
+ROOT_BLOCK_CLAIM = 'root_block_id'
+
+
+def root_block_claim(user):
+    """root_block_id из токена пользователя или None, если пользователь не из токена или в токене поля нет."""
+    token = getattr(user, 'token', None)
+    return token.get(ROOT_BLOCK_CLAIM) if token is not None else None
+
+
+def get_root_block_id(user):
+    root_block_id = root_block_claim(user)
+    if root_block_id is None:
+        root_block_id = Profile.objects.filter(pk=user.id).values_list('root_block_id', flat=True).first()
+    return root_block_id
+
+
+def add_root_block_claim(token, user, root_block_id=None):
+    """Добавляет root_block_id в refresh-токен (access-токен получает его при выпуске из refresh)."""
+    if root_block_id is None:
+        root_block_id = Profile.objects.filter(pk=user.pk).values_list('root_block_id', flat=True).first()
+    if root_block_id is not None:
+        token[ROOT_BLOCK_CLAIM] = root_block_id
+    return token
@@ -1,103 +1,972 @@
+def api_datetime(column):
+    """
+    SQL-выражение: время column строкой так, как его выводит JSONEncoder DRF
+    (isoformat в UTC: микросекунды, если они есть, и суффикс Z вместо +00:00).
+    """
+    utc = f"{column} AT TIME ZONE 'UTC'"
+    return (f"to_char({utc}, 'YYYY-MM-DD\"T\"HH24:MI:SS') || "
+            f"CASE WHEN date_trunc('second', {column}) = {column} THEN '' ELSE to_char({utc}, '.US') END || 'Z'")
+
+
+# Поддеревья нескольких корней (block_ids) глубиной max_depth одним запросом. Если задан max_children,
+# у каждого узла загружаются только первые max_children детей (в порядке добавления связи),
+# а сам узел помечается как is_fully_loaded = false. Общие узлы поддеревьев возвращаются один раз,
+# paths считаются от того корня, через который узел найден. only_ids (если задан) оставляет в ответе
+# только эти узлы поддерева; вместе с max_children его не используют.
+# Пути собираются обходом api_block_children от корней: BlockPath их не хранит, а проверка на цикл
+# не нужна - циклы не даёт создать check_new_edges (api/hierarchy.py).
 get_blocks_query = '''
 WITH RECURSIVE
-    block_hierarchy AS (SELECT b.id,
-                               ARRAY [b.id]             AS path,
-                               0                        AS depth,
-                               b.creator_id,
-                               b.access_type                 AS direct_status,
-                               CASE
-                                   WHEN b.access_type = 'public' THEN 'public'
-                                   WHEN b.access_type = 'private' THEN 'private'
-                                   ELSE 'inherited' END AS effective_status,
-                               b.text,
-                               b."content_classList",
-                               b.children_position,
-                               b."classList",
-                               b.layout,
-                               COALESCE(b.color, 'default_color') AS color,
-                               b.created_at,
-                               b.updated_at,
-                               b.properties,
-                               true                     AS is_complete,
-                               CASE
-                                   WHEN b.access_type = 'inherited' AND NOT EXISTS (SELECT 1
-                                                                               FROM api_block_visible_to_users bv
-                                                                               WHERE bv.block_id = b.id
-                                                                                 AND bv.user_id = %(user_id)s) THEN true
-                                   ELSE false
-                                   END                  AS is_ambiguous,
-                                false AS has_children_at_max_depth
-                        FROM api_block b
-                        WHERE b.id = %(block_id)s
-                          AND (b.access_type = 'public'
-                           OR (b.access_type = 'private' AND EXISTS (SELECT 1
-                                                                 FROM api_block_visible_to_users bv
-                                                                 WHERE bv.block_id = b.id
-                                                                   AND bv.user_id = %(user_id)s)) 
-                           OR (b.access_type = 'inherited' AND EXISTS (SELECT 1
-                                                                   FROM api_block_visible_to_users bv
-                                                                   WHERE bv.block_id = b.id
-                                                                     AND bv.user_id = %(user_id)s)))
-
-                        UNION ALL
-
-                        SELECT b.id,
-                               bh.path || ARRAY [b.id],
-                               bh.depth + 1,
-                               b.creator_id,
-                               b.access_type                         AS direct_status,
-                               CASE
-                                   WHEN b.access_type = 'public' THEN 'public'
-                                   WHEN b.access_type = 'private' THEN 'private'
-                                   WHEN b.access_type = 'inherited' THEN bh.effective_status
-                                   ELSE bh.effective_status END AS effective_status,
-                               b.text,
-                               b."content_classList",
-                               b.children_position,
-                               b."classList",
-                               b.layout,
-                               COALESCE(b.color, bh.color) AS color,
-                               b.created_at,
-                               b.updated_at,
-                               b.properties,
-                               (bh.depth + 1 < 5)                   AS is_complete,
-                               bh.is_ambiguous,
-                               CASE
-                                   WHEN bh.depth + 1 = 5 AND EXISTS (SELECT 1
-                                                                     FROM api_block_children bc
-                                                                     WHERE bc.from_block_id = b.id) THEN true
-                                   ELSE bh.has_children_at_max_depth
-                               END AS has_children_at_max_depth
-                        FROM api_block b
-                                 JOIN api_block_children bc ON b.id = bc.to_block_id
-                                 JOIN block_hierarchy bh ON bh.id = bc.from_block_id
-                        WHERE NOT b.id = ANY (bh.path)
-                            AND bh.depth + 1 < 5),
-    first_level_children AS (SELECT bc.from_block_id          AS parent_id,
-                                    array_agg(bc.to_block_id) AS first_level_children_ids
-                             FROM api_block_children bc
-                             GROUP BY bc.from_block_id)
-SELECT bh.id,
-       string_agg(array_to_string(bh.path, ','), ';') AS paths,
-       bh.creator_id,
-       bh.direct_status,
-       bh.effective_status,
-       bh.text,
-       bh."content_classList",
-       bh."classList",
-       bh.children_position,
-       bh.layout,
-       bh.color,
-       bh.created_at,
-       bh.updated_at,
-       bh.properties,
-       bool_and(bh.is_complete) AND NOT bool_or(bh.has_children_at_max_depth) AS is_fully_loaded,
-       COALESCE(fl.first_level_children_ids, '{}')    AS children,
-       bh.is_ambiguous
-FROM block_hierarchy bh
-         LEFT JOIN first_level_children fl ON bh.id = fl.parent_id
-GROUP BY bh.id, bh.creator_id, bh.direct_status, bh.effective_status, bh.text, bh."content_classList", bh."classList",
-         bh.layout, bh.color, bh.created_at, bh.updated_at, fl.first_level_children_ids, bh.children_position, bh.properties,
-         bh.is_ambiguous
-ORDER BY bh.id;
-'''
\ No newline at end of file
+    root AS (SELECT b.id,
+                    CASE
+                        WHEN b.access_type = 'inherited' AND NOT EXISTS (SELECT 1
+                                                                    FROM api_block_visible_to_users bv
+                                                                    WHERE bv.block_id = b.id
+                                                                      AND bv.user_id = %(user_id)s) THEN true
+                        ELSE false
+                        END AS is_ambiguous
+             FROM api_block b
+             WHERE b.id = ANY (%(block_ids)s::bigint[])
+               AND (b.access_type = 'public'
+                OR (b.access_type IN ('private', 'inherited') AND EXISTS (SELECT 1
+                                                                        FROM api_blockaccess ba
+                                                                        WHERE ba.block_id = b.id
+                                                                          AND ba.user_id = %(user_id)s)))),
+    -- LIMIT NULL (max_children не задан) - все дети
+    subtree(id, path, depth, is_ambiguous) AS (SELECT root.id, ARRAY [root.id], 0, root.is_ambiguous
+                                               FROM root
+                                               UNION ALL
+                                               SELECT c.id, s.path || c.id, s.depth + 1, s.is_ambiguous
+                                               FROM subtree s
+                                                        CROSS JOIN LATERAL (SELECT bc.to_block_id AS id
+                                                                            FROM api_block_children bc
+                                                                            WHERE bc.from_block_id = s.id
+                                                                            ORDER BY bc.id
+                                                                            LIMIT %(max_children)s::int) c
+                                               WHERE s.depth + 1 < %(max_depth)s),
+    visible_subtree AS (SELECT s.*
+                        FROM subtree s
+                        WHERE %(only_ids)s::bigint[] IS NULL
+                           OR s.id = ANY (%(only_ids)s::bigint[]))
+SELECT b.id,
+       string_agg(array_to_string(s.path, ','), ';')                AS paths,
+       b.creator_id,
+       b.access_type                                                AS direct_status,
+       COALESCE(st.access_type, 'inherited')                        AS effective_status,
+       b.text,
+       b."content_classList",
+       b."classList",
+       b.children_position,
+       b.layout,
+       COALESCE(cl.color, 'default_color')                          AS color,
+       ''' + api_datetime('b.created_at') + ''' AS created_at,
+       ''' + api_datetime('b.updated_at') + ''' AS updated_at,
+       b.properties,
+       NULLIF(b.image, '')                                          AS image,
+       -- Адреса вариантов картинки, см. api/images.py
+       CASE
+           WHEN b.image <> '' THEN json_build_object(
+                   'original', %(media_url)s || b.image,
+                   'thumb', %(media_url)s || 'images/variants/thumb/' || b.image || '.webp',
+                   'medium', %(media_url)s || 'images/variants/medium/' || b.image || '.webp')
+           END                                                      AS image_variants,
+       bool_and((s.depth < %(max_depth)s - 1 OR cardinality(fl.children) = 0)
+           AND (%(max_children)s::int IS NULL OR cardinality(fl.children) <= %(max_children)s::int)) AS is_fully_loaded,
+       fl.children,
+       bool_and(s.is_ambiguous)                                     AS is_ambiguous
+FROM visible_subtree s
+         JOIN api_block b ON b.id = s.id
+    -- effective_status: ближайший по пути блок с явным public/private, иначе inherited
+         LEFT JOIN LATERAL (SELECT a.access_type
+                            FROM unnest(s.path) WITH ORDINALITY AS p(id, ord)
+                                     JOIN api_block a ON a.id = p.id
+                            WHERE a.access_type IN ('public', 'private')
+                            ORDER BY p.ord DESC
+                            LIMIT 1) st ON true
+    -- color: ближайший по пути блок с заданным цветом
+         LEFT JOIN LATERAL (SELECT a.color
+                            FROM unnest(s.path) WITH ORDINALITY AS p(id, ord)
+                                     JOIN api_block a ON a.id = p.id
+                            WHERE a.color IS NOT NULL
+                            ORDER BY p.ord DESC
+                            LIMIT 1) cl ON true
+         CROSS JOIN LATERAL (SELECT ARRAY(SELECT bc.to_block_id
+                                          FROM api_block_children bc
+                                          WHERE bc.from_block_id = b.id
+                                          ORDER BY bc.id) AS children) fl
+GROUP BY b.id, st.access_type, cl.color, fl.children
+ORDER BY b.id;
+'''
+
+# Результат get_blocks_query одним JSON-документом {id: блок} в том виде, который отдаёт API,
+# и id вошедших блоков для индекса кэша поддеревьев
+flat_map_json_query = '''
+SELECT COALESCE(json_object_agg(t.id, json_build_object('id', t.id,
+                                                         'paths', string_to_array(t.paths, ';'),
+                                                         'creator_id', t.creator_id,
+                                                         'direct_status', t.direct_status,
+                                                         'effective_status', t.effective_status,
+                                                         'text', t.text,
+                                                         'content_classList', t."content_classList",
+                                                         'classList', t."classList",
+                                                         'children_position', t.children_position,
+                                                         'layout', t.layout,
+                                                         'color', t.color,
+                                                         'created_at', t.created_at,
+                                                         'updated_at', t.updated_at,
+                                                         'properties', t.properties,
+                                                         'image', t.image,
+                                                         'image_variants', t.image_variants,
+                                                         'is_fully_loaded', t.is_fully_loaded,
+                                                         'children', t.children,
+                                                         'is_ambiguous', t.is_ambiguous) ORDER BY t.id),
+                '{}')::text,
+       COALESCE(array_agg(t.id), '{}')
+FROM (''' + get_blocks_query.strip().rstrip(';') + ''') t;
+'''
+
+# Тот же результат в столбцовом виде: {"ids": [...], "columns": {поле: [значение по каждому id]},
+# "interned": [поля], "values": [...]}. В полях из interned вместо значений индексы в общей таблице
+# values, пути - массивы id.
+columnar_tree_query = '''
+WITH blocks AS (''' + get_blocks_query.strip().rstrip(';') + '''),
+     cells AS (SELECT b.id, c.name, COALESCE(c.value, 'null'::jsonb) AS value
+               FROM blocks b
+                        CROSS JOIN LATERAL (VALUES ('direct_status', to_jsonb(b.direct_status)),
+                                                   ('effective_status', to_jsonb(b.effective_status)),
+                                                   ('content_classList', b."content_classList"),
+                                                   ('classList', b."classList"),
+                                                   ('layout', to_jsonb(b.layout)),
+                                                   ('color', to_jsonb(b.color)),
+                                                   ('properties', b.properties)) AS c(name, value)),
+     dictionary AS (SELECT value, (row_number() OVER (ORDER BY min(id), value::text) - 1)::int AS idx
+                    FROM cells
+                    GROUP BY value),
+     interned AS (SELECT c.name, json_agg(d.idx ORDER BY c.id) AS indexes
+                  FROM cells c
+                           JOIN dictionary d ON d.value = c.value
+                  GROUP BY c.name),
+     plain AS (SELECT json_build_object(
+                              'paths', json_agg((SELECT json_agg(string_to_array(p, ',')::bigint[])
+                                                 FROM unnest(string_to_array(b.paths, ';')) AS p) ORDER BY b.id),
+                              'creator_id', json_agg(b.creator_id ORDER BY b.id),
+                              'text', json_agg(b.text ORDER BY b.id),
+                              'children_position', json_agg(b.children_position ORDER BY b.id),
+                              'image', json_agg(b.image ORDER BY b.id),
+                              'image_variants', json_agg(b.image_variants ORDER BY b.id),
+                              'created_at', json_agg(b.created_at ORDER BY b.id),
+                              'updated_at', json_agg(b.updated_at ORDER BY b.id),
+                              'is_fully_loaded', json_agg(b.is_fully_loaded ORDER BY b.id),
+                              'children', json_agg(b.children ORDER BY b.id),
+                              'is_ambiguous', json_agg(b.is_ambiguous ORDER BY b.id))::jsonb AS columns,
+                      COALESCE(array_agg(b.id ORDER BY b.id), '{}') AS ids
+               FROM blocks b)
+SELECT json_build_object('format', 'columnar',
+                         'ids', plain.ids,
+                         'columns', plain.columns || COALESCE((SELECT jsonb_object_agg(name, indexes) FROM interned), '{}'),
+                         'interned', COALESCE((SELECT json_agg(name ORDER BY name) FROM interned), '[]'),
+                         'values', COALESCE((SELECT json_agg(value ORDER BY idx) FROM dictionary), '[]'))::text,
+       plain.ids
+FROM plain;
+'''
+
+add_block_paths_query = '''
+INSERT INTO api_blockpath (ancestor_id, descendant_id, depth, paths)
+SELECT b.id, b.id, 0, 1
+FROM unnest(%(block_ids)s::bigint[]) AS b(id)
+ON CONFLICT DO NOTHING;
+'''
+
+# Пути через рёбра parent -> child: (путь, заканчивающийся в parent) + ребро + (путь из child), их число -
+# произведение чисел путей. На DAG такой путь простой: иначе child был бы предком parent.
+# Путь через два ребра из набора одним запросом посчитался бы неверно, такие наборы hierarchy.py
+# обрабатывает по одному ребру.
+edge_paths_delta = '''
+SELECT up.ancestor_id, down.descendant_id, up.depth + 1 + down.depth AS depth, sum(up.paths * down.paths)::bigint AS paths
+FROM unnest(%(parent_ids)s::bigint[], %(child_ids)s::bigint[]) AS e(parent_id, child_id)
+         JOIN api_blockpath up ON up.descendant_id = e.parent_id
+         JOIN api_blockpath down ON down.ancestor_id = e.child_id
+WHERE up.depth + 1 + down.depth <= %(max_depth)s
+GROUP BY up.ancestor_id, down.descendant_id, up.depth + 1 + down.depth
+'''
+
+link_block_paths_query = '''
+INSERT INTO api_blockpath (ancestor_id, descendant_id, depth, paths)
+''' + edge_paths_delta + '''
+ON CONFLICT (ancestor_id, depth, descendant_id) DO UPDATE SET paths = api_blockpath.paths + excluded.paths;
+'''
+
+# Вычитает пути через рёбра; пары, у которых путей не осталось, удаляются
+unlink_block_paths_query = '''
+WITH delta AS (''' + edge_paths_delta + '''),
+     dropped AS (DELETE
+                 FROM api_blockpath bp
+                     USING delta d
+                 WHERE bp.ancestor_id = d.ancestor_id
+                   AND bp.depth = d.depth
+                   AND bp.descendant_id = d.descendant_id
+                   AND bp.paths <= d.paths)
+UPDATE api_blockpath bp
+SET paths = bp.paths - d.paths
+FROM delta d
+WHERE bp.ancestor_id = d.ancestor_id
+  AND bp.depth = d.depth
+  AND bp.descendant_id = d.descendant_id
+  AND bp.paths > d.paths;
+'''
+
+# Достижим ли parent одного из рёбер из child другого (или это один блок): тогда какой-то путь может пройти
+# через оба ребра
+edges_overlap_query = '''
+SELECT EXISTS (SELECT 1
+               FROM api_blockpath bp
+               WHERE bp.ancestor_id = ANY (%(child_ids)s::bigint[])
+                 AND bp.descendant_id = ANY (%(parent_ids)s::bigint[]));
+'''
+
+# Связи children для пакетных операций. Возвращают только реально добавленные / удалённые пары
+insert_block_children_query = '''
+INSERT INTO api_block_children (from_block_id, to_block_id)
+SELECT e.parent_id, e.child_id
+FROM unnest(%(parent_ids)s::bigint[], %(child_ids)s::bigint[]) AS e(parent_id, child_id)
+ON CONFLICT DO NOTHING
+RETURNING from_block_id, to_block_id;
+'''
+
+delete_block_children_query = '''
+DELETE
+FROM api_block_children bc
+    USING unnest(%(parent_ids)s::bigint[], %(child_ids)s::bigint[]) AS e(parent_id, child_id)
+WHERE bc.from_block_id = e.parent_id
+  AND bc.to_block_id = e.child_id
+RETURNING bc.from_block_id, bc.to_block_id;
+'''
+
+# Убирает из BlockPath удаляемые блоки, у которых нет предков среди block_ids (через два таких блока путь
+# пройти не может): вычитает пути, проходящие через них, и удаляет их собственные строки.
+# Возвращает обработанные блоки и число удалённых строк; остальные hierarchy.py передаёт следующим вызовом
+drop_block_paths_query = '''
+WITH layer AS (SELECT x.id
+               FROM unnest(%(block_ids)s::bigint[]) AS x(id)
+               WHERE NOT EXISTS (SELECT 1
+                                 FROM api_blockpath bp
+                                 WHERE bp.descendant_id = x.id
+                                   AND bp.depth > 0
+                                   AND bp.ancestor_id = ANY (%(block_ids)s::bigint[]))),
+     delta AS (SELECT up.ancestor_id, down.descendant_id, up.depth + down.depth AS depth,
+                      sum(up.paths * down.paths)::bigint AS paths
+               FROM layer l
+                        JOIN api_blockpath up ON up.descendant_id = l.id AND up.depth > 0
+                        JOIN api_blockpath down ON down.ancestor_id = l.id AND down.depth > 0
+               WHERE up.depth + down.depth <= %(max_depth)s
+                 AND up.ancestor_id NOT IN (SELECT id FROM layer)
+                 AND down.descendant_id NOT IN (SELECT id FROM layer)
+               GROUP BY up.ancestor_id, down.descendant_id, up.depth + down.depth),
+     dropped AS (DELETE
+                 FROM api_blockpath bp
+                     USING delta d
+                 WHERE bp.ancestor_id = d.ancestor_id
+                   AND bp.depth = d.depth
+                   AND bp.descendant_id = d.descendant_id
+                   AND bp.paths <= d.paths
+                 RETURNING 1),
+     updated AS (UPDATE api_blockpath bp
+                 SET paths = bp.paths - d.paths
+                 FROM delta d
+                 WHERE bp.ancestor_id = d.ancestor_id
+                   AND bp.depth = d.depth
+                   AND bp.descendant_id = d.descendant_id
+                   AND bp.paths > d.paths),
+     own AS (DELETE
+             FROM api_blockpath bp
+             WHERE bp.ancestor_id IN (SELECT id FROM layer)
+                OR bp.descendant_id IN (SELECT id FROM layer)
+             RETURNING 1)
+SELECT ARRAY(SELECT id FROM layer), (SELECT count(*) FROM dropped) + (SELECT count(*) FROM own);
+'''
+
+# Пересчёт api_blockaccess для блоков block_ids и всех их потомков, которые наследуют права
+# через цепочку inherited-блоков. Права родителей вне этого множества берутся из api_blockaccess.
+# Возвращает id блоков, у которых набор прав изменился.
+refresh_block_access_query = '''
+WITH RECURSIVE
+    affected AS (SELECT b.id
+                 FROM api_block b
+                 WHERE b.id = ANY (%(block_ids)s::bigint[])
+                 UNION
+                 SELECT bc.to_block_id
+                 FROM affected a
+                          JOIN api_block_children bc ON bc.from_block_id = a.id
+                          JOIN api_block c ON c.id = bc.to_block_id AND c.access_type = 'inherited'),
+    grants(block_id, user_id, can_edit) AS (SELECT bv.block_id, bv.user_id, false
+                                            FROM api_block_visible_to_users bv
+                                            WHERE bv.block_id IN (SELECT id FROM affected)
+                                            UNION
+                                            SELECT be.block_id, be.user_id, true
+                                            FROM api_block_editable_by_users be
+                                            WHERE be.block_id IN (SELECT id FROM affected)
+                                            UNION
+                                            SELECT gv.block_id, gm.user_id, false
+                                            FROM api_group_visible_blocks gv
+                                                     JOIN api_group_members gm ON gm.group_id = gv.group_id
+                                            WHERE gv.block_id IN (SELECT id FROM affected)
+                                            UNION
+                                            SELECT ge.block_id, gm.user_id, true
+                                            FROM api_group_editable_blocks ge
+                                                     JOIN api_group_members gm ON gm.group_id = ge.group_id
+                                            WHERE ge.block_id IN (SELECT id FROM affected)
+                                            UNION
+                                            SELECT bc.to_block_id, ba.user_id, ba.can_edit
+                                            FROM api_block_children bc
+                                                     JOIN api_block c ON c.id = bc.to_block_id AND c.access_type = 'inherited'
+                                                     JOIN api_blockaccess ba ON ba.block_id = bc.from_block_id
+                                            WHERE bc.to_block_id IN (SELECT id FROM affected)
+                                              AND bc.from_block_id NOT IN (SELECT id FROM affected)
+                                            UNION
+                                            SELECT bc.to_block_id, g.user_id, g.can_edit
+                                            FROM grants g
+                                                     JOIN api_block_children bc ON bc.from_block_id = g.block_id
+                                                     JOIN api_block c ON c.id = bc.to_block_id AND c.access_type = 'inherited'
+                                            WHERE bc.to_block_id IN (SELECT id FROM affected)),
+    fresh AS (SELECT block_id, user_id, bool_or(can_edit) AS can_edit
+              FROM grants
+              GROUP BY block_id, user_id),
+    removed AS (DELETE FROM api_blockaccess ba
+        WHERE ba.block_id IN (SELECT id FROM affected)
+            AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.block_id = ba.block_id AND f.user_id = ba.user_id)
+        RETURNING ba.block_id),
+    upserted AS (INSERT INTO api_blockaccess (block_id, user_id, can_edit)
+        SELECT block_id, user_id, can_edit FROM fresh
+        ON CONFLICT (block_id, user_id) DO UPDATE SET can_edit = EXCLUDED.can_edit
+            WHERE api_blockaccess.can_edit <> EXCLUDED.can_edit
+        RETURNING block_id)
+SELECT block_id
+FROM removed
+UNION
+SELECT block_id
+FROM upserted;
+'''
+
+# Версия поддерева для ETag: меняется при любой записи в блок (change_seq из последовательности, а не
+# часы приложения), изменении связей и прав (revision), удалении узлов (число путей) и потере доступа
+# к корню. max(updated_at) нужен только для Last-Modified.
+subtree_version_query = '''
+SELECT max(b.updated_at),
+       max(b.change_seq),
+       COALESCE(sum(b.revision), 0),
+       COALESCE(sum(bp.paths), 0),
+       EXISTS (SELECT 1
+               FROM api_block r
+               WHERE r.id = %(block_id)s
+                 AND (r.access_type = 'public'
+                   OR EXISTS (SELECT 1
+                              FROM api_blockaccess ba
+                              WHERE ba.block_id = r.id
+                                AND ba.user_id = %(user_id)s))),
+       pg_snapshot_xmin(pg_current_snapshot())::text::bigint
+FROM api_blockpath bp
+         JOIN api_block b ON b.id = bp.descendant_id
+WHERE bp.ancestor_id = %(block_id)s
+  AND bp.depth < %(max_depth)s;
+'''
+
+# Версия для delta sync: xmin текущего снимка. Все транзакции с xid меньше него завершены, поэтому
+# изменения, которые ещё не видны (транзакция не закоммичена), получат xid не меньше версии
+# и попадут в следующий ответ. Изменения с xid >= версии могут прийти повторно
+change_version_query = '''
+SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint;
+'''
+
+# Блоки поддерева, изменённые транзакциями начиная с since: идём от индекса по change_xid,
+# а не по всему поддереву. Плюс поддеревья, привязанные или отвязанные за это время: у их блоков
+# поменялись пути, а строки нет
+changed_blocks_query = '''
+SELECT b.id
+FROM api_block b
+         JOIN api_blockpath bp ON bp.descendant_id = b.id
+WHERE b.change_xid >= %(since)s
+  AND bp.ancestor_id = %(block_id)s
+  AND bp.depth < %(max_depth)s
+UNION
+SELECT bp.descendant_id
+FROM api_blocktombstone t
+         JOIN api_blockpath moved ON moved.ancestor_id = t.block_id
+         JOIN api_blockpath bp ON bp.descendant_id = moved.descendant_id
+WHERE t.xid >= %(since)s
+  AND t.kind IN ('linked', 'unlinked')
+  AND moved.depth < %(max_depth)s
+  AND bp.ancestor_id = %(block_id)s
+  AND bp.depth < %(max_depth)s;
+'''
+
+# Удаления и отвязки начиная с since, у которых родитель (или сам блок) в поддереве
+block_tombstones_query = '''
+SELECT t.seq, t.kind, t.block_id, t.parent_id
+FROM api_blocktombstone t
+WHERE t.xid >= %(since)s
+  AND t.kind IN ('deleted', 'unlinked')
+  AND (t.block_id = %(block_id)s
+    OR EXISTS (SELECT 1
+               FROM api_blockpath bp
+               WHERE bp.descendant_id = t.parent_id
+                 AND bp.ancestor_id = %(block_id)s
+                 AND bp.depth < %(max_depth)s))
+ORDER BY t.seq;
+'''
+
+add_block_tombstones_query = '''
+INSERT INTO api_blocktombstone (seq, xid, kind, block_id, parent_id)
+SELECT nextval('api_block_change_seq'), pg_current_xact_id()::text::bigint, %(kind)s, t.block_id, t.parent_id
+FROM unnest(%(block_ids)s::bigint[], %(parent_ids)s::bigint[]) AS t(block_id, parent_id);
+'''
+
+# NULL, если блока нет; иначе может ли пользователь его видеть
+can_view_block_query = '''
+SELECT b.access_type IN ('public', 'public_ed')
+           OR EXISTS (SELECT 1
+                      FROM api_blockaccess ba
+                      WHERE ba.block_id = b.id
+                        AND ba.user_id = %(user_id)s)
+FROM api_block b
+WHERE b.id = %(block_id)s;
+'''
+
+# Страница истории блока после курсора (changed_at, id), от новых к старым, см. api/pagination.py
+block_changelog_query = '''
+SELECT c.id,
+       c.block_id   AS block,
+       c.changed_at,
+       c.content_change,
+       u.id         AS changed_by_id,
+       u.username   AS changed_by_username,
+       u.email      AS changed_by_email
+FROM api_blockchangelog c
+         JOIN auth_user u ON u.id = c.changed_by_id
+WHERE c.block_id = %(block_id)s
+  AND (c.changed_at, c.id) < (%(changed_at)s::timestamptz, %(id)s::bigint)
+ORDER BY c.changed_at DESC, c.id DESC
+LIMIT %(limit)s;
+'''
+
+# Предыдущая страница истории: записи новее курсора, от старых к новым
+block_changelog_before_query = '''
+SELECT c.id,
+       c.block_id   AS block,
+       c.changed_at,
+       c.content_change,
+       u.id         AS changed_by_id,
+       u.username   AS changed_by_username,
+       u.email      AS changed_by_email
+FROM api_blockchangelog c
+         JOIN auth_user u ON u.id = c.changed_by_id
+WHERE c.block_id = %(block_id)s
+  AND (c.changed_at, c.id) > (%(changed_at)s::timestamptz, %(id)s::bigint)
+ORDER BY c.changed_at, c.id
+LIMIT %(limit)s;
+'''
+
+# Слушают ли канал событий другие воркеры (PostgresBroker): последний запрос слушающего соединения - LISTEN
+block_events_listeners_query = '''
+SELECT EXISTS (SELECT 1
+               FROM pg_stat_activity
+               WHERE datname = current_database()
+                 AND state = 'idle'
+                 AND query = %(listen)s);
+'''
+
+block_ancestors_query = '''
+SELECT bp.descendant_id, array_agg(DISTINCT bp.ancestor_id)
+FROM api_blockpath bp
+WHERE bp.descendant_id = ANY (%(block_ids)s::bigint[])
+GROUP BY bp.descendant_id;
+'''
+
+# Перенос пачки записей из outbox в историю. Записи об уже удалённых блоках и пользователях отбрасываются.
+flush_changelog_query = '''
+WITH moved AS (DELETE
+    FROM api_blockchangeoutbox
+        WHERE id IN (SELECT id
+                     FROM api_blockchangeoutbox
+                     ORDER BY id
+                     LIMIT %(limit)s FOR UPDATE SKIP LOCKED)
+        RETURNING id, block_id, changed_by_id, changed_at, content_change),
+     inserted AS (INSERT INTO api_blockchangelog (block_id, changed_by_id, changed_at, content_change)
+         SELECT m.block_id, m.changed_by_id, m.changed_at, m.content_change
+         FROM moved m
+         WHERE EXISTS (SELECT 1 FROM api_block b WHERE b.id = m.block_id)
+           AND EXISTS (SELECT 1 FROM auth_user u WHERE u.id = m.changed_by_id)
+         ORDER BY m.id)
+SELECT count(*)
+FROM moved;
+'''
+
+# Права пользователя сразу на несколько блоков: (id, access_type, есть ли строка доступа, can_edit)
+block_permissions_query = '''
+SELECT b.id, b.access_type, ba.id IS NOT NULL, COALESCE(ba.can_edit, false)
+FROM api_block b
+         LEFT JOIN api_blockaccess ba ON ba.block_id = b.id AND ba.user_id = %(user_id)s
+WHERE b.id = ANY (%(block_ids)s::bigint[]);
+'''
+
+# Полнотекстовый поиск по видимым блокам с сортировкой по релевантности и keyset-пагинацией по (rank, id).
+# path - путь от самого дальнего по BlockPath видимого предка до найденного блока. Он собирается от предка
+# вниз: на каждом шаге берётся ребёнок, от которого до блока остаётся путь нужной длины.
+search_blocks_query = '''
+WITH search AS (SELECT websearch_to_tsquery('simple', %(query)s) AS query),
+     hits AS (SELECT b.id, b.text, b.updated_at, ts_rank(b.search_vector, s.query)::float8 AS rank
+              FROM api_block b,
+                   search s
+              WHERE b.search_vector @@ s.query
+                AND (b.access_type IN ('public', 'public_ed')
+                  OR EXISTS (SELECT 1
+                             FROM api_blockaccess ba
+                             WHERE ba.block_id = b.id
+                               AND ba.user_id = %(user_id)s)))
+SELECT h.id, h.text, h.updated_at, h.rank, p.path
+FROM hits h
+         LEFT JOIN LATERAL (WITH RECURSIVE
+                                top AS (SELECT bp.ancestor_id, bp.depth
+                                        FROM api_blockpath bp
+                                                 JOIN api_block a ON a.id = bp.ancestor_id
+                                        WHERE bp.descendant_id = h.id
+                                          AND (a.access_type IN ('public', 'public_ed')
+                                            OR EXISTS (SELECT 1
+                                                       FROM api_blockaccess ba
+                                                       WHERE ba.block_id = a.id
+                                                         AND ba.user_id = %(user_id)s))
+                                        ORDER BY bp.depth DESC, bp.ancestor_id
+                                        LIMIT 1),
+                                walk(id, depth, path) AS (SELECT ancestor_id, depth::int, ARRAY [ancestor_id]
+                                                          FROM top
+                                                          UNION ALL
+                                                          SELECT n.id, w.depth - 1, w.path || n.id
+                                                          FROM walk w
+                                                                   CROSS JOIN LATERAL (SELECT bc.to_block_id AS id
+                                                                                       FROM api_block_children bc
+                                                                                                JOIN api_blockpath bp
+                                                                                                     ON bp.ancestor_id = bc.to_block_id
+                                                                                                         AND bp.depth = w.depth - 1
+                                                                                                         AND bp.descendant_id = h.id
+                                                                                       WHERE bc.from_block_id = w.id
+                                                                                       ORDER BY bc.to_block_id
+                                                                                       LIMIT 1) n
+                                                          WHERE w.depth > 0)
+                            SELECT walk.path
+                            FROM walk
+                            WHERE walk.depth = 0) p ON true
+WHERE %(after_rank)s::float8 IS NULL
+   OR (h.rank, h.id) < (%(after_rank)s::float8, %(after_id)s::bigint)
+ORDER BY h.rank DESC, h.id DESC
+LIMIT %(limit)s;
+'''
+
+# Сборка мусора (api/orphans.py). Снимок недостижимых блоков: всё, до чего нельзя дойти по api_block_children
+# от корней пользователей (Profile.root_block, у пользователей без корня в профиле - первый блок создателя)
+# и от блоков, созданных не раньше min_created_at (их ещё могут привязать к дереву).
+orphan_blocks_snapshot_query = '''
+CREATE TEMP TABLE gc_orphan_blocks AS
+WITH RECURSIVE reachable(id) AS (SELECT seeds.id
+                                 FROM (SELECT p.root_block_id AS id
+                                       FROM api_profile p
+                                       WHERE p.root_block_id IS NOT NULL
+                                       UNION
+                                       SELECT min(b.id)
+                                       FROM api_block b
+                                       WHERE NOT EXISTS (SELECT 1
+                                                         FROM api_profile p
+                                                         WHERE p.user_id = b.creator_id
+                                                           AND p.root_block_id IS NOT NULL)
+                                       GROUP BY b.creator_id
+                                       UNION
+                                       SELECT b.id
+                                       FROM api_block b
+                                       WHERE b.created_at >= %(min_created_at)s) seeds
+                                 UNION
+                                 SELECT bc.to_block_id
+                                 FROM reachable r
+                                          JOIN api_block_children bc ON bc.from_block_id = r.id)
+SELECT b.id
+FROM api_block b
+WHERE NOT EXISTS (SELECT 1 FROM reachable r WHERE r.id = b.id);
+'''
+
+# Убирает из снимка блоки, которые после него снова стали достижимыми: у них появился родитель вне снимка
+rescue_orphan_blocks_query = '''
+WITH RECURSIVE rescued(id) AS (SELECT bc.to_block_id
+                               FROM api_block_children bc
+                                        JOIN gc_orphan_blocks o ON o.id = bc.to_block_id
+                               WHERE NOT EXISTS (SELECT 1 FROM gc_orphan_blocks p WHERE p.id = bc.from_block_id)
+                               UNION
+                               SELECT bc.to_block_id
+                               FROM rescued r
+                                        JOIN api_block_children bc ON bc.from_block_id = r.id
+                                        JOIN gc_orphan_blocks o ON o.id = bc.to_block_id)
+DELETE
+FROM gc_orphan_blocks
+WHERE id IN (SELECT id FROM rescued);
+'''
+
+# Удаление пачки блоков сборщиком мусора одним запросом, без ORM и сигналов: связи, права, история
+# и сами блоки, с надгробием deleted для каждого бывшего родителя (как add_deleted_tombstones).
+# Строки BlockPath удаляются до этого, см. hierarchy.drop_block_paths.
+# Возвращает число блоков, число строк всего и id уцелевших детей, которые потеряли родителя.
+delete_orphan_blocks_query = '''
+WITH edges AS (DELETE
+               FROM api_block_children bc
+               WHERE bc.from_block_id = ANY (%(block_ids)s::bigint[])
+                  OR bc.to_block_id = ANY (%(block_ids)s::bigint[])
+               RETURNING bc.from_block_id, bc.to_block_id),
+     tombstones AS (INSERT INTO api_blocktombstone (seq, xid, kind, block_id, parent_id)
+                    SELECT nextval('api_block_change_seq'), pg_current_xact_id()::text::bigint, 'deleted', b.id,
+                           e.from_block_id
+                    FROM unnest(%(block_ids)s::bigint[]) AS b(id)
+                             LEFT JOIN edges e ON e.to_block_id = b.id),
+     visible AS (DELETE FROM api_block_visible_to_users WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     editable AS (DELETE FROM api_block_editable_by_users WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     group_visible AS (DELETE FROM api_group_visible_blocks WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     group_editable AS (DELETE FROM api_group_editable_blocks WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     access AS (DELETE FROM api_blockaccess WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     changes AS (DELETE FROM api_blockchangelog WHERE block_id = ANY (%(block_ids)s::bigint[]) RETURNING 1),
+     profiles AS (UPDATE api_profile SET root_block_id = NULL WHERE root_block_id = ANY (%(block_ids)s::bigint[])),
+     blocks AS (DELETE FROM api_block WHERE id = ANY (%(block_ids)s::bigint[]) RETURNING 1)
+SELECT (SELECT count(*) FROM blocks),
+       (SELECT count(*) FROM blocks) + (SELECT count(*) FROM edges) + (SELECT count(*) FROM visible)
+           + (SELECT count(*) FROM editable) + (SELECT count(*) FROM group_visible)
+           + (SELECT count(*) FROM group_editable) + (SELECT count(*) FROM access) + (SELECT count(*) FROM changes),
+       ARRAY(SELECT DISTINCT e.to_block_id
+             FROM edges e
+             WHERE e.to_block_id <> ALL (%(block_ids)s::bigint[]));
+'''
+
+# Примерный объём строк блоков, их путей, прав и связей (без индексов)
+block_rows_size_query = '''
+SELECT (SELECT COALESCE(sum(pg_column_size(b.*)), 0)
+        FROM api_block b
+        WHERE b.id = ANY (%(block_ids)s::bigint[]))
+           + (SELECT COALESCE(sum(pg_column_size(bp.*)), 0)
+              FROM api_blockpath bp
+              WHERE bp.ancestor_id = ANY (%(block_ids)s::bigint[])
+                 OR bp.descendant_id = ANY (%(block_ids)s::bigint[]))
+           + (SELECT COALESCE(sum(pg_column_size(ba.*)), 0)
+              FROM api_blockaccess ba
+              WHERE ba.block_id = ANY (%(block_ids)s::bigint[]))
+           + (SELECT COALESCE(sum(pg_column_size(bc.*)), 0)
+              FROM api_block_children bc
+              WHERE bc.from_block_id = ANY (%(block_ids)s::bigint[])
+                 OR bc.to_block_id = ANY (%(block_ids)s::bigint[]));
+'''
+
+# Есть ли путь ancestor_id -> block_id (или это один блок). Пути длиннее BLOCK_PATH_MAX_DEPTH проходятся
+# прыжками по строкам BlockPath ровно максимальной длины, так что запрос не зависит от глубины иерархии.
+is_block_ancestor_query = '''
+WITH RECURSIVE frontier(id) AS (SELECT %(block_id)s::bigint
+                                UNION
+                                SELECT bp.ancestor_id
+                                FROM frontier f
+                                         JOIN api_blockpath bp ON bp.descendant_id = f.id AND bp.depth = %(max_depth)s)
+SELECT EXISTS (SELECT 1
+               FROM frontier f
+                        JOIN api_blockpath bp ON bp.descendant_id = f.id
+               WHERE bp.ancestor_id = %(ancestor_id)s);
+'''
+
+# Корни иерархий, в которых лежат block_ids (предки без родителей, включая сами блоки). Предки дальше
+# BLOCK_PATH_MAX_DEPTH находятся прыжками по путям максимальной длины, как в is_block_ancestor_query
+block_roots_query = '''
+WITH RECURSIVE frontier(id) AS (SELECT unnest(%(block_ids)s::bigint[])
+                                UNION
+                                SELECT bp.ancestor_id
+                                FROM frontier f
+                                         JOIN api_blockpath bp ON bp.descendant_id = f.id AND bp.depth = %(max_depth)s)
+SELECT DISTINCT bp.ancestor_id
+FROM frontier f
+         JOIN api_blockpath bp ON bp.descendant_id = f.id
+WHERE NOT EXISTS (SELECT 1
+                  FROM api_block_children bc
+                  WHERE bc.to_block_id = bp.ancestor_id)
+ORDER BY bp.ancestor_id;
+'''
+
+# Блокировки до конца транзакции, по одной на корень, в порядке id (чтобы не было взаимных блокировок)
+lock_block_roots_query = '''
+SELECT pg_advisory_xact_lock(hashtextextended('api_block_root', r.id))
+FROM (SELECT unnest(%(root_ids)s::bigint[]) AS id ORDER BY 1) r;
+'''
+
+# Отозванное для проверки JWT без запроса к базе (api/authentication.py): выключенные пользователи
+# и jti занесённых в blacklist токенов, которые ещё не истекли
+# Выключенные пользователи и удалённые, чьи токены ещё могут быть действительны
+revoked_users_query = '''
+SELECT id
+FROM auth_user
+WHERE NOT is_active
+UNION
+SELECT user_id
+FROM api_deleteduser
+WHERE deleted_at > now() - %(token_lifetime)s * interval '1 second';
+'''
+
+prune_deleted_users_query = '''
+DELETE
+FROM api_deleteduser
+WHERE deleted_at <= now() - %(token_lifetime)s * interval '1 second';
+'''
+
+add_deleted_user_query = '''
+INSERT INTO api_deleteduser (user_id, deleted_at)
+VALUES (%(user_id)s, now())
+ON CONFLICT (user_id) DO UPDATE SET deleted_at = excluded.deleted_at;
+'''
+
+root_block_query = '''
+SELECT root_block_id
+FROM api_profile
+WHERE user_id = %(user_id)s;
+'''
+
+# Копирование, выгрузка и загрузка поддеревьев (api/transfer.py). Поддерево - блоки, достижимые от block_id
+# по api_block_children через видимые пользователю блоки, без ограничения глубины.
+_visible_subtree_cte = '''
+WITH RECURSIVE subtree(id) AS (SELECT %(block_id)s::bigint
+                               UNION
+                               SELECT bc.to_block_id
+                               FROM subtree s
+                                        JOIN api_block_children bc ON bc.from_block_id = s.id
+                                        JOIN api_block c ON c.id = bc.to_block_id
+                               WHERE c.access_type IN ('public', 'public_ed')
+                                  OR EXISTS (SELECT 1
+                                             FROM api_blockaccess ba
+                                             WHERE ba.block_id = c.id
+                                               AND ba.user_id = %(user_id)s))
+'''
+
+# Строки NDJSON-выгрузки: блок со списком детей внутри поддерева (в порядке добавления связи)
+export_subtree_query = _visible_subtree_cte + '''
+SELECT json_build_object('id', b.id,
+                         'children', ARRAY(SELECT bc.to_block_id
+                                           FROM api_block_children bc
+                                           WHERE bc.from_block_id = b.id
+                                             AND bc.to_block_id IN (SELECT id FROM subtree)
+                                           ORDER BY bc.id),
+                         'children_position', b.children_position,
+                         'access_type', b.access_type,
+                         'text', b.text,
+                         'content_classList', b."content_classList",
+                         'classList', b."classList",
+                         'layout', b.layout,
+                         'color', b.color,
+                         'properties', b.properties,
+                         'image', NULLIF(b.image, ''))::text
+FROM subtree s
+         JOIN api_block b ON b.id = s.id;
+'''
+
+# transfer_map(old_id, new_id): старые id копируемых блоков и выданные им новые
+clone_transfer_map_query = '''
+CREATE TEMP TABLE transfer_map ON COMMIT DROP AS
+''' + _visible_subtree_cte + '''
+SELECT id AS old_id, nextval(pg_get_serial_sequence('api_block', 'id')) AS new_id
+FROM subtree;
+CREATE UNIQUE INDEX ON transfer_map (old_id);
+ANALYZE transfer_map;
+'''
+
+
+def _remap_children_position(source):
+    """Выражение: children_position из source с ключами-id детей, заменёнными по transfer_map."""
+    return '''CASE
+           WHEN jsonb_typeof(''' + source + ''') = 'object' THEN
+               COALESCE((SELECT jsonb_object_agg(COALESCE(cm.new_id::text, kv.key), kv.value)
+                                    FILTER (WHERE cm.new_id IS NOT NULL OR kv.key !~ '^[0-9]+$')
+                         FROM jsonb_each(''' + source + ''') kv
+                                  LEFT JOIN transfer_map cm
+                                            ON cm.old_id = CASE WHEN kv.key ~ '^[0-9]{1,18}$' THEN kv.key::bigint END),
+                        '{}'::jsonb)
+           ELSE ''' + source + '''
+           END'''
+
+
+clone_blocks_query = '''
+INSERT INTO api_block (id, creator_id, access_type, children_position, text, "content_classList", image,
+                       "classList", layout, color, created_at, updated_at, properties, revision, change_seq)
+SELECT m.new_id,
+       %(user_id)s,
+       b.access_type,
+       ''' + _remap_children_position('b.children_position') + ''',
+       b.text,
+       b."content_classList",
+       b.image,
+       b."classList",
+       b.layout,
+       b.color,
+       now(),
+       now(),
+       b.properties,
+       0,
+       0
+FROM transfer_map m
+         JOIN api_block b ON b.id = m.old_id;
+'''
+
+clone_children_query = '''
+INSERT INTO api_block_children (from_block_id, to_block_id)
+SELECT mf.new_id, mt.new_id
+FROM api_block_children bc
+         JOIN transfer_map mf ON mf.old_id = bc.from_block_id
+         JOIN transfer_map mt ON mt.old_id = bc.to_block_id
+ORDER BY bc.id;
+'''
+
+# Загрузка NDJSON: строки файла копируются COPY во временную таблицу, дальше всё делается запросами
+import_table_query = '''
+CREATE TEMP TABLE transfer_import
+(
+    line bigserial PRIMARY KEY,
+    data jsonb NOT NULL
+) ON COMMIT DROP;
+'''
+
+import_copy_query = 'COPY transfer_import (data) FROM STDIN'
+
+import_invalid_lines_query = '''
+SELECT line
+FROM transfer_import
+WHERE jsonb_typeof(data) <> 'object'
+   OR NOT (data ->> 'id') ~ '^[0-9]{1,18}$'
+   OR jsonb_typeof(COALESCE(data -> 'children', '[]')) <> 'array'
+ORDER BY line
+LIMIT 1;
+'''
+
+# Уникальный индекс по old_id отклоняет файлы с повторяющимися id
+import_ids_query = '''
+CREATE TEMP TABLE transfer_ids ON COMMIT DROP AS
+SELECT (data ->> 'id')::bigint AS old_id, line
+FROM transfer_import;
+CREATE UNIQUE INDEX ON transfer_ids (old_id);
+'''
+
+# Связи между блоками файла; ссылки на id, которых нет в файле, отбрасываются
+import_edges_query = '''
+CREATE TEMP TABLE transfer_edges ON COMMIT DROP AS
+SELECT (i.data ->> 'id')::bigint AS from_id, t.old_id AS to_id, i.line, c.ord
+FROM transfer_import i
+         CROSS JOIN LATERAL jsonb_array_elements_text(COALESCE(i.data -> 'children', '[]')) WITH ORDINALITY AS c(id, ord)
+         JOIN transfer_ids t ON t.old_id = CASE WHEN c.id ~ '^[0-9]{1,18}$' THEN c.id::bigint END;
+CREATE INDEX ON transfer_edges (from_id);
+CREATE INDEX ON transfer_edges (to_id);
+ANALYZE transfer_edges;
+'''
+
+# Загружаются только блоки, достижимые от корня файла
+import_transfer_map_query = '''
+CREATE TEMP TABLE transfer_map ON COMMIT DROP AS
+WITH RECURSIVE reachable(id) AS (SELECT %(root_id)s::bigint
+                                 UNION
+                                 SELECT e.to_id
+                                 FROM reachable r
+                                          JOIN transfer_edges e ON e.from_id = r.id)
+SELECT t.old_id, t.line, nextval(pg_get_serial_sequence('api_block', 'id')) AS new_id
+FROM reachable r
+         JOIN transfer_ids t ON t.old_id = r.id;
+CREATE UNIQUE INDEX ON transfer_map (old_id);
+ANALYZE transfer_map;
+'''
+
+# Поиск циклов в загружаемом графе: вершины без входящих рёбер снимаются слоями, пока это возможно,
+# в transfer_pending остаются вершины циклов (и их потомки). Число проходов равно высоте графа.
+import_peel_graph_query = '''
+CREATE TEMP TABLE transfer_pending ON COMMIT DROP AS
+SELECT old_id AS id
+FROM transfer_map;
+CREATE UNIQUE INDEX ON transfer_pending (id);
+DO
+$$
+    BEGIN
+        LOOP
+            DELETE
+            FROM transfer_pending p
+            WHERE NOT EXISTS (SELECT 1
+                              FROM transfer_edges e
+                                       JOIN transfer_pending q ON q.id = e.from_id
+                              WHERE e.to_id = p.id);
+            EXIT WHEN NOT FOUND;
+        END LOOP;
+    END
+$$;
+'''
+
+import_cycle_blocks_query = '''
+SELECT count(*)
+FROM transfer_pending;
+'''
+
+import_blocks_query = '''
+INSERT INTO api_block (id, creator_id, access_type, children_position, text, "content_classList", image,
+                       "classList", layout, color, created_at, updated_at, properties, revision, change_seq)
+SELECT m.new_id,
+       %(user_id)s,
+       CASE WHEN i.data ->> 'access_type' = ANY (%(access_types)s) THEN i.data ->> 'access_type' ELSE 'inherited' END,
+       ''' + _remap_children_position("i.data -> 'children_position'") + ''',
+       COALESCE(i.data ->> 'text', ''),
+       COALESCE(i.data -> 'content_classList', %(content_class_list)s::jsonb),
+       -- Картинки ссылаются на уже загруженные оригиналы по хэшу (api/images.py)
+       CASE WHEN i.data ->> 'image' ~ '^images/originals/[0-9a-f]{2}/[0-9a-f]{64}(\\.[a-z0-9]+)?$' THEN i.data ->> 'image' END,
+       COALESCE(i.data -> 'classList', %(class_list)s::jsonb),
+       CASE WHEN i.data ->> 'layout' = ANY (%(layouts)s) THEN i.data ->> 'layout' ELSE 'default' END,
+       left(i.data ->> 'color', 20),
+       COALESCE(i.data -> 'properties', '{}'::jsonb),
+       now(),
+       now(),
+       0,
+       0
+FROM transfer_map m
+         JOIN transfer_import i ON i.line = m.line;
+'''
+
+import_children_query = '''
+INSERT INTO api_block_children (from_block_id, to_block_id)
+SELECT mf.new_id, mt.new_id
+FROM transfer_edges e
+         JOIN transfer_map mf ON mf.old_id = e.from_id
+         JOIN transfer_map mt ON mt.old_id = e.to_id
+ORDER BY e.line, e.ord
+ON CONFLICT DO NOTHING;
+'''
+
+# Общие шаги копирования и загрузки: права создателя, пути BlockPath внутри нового поддерева
+transfer_grants_query = '''
+INSERT INTO api_block_visible_to_users (block_id, user_id)
+SELECT new_id, %(user_id)s
+FROM transfer_map;
+INSERT INTO api_block_editable_by_users (block_id, user_id)
+SELECT new_id, %(user_id)s
+FROM transfer_map;
+'''
+
+transfer_self_paths_query = '''
+INSERT INTO api_blockpath (ancestor_id, descendant_id, depth, paths)
+SELECT new_id, new_id, 0, 1
+FROM transfer_map;
+'''
+
+# Строки BlockPath длины depth внутри нового поддерева из строк длины depth - 1, по уровню за запрос:
+# число путей складывается по последнему ребру, без перебора самих путей
+transfer_paths_query = '''
+INSERT INTO api_blockpath (ancestor_id, descendant_id, depth, paths)
+SELECT bp.ancestor_id, bc.to_block_id, %(depth)s, sum(bp.paths)
+FROM transfer_map m
+         JOIN api_blockpath bp ON bp.ancestor_id = m.new_id AND bp.depth = %(depth)s - 1
+         JOIN api_block_children bc ON bc.from_block_id = bp.descendant_id
+GROUP BY bp.ancestor_id, bc.to_block_id;
+'''
+
+# Новые блоки с собственными правами (не inherited), кроме корня: права корня и его inherited-потомков
+# пересчитываются при привязке к родителю
+transfer_own_access_query = '''
+SELECT m.new_id
+FROM transfer_map m
+         JOIN api_block b ON b.id = m.new_id
+WHERE b.access_type <> 'inherited'
+  AND m.new_id <> %(root_id)s;
+'''
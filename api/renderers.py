@@ -0,0 +1,28 @@
+import orjson
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ORJSONRenderer(BaseRenderer):
+    """
+    JSONRenderer на orjson. Типы, которые orjson не знает (Decimal, ленивые строки, QuerySet ...),
+    кодируются так же, как в DRF.
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return orjson.dumps(data, default=JSONEncoder().default, option=self.options)
+
+
+class ColumnarTreeRenderer(ORJSONRenderer):
+    """
+    Столбцовый формат дерева (см. columnar_tree_query). Документ с деревом вью отдают готовыми байтами,
+    рендерер нужен для content negotiation, остальные ответы (ошибки) - обычный JSON.
+    """
+    media_type = 'application/vnd.blocks.columnar+json'
+    format = 'columnar'
@@ -1,14 +1,34 @@
 from rest_framework import serializers, status
+from rest_framework.exceptions import PermissionDenied
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+
+from .access import refresh_block_access
+from .cache import invalidate_trees
+from .changelog import capture_changes, record_change
+from .events import publish_block_events
+from .hierarchy import add_block_paths, check_new_edges, insert_children, delete_children, bump_block_revisions
+from .permissions import BlockPermissions
+from .profiles import add_root_block_claim
 from .models import (
     Block,
     BlockChangeLog,
     Group,
     LAYOUT_CHOICES,
-    ACCESS_TYPE_CHOICES
+    ACCESS_TYPE_CHOICES,
+    BLOCK_PATH_MAX_DEPTH,
+    DEFAULT_TREE_DEPTH
 )
 
+MAX_EXPAND_BLOCKS = 500
+MAX_BATCH_OPERATIONS = 1000
+MAX_SEARCH_QUERY_LENGTH = 200
+MAX_SEARCH_LIMIT = 100
+DEFAULT_SEARCH_LIMIT = 20
+
 
 def default_content_class_list():
     return ['grid-row_1', 'grid-column_1-M1']
@@ -18,6 +38,12 @@ def default_class_list():
     return ['grid-template-columns_1fr', 'grid-template-rows_1fr', ]
 
 
+class RootBlockTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_root_block_claim(super().get_token(user), user)
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
 
@@ -73,15 +99,29 @@ class BlockSerializer(serializers.ModelSerializer):
     def validate_color(self, value):
         return value if value else ''
 
+    def validate_children(self, value):
+        # Новым ребёнком можно сделать только видимый пользователю блок: иначе inherited-блок
+        # получил бы права родителя, и пользователь увидел бы чужое поддерево.
+        # context['permissions'] - BlockPermissions пользователя, который меняет блок
+        current_ids = set(self.instance.children.values_list('id', flat=True)) if self.instance else set()
+        added_ids = {block.pk for block in value} - current_ids
+        if added_ids:
+            permissions = self.context.get('permissions')
+            if permissions is None or added_ids - permissions.viewable(added_ids):
+                raise PermissionDenied('You do not have permission to view the added children.')
+        return value
+
     class Meta:
         model = Block
-        fields = '__all__'
+        exclude = ('search_vector',)
+        read_only_fields = ('revision', 'change_seq')
 
 
 class BlockCreateSerializer:
 
-    def __init__(self, data, user):
+    def __init__(self, data, user, permissions=None):
         self.status = None
+        self.permissions = permissions or BlockPermissions(user.id)
         self.parent = None
         self.errors = {}
         self.data = data
@@ -98,9 +138,7 @@ class BlockCreateSerializer:
             self.errors['not_found'] = 'Parent block not found'
             self.errors['parent'] = 'Parent block not found'
 
-        if (parent_block is not None and
-                self.user not in parent_block.editable_by_users.all() and
-                parent_block.access_type != 'public_editable'):
+        if parent_block is not None and not self.permissions.can_edit(parent_block.pk):
             self.errors['access'] = "You do not have permission to edit this block."
             self.status = status.HTTP_403_FORBIDDEN
 
@@ -119,7 +157,7 @@ class BlockCreateSerializer:
         return True
 
     def save(self):
-        child = Block.objects.create(creator=self.user.id,
+        child = Block.objects.create(creator_id=self.user.id,
                                      classList=default_class_list(),
                                      content_classList=default_content_class_list())
         child.save()
@@ -130,6 +168,221 @@ class BlockCreateSerializer:
         return self.parent, child
 
 
+class BlockBatchDataSerializer(serializers.ModelSerializer):
+    """Поля блока для пакетных операций. Связи здесь не принимаются, для них есть link / unlink."""
+    children_position = serializers.JSONField(default=dict)
+    text = serializers.CharField(allow_blank=True, required=False)
+    content_classList = serializers.JSONField(default=default_content_class_list)
+    classList = serializers.JSONField(default=default_class_list)
+    layout = serializers.ChoiceField(choices=LAYOUT_CHOICES, default='default')
+    access_type = serializers.ChoiceField(choices=ACCESS_TYPE_CHOICES, default='inherited')
+    color = serializers.CharField(allow_blank=True, default='default_color', required=False)
+    properties = serializers.JSONField(default=dict)
+
+    def validate_color(self, value):
+        return value if value else ''
+
+    class Meta:
+        model = Block
+        fields = ('text', 'content_classList', 'classList', 'children_position', 'layout', 'access_type', 'color',
+                  'properties')
+
+
+class BlockBatchSerializer:
+    """
+    Пакет операций над блоками:
+        {"op": "create", "ref": "new-1", "data": {...}}
+        {"op": "patch", "id": 12, "data": {...}}
+        {"op": "link", "parent": 12, "child": "new-1"}
+        {"op": "unlink", "parent": 12, "child": 34}
+    На блоки, создаваемые в этом же пакете, можно ссылаться по ref.
+    Все операции проверяются заранее (по запросу на блоки и на права) и применяются в одной
+    транзакции в порядке create, patch, unlink, link. Связь, которая замкнула бы цикл, откатывает
+    весь пакет (BlockCycleError).
+    """
+
+    def __init__(self, data, user, permissions=None):
+        self.status = None
+        self.errors = {}
+        self.data = data
+        self.user = user
+        self.permissions = permissions or BlockPermissions(user.id)
+        self._creates = []  # (index, ref, validated_data)
+        self._patches = []  # (index, block_id, validated_data)
+        self._links = []  # (index, parent, child)
+        self._unlinks = []
+        self._blocks = {}
+        self._ref_ids = {}
+
+    def is_valid(self):
+        operations = self.data.get('operations') if isinstance(self.data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            self.errors['operations'] = 'A non-empty list of operations is required.'
+        elif len(operations) > MAX_BATCH_OPERATIONS:
+            self.errors['operations'] = f'No more than {MAX_BATCH_OPERATIONS} operations per batch.'
+        else:
+            refs = set()
+            for index, operation in enumerate(operations):
+                error = self._parse_operation(index, operation, refs)
+                if error:
+                    self.errors[index] = error
+
+        if not self.errors:
+            self._check_blocks()
+
+        if self.errors:
+            self.status = self.status or status.HTTP_400_BAD_REQUEST
+            return False
+        return True
+
+    def save(self):
+        results = {}
+        with transaction.atomic(), capture_changes(self.user.id):
+            new_ids = self._apply_creates(results)
+            access_changed_ids, patched_ids = self._apply_patches(results)
+            unlinked = self._apply_edges(self._unlinks, 'unlink', results)
+            linked = self._apply_edges(self._links, 'link', results)
+
+            edges = unlinked + linked
+            child_ids = {child_id for _, child_id in edges}
+            access_refreshed_ids = refresh_block_access(set(new_ids) | access_changed_ids | child_ids)
+            bump_block_revisions(access_refreshed_ids | {parent_id for parent_id, _ in edges})
+            invalidate_trees(access_refreshed_ids | patched_ids | {block_id for edge in edges for block_id in edge})
+            publish_block_events(
+                [(block_id, {'type': 'created', 'block_id': block_id}) for block_id in new_ids] +
+                [(block_id, {'type': 'updated', 'block_id': block_id}) for block_id in patched_ids] +
+                [(parent_id, {'type': 'unlinked', 'parent_id': parent_id, 'child_id': child_id})
+                 for parent_id, child_id in unlinked] +
+                [(parent_id, {'type': 'linked', 'parent_id': parent_id, 'child_id': child_id})
+                 for parent_id, child_id in linked] +
+                [(block_id, {'type': 'access', 'block_id': block_id}) for block_id in access_refreshed_ids])
+        return [results[index] for index in sorted(results)]
+
+    def _parse_operation(self, index, operation, refs):
+        if not isinstance(operation, dict):
+            return 'Operation must be an object.'
+        op = operation.get('op')
+        if op in ('create', 'patch'):
+            data_serializer = BlockBatchDataSerializer(data=operation.get('data') or {}, partial=op == 'patch')
+            if not data_serializer.is_valid():
+                return data_serializer.errors
+            if op == 'create':
+                ref = operation.get('ref')
+                if not isinstance(ref, str) or not ref or ref in refs:
+                    return 'Create operation requires a unique string ref.'
+                refs.add(ref)
+                self._creates.append((index, ref, data_serializer.validated_data))
+            else:
+                if not isinstance(operation.get('id'), int):
+                    return 'Patch operation requires an integer id.'
+                self._patches.append((index, operation['id'], data_serializer.validated_data))
+        elif op in ('link', 'unlink'):
+            parent, child = operation.get('parent'), operation.get('child')
+            for value in (parent, child):
+                if not isinstance(value, int) and value not in refs:
+                    return f'Unknown block reference {value!r}.'
+            (self._links if op == 'link' else self._unlinks).append((index, parent, child))
+        else:
+            return 'op must be one of create, patch, link, unlink.'
+        return None
+
+    def _check_blocks(self):
+        edit_ids = {block_id for _, block_id, _ in self._patches}
+        view_ids = set()
+        for _, parent, child in self._links + self._unlinks:
+            if isinstance(parent, int):
+                edit_ids.add(parent)
+            if isinstance(child, int):
+                view_ids.add(child)
+
+        self._blocks = Block.objects.in_bulk(edit_ids | view_ids)
+        editable = self.permissions.editable(edit_ids)
+        viewable = self.permissions.viewable(view_ids)
+
+        for block_id in sorted(edit_ids | view_ids):
+            block = self._blocks.get(block_id)
+            if block is None:
+                self.errors[f'block_{block_id}'] = 'Block not found.'
+                self.status = status.HTTP_404_NOT_FOUND
+            elif block_id in edit_ids and block_id not in editable:
+                self.errors[f'block_{block_id}'] = 'You do not have permission to edit this block.'
+                self.status = self.status or status.HTTP_403_FORBIDDEN
+            elif block_id in view_ids and block_id not in viewable:
+                self.errors[f'block_{block_id}'] = 'You do not have permission to view this block.'
+                self.status = self.status or status.HTTP_403_FORBIDDEN
+
+    def _apply_creates(self, results):
+        blocks = [Block(creator_id=self.user.id, **data) for _, _, data in self._creates]
+        Block.objects.bulk_create(blocks)
+        new_ids = [block.pk for block in blocks]
+        for (index, ref, _), block in zip(self._creates, blocks):
+            self._ref_ids[ref] = block.pk
+            results[index] = {'op': 'create', 'ref': ref, 'id': block.pk}
+
+        # То, что для одиночного блока делает Block.save
+        add_block_paths(new_ids)
+        for through in (Block.visible_to_users.through, Block.editable_by_users.through):
+            through.objects.bulk_create([through(block_id=block_id, user_id=self.user.id) for block_id in new_ids])
+        return new_ids
+
+    def _apply_patches(self, results):
+        now = timezone.now()
+        fields = {'updated_at'}
+        access_changed_ids = set()
+        for index, block_id, data in self._patches:
+            block = self._blocks[block_id]
+            for name, value in data.items():
+                setattr(block, name, value)
+            block.updated_at = now
+            fields.update(data)
+            if block.field_changed('access_type'):
+                access_changed_ids.add(block_id)
+            results[index] = {'op': 'patch', 'id': block_id}
+
+        patched_ids = {block_id for _, block_id, _ in self._patches}
+        if patched_ids:
+            Block.objects.bulk_update([self._blocks[block_id] for block_id in patched_ids], fields)
+            for block_id in patched_ids:
+                record_change(self._blocks[block_id])
+        return access_changed_ids, patched_ids
+
+    def _apply_edges(self, operations, op, results):
+        # Порядок пар - порядок операций в запросе, повторы отбрасываются
+        edges = {}
+        for index, parent, child in operations:
+            edge = (self._ref_ids.get(parent, parent), self._ref_ids.get(child, child))
+            edges[edge] = None
+            results[index] = {'op': op, 'parent': edge[0], 'child': edge[1]}
+        # Дальше идут только реально добавленные / удалённые связи: надгробия и события для них
+        if op == 'unlink':
+            return delete_children(list(edges))
+        # Связи добавляются по одной: следующая проверяется на цикл с учётом уже добавленных
+        linked = []
+        for edge in edges:
+            check_new_edges([edge])
+            linked += insert_children([edge])
+        return linked
+
+
+class BlockMoveParentSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    children_position = serializers.JSONField(required=False)
+    classList = serializers.JSONField(required=False)
+
+
+class BlockMoveSerializer(serializers.Serializer):
+    """Перенос блока: родитель, из которого он убирается, и новый родитель с их обновлёнными раскладками."""
+    from_parent = BlockMoveParentSerializer()
+    to_parent = BlockMoveParentSerializer()
+
+
+class BlockCloneSerializer(serializers.Serializer):
+    """Куда положить копию: родитель, позиция копии в его children_position и, при необходимости, его classList."""
+    parent = serializers.IntegerField()
+    position = serializers.JSONField(required=False)
+    classList = serializers.JSONField(required=False)
+
+
 class ChangeLogSerializer(serializers.ModelSerializer):
     block = serializers.PrimaryKeyRelatedField(required=True, queryset=Block.objects.all())
     changed_by = UserSerializer(read_only=True)
@@ -138,3 +391,31 @@ class ChangeLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = BlockChangeLog
         fields = '__all__'
+
+
+class TreeParamsSerializer(serializers.Serializer):
+    depth = serializers.IntegerField(min_value=1, max_value=BLOCK_PATH_MAX_DEPTH + 1, default=DEFAULT_TREE_DEPTH)
+    max_children = serializers.IntegerField(min_value=1, required=False, allow_null=True, default=None)
+
+
+class ExpandBlocksSerializer(TreeParamsSerializer):
+    block_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False,
+                                      max_length=MAX_EXPAND_BLOCKS)
+
+
+class BlockChangesParamsSerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0)
+    depth = serializers.IntegerField(min_value=1, max_value=BLOCK_PATH_MAX_DEPTH + 1, default=DEFAULT_TREE_DEPTH)
+
+
+class BlockSearchParamsSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=MAX_SEARCH_QUERY_LENGTH)
+    limit = serializers.IntegerField(min_value=1, max_value=MAX_SEARCH_LIMIT, default=DEFAULT_SEARCH_LIMIT)
+    # Ключ последней полученной записи (rank, id) для следующей страницы
+    after_rank = serializers.FloatField(required=False, allow_null=True, default=None)
+    after_id = serializers.IntegerField(required=False, allow_null=True, default=None)
+
+    def validate(self, attrs):
+        if (attrs['after_rank'] is None) != (attrs['after_id'] is None):
+            raise serializers.ValidationError('after_rank and after_id must be passed together.')
+        return attrs
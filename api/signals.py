@@ -0,0 +1,168 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .access import group_block_ids, refresh_block_access
+from .authentication import revocations, user_cache
+from .cache import invalidate_trees
+from .changelog import record_change
+from .events import block_ancestors, has_block_subscribers, publish_block_events
+from .hierarchy import (check_new_edges,
+                        link_block_paths,
+                        unlink_block_paths,
+                        drop_block_paths,
+                        existing_edges,
+                        bump_block_revisions,
+                        add_deleted_tombstones)
+from .images import schedule_variants
+from .models import Block, Group
+
+
+def _refresh_access(block_ids):
+    changed_ids = refresh_block_access(block_ids)
+    bump_block_revisions(changed_ids)
+    invalidate_trees(changed_ids)
+    publish_block_events([(block_id, {'type': 'access', 'block_id': block_id}) for block_id in changed_ids])
+
+
+def _children_edges(instance, reverse, pk_set):
+    if reverse:
+        # instance - дочерний блок, pk_set - родители
+        return [(parent_id, instance.pk) for parent_id in pk_set]
+    return [(instance.pk, child_id) for child_id in pk_set]
+
+
+@receiver(post_save, sender=Block)
+def block_saved(sender, instance, created, **kwargs):
+    publish_block_events([(instance.pk, {'type': 'created' if created else 'updated', 'block_id': instance.pk})])
+    if instance.image and (created or instance.field_changed('image')):
+        schedule_variants(instance.image.name)
+    if created:
+        return
+    record_change(instance)
+    invalidate_trees([instance.pk])
+    if instance.field_changed('access_type'):
+        _refresh_access([instance.pk])
+
+
+@receiver(m2m_changed, sender=Block.children.through)
+def block_children_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_add':
+        # pk_set здесь - только связи, которых ещё нет
+        check_new_edges(_children_edges(instance, reverse, pk_set))
+        return
+    elif action == 'pre_remove':
+        # remove() передаёт и связи, которых не было: вычитать можно только пути через удаляемые
+        instance._removed_edges = existing_edges(_children_edges(instance, reverse, pk_set))
+        return
+    elif action == 'post_add':
+        link_block_paths(_children_edges(instance, reverse, pk_set))
+    elif action == 'post_remove':
+        unlink_block_paths(instance.__dict__.pop('_removed_edges', []))
+    elif action == 'pre_clear':
+        related = instance.parent_blocks if reverse else instance.children
+        instance._cleared_ids = set(related.values_list('id', flat=True))
+        unlink_block_paths(_children_edges(instance, reverse, instance._cleared_ids))
+        return
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_ids', set())
+    else:
+        return
+
+    invalidate_trees({instance.pk} | set(pk_set))
+    bump_block_revisions(pk_set if reverse else [instance.pk])
+    event_type = 'linked' if action == 'post_add' else 'unlinked'
+    publish_block_events([(parent_id, {'type': event_type, 'parent_id': parent_id, 'child_id': child_id})
+                          for parent_id, child_id in _children_edges(instance, reverse, pk_set)])
+    # Права наследуются от родителей, поэтому пересчитываются у дочерних блоков
+    _refresh_access([instance.pk] if reverse else pk_set)
+
+
+@receiver(m2m_changed, sender=Block.visible_to_users.through)
+@receiver(m2m_changed, sender=Block.editable_by_users.through)
+def block_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            _refresh_access([instance.pk])
+        return
+    # instance - пользователь, pk_set - блоки
+    if action in ('post_add', 'post_remove'):
+        _refresh_access(pk_set)
+    elif action == 'pre_clear':
+        instance._cleared_block_ids = set(sender.objects.filter(user_id=instance.pk).values_list('block_id', flat=True))
+    elif action == 'post_clear':
+        _refresh_access(instance.__dict__.pop('_cleared_block_ids', set()))
+
+
+@receiver(pre_delete, sender=Block)
+def block_deleting(sender, instance, **kwargs):
+    # Предков нужно найти до того, как пути удалённого блока исчезнут
+    if has_block_subscribers():
+        publish_block_events([(instance.pk, {'type': 'deleted', 'block_id': instance.pk})],
+                             ancestors=block_ancestors([instance.pk]))
+    drop_block_paths([instance.pk])
+    parent_ids = set(instance.parent_blocks.values_list('id', flat=True))
+    instance._child_ids = set(instance.children.values_list('id', flat=True))
+    invalidate_trees({instance.pk} | parent_ids)
+    bump_block_revisions(parent_ids)
+    add_deleted_tombstones(instance.pk, parent_ids)
+
+
+@receiver(post_delete, sender=Block)
+def block_deleted(sender, instance, **kwargs):
+    # Дети удалённого блока теряют унаследованные через него права
+    _refresh_access(instance.__dict__.pop('_child_ids', set()))
+
+
+@receiver(m2m_changed, sender=Group.visible_blocks.through)
+@receiver(m2m_changed, sender=Group.editable_blocks.through)
+def group_blocks_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance - блок, pk_set - группы
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            _refresh_access([instance.pk])
+        return
+    # instance - группа, pk_set - блоки
+    if action in ('post_add', 'post_remove'):
+        _refresh_access(pk_set)
+    elif action == 'pre_clear':
+        instance._cleared_block_ids = set(sender.objects.filter(group_id=instance.pk).values_list('block_id', flat=True))
+    elif action == 'post_clear':
+        _refresh_access(instance.__dict__.pop('_cleared_block_ids', set()))
+
+
+@receiver(m2m_changed, sender=Group.members.through)
+def group_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Состав группы меняет права на все её блоки
+    if action == 'pre_clear':
+        group_ids = (set(sender.objects.filter(user_id=instance.pk).values_list('group_id', flat=True))
+                     if reverse else {instance.pk})
+        instance._cleared_group_block_ids = group_block_ids(group_ids)
+    elif action == 'post_clear':
+        _refresh_access(instance.__dict__.pop('_cleared_group_block_ids', set()))
+    elif action in ('post_add', 'post_remove'):
+        _refresh_access(group_block_ids(pk_set if reverse else [instance.pk]))
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    instance._group_block_ids = group_block_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    # Связи группы удаляются каскадом без m2m_changed
+    _refresh_access(instance.__dict__.pop('_group_block_ids', set()))
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, created, **kwargs):
+    user_cache.discard(instance.pk)
+    if not instance.is_active:
+        revocations.revoke_user(instance.pk)
+
+
+@receiver(post_delete, sender=get_user_model())
+def user_deleted(sender, instance, **kwargs):
+    user_cache.discard(instance.pk)
+    revocations.revoke_user(instance.pk, deleted=True)
@@ -1,3 +1,402 @@
-from django.test import TestCase
+import json
+from collections import Counter
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Max
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from .access import refresh_block_access
+from .hierarchy import BlockCycleError
+from .models import Block, BlockAccess, BlockPath, Group, BLOCK_PATH_MAX_DEPTH
+from .permissions import BlockPermissions
+from .views import CHANGE_VERSION_HEADER, NDJSON_CONTENT_TYPE
+
+User = get_user_model()
+
+
+def make_block(creator, **fields):
+    return Block.objects.create(creator=creator, **fields)
+
+
+def access_of(block):
+    """{user_id: can_edit} из api_blockaccess."""
+    return dict(BlockAccess.objects.filter(block=block).values_list('user_id', 'can_edit'))
+
+
+class BlockPathTests(TestCase):
+    """Строки BlockPath (user-001) совпадают с пересчётом путей по api_block_children."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.a, self.b, self.c, self.d, self.e = [make_block(self.user, text=name) for name in 'abcde']
+
+    def expected_paths(self):
+        edges = {}
+        for parent_id, child_id in Block.children.through.objects.values_list('from_block_id', 'to_block_id'):
+            edges.setdefault(parent_id, []).append(child_id)
+        counts = Counter()
+
+        def walk(ancestor_id, block_id, path):
+            counts[(ancestor_id, block_id, len(path) - 1)] += 1
+            if len(path) > BLOCK_PATH_MAX_DEPTH:
+                return
+            for child_id in edges.get(block_id, ()):
+                if child_id not in path:
+                    walk(ancestor_id, child_id, path + [child_id])
+
+        for block_id in Block.objects.filter(creator=self.user).values_list('id', flat=True):
+            walk(block_id, block_id, [block_id])
+        return dict(counts)
+
+    def stored_paths(self):
+        return {(ancestor_id, descendant_id, depth): paths
+                for ancestor_id, descendant_id, depth, paths
+                in BlockPath.objects.filter(ancestor__creator=self.user)
+                .values_list('ancestor_id', 'descendant_id', 'depth', 'paths')}
+
+    def assertPathsConsistent(self):
+        self.assertEqual(self.stored_paths(), self.expected_paths())
+
+    def test_diamond_counts_paths(self):
+        self.a.children.add(self.b, self.c)
+        self.b.children.add(self.d)
+        self.c.children.add(self.d)
+        self.d.children.add(self.e)
+        self.assertEqual(self.stored_paths()[(self.a.pk, self.e.pk, 3)], 2)
+        self.assertPathsConsistent()
+
+    def test_unlink_subtracts_paths(self):
+        self.a.children.add(self.b, self.c)
+        self.b.children.add(self.d)
+        self.c.children.add(self.d)
+        self.c.children.remove(self.d)
+        self.assertEqual(self.stored_paths()[(self.a.pk, self.d.pk, 2)], 1)
+        self.b.children.remove(self.d)
+        self.assertNotIn((self.a.pk, self.d.pk, 2), self.stored_paths())
+        self.assertPathsConsistent()
+
+    def test_remove_ignores_missing_edges(self):
+        self.a.children.add(self.b)
+        self.b.children.add(self.c)
+        # a -> c нет: remove не должен вычитать пути a -> b -> c
+        self.a.children.remove(self.c)
+        self.d.parent_blocks.remove(self.a)
+        self.assertPathsConsistent()
+
+    def test_clear_and_reverse_add(self):
+        self.a.children.add(self.b, self.c)
+        self.d.parent_blocks.add(self.b, self.c)
+        self.assertPathsConsistent()
+        self.a.children.clear()
+        self.assertPathsConsistent()
+
+    def test_delete_drops_paths_through_block(self):
+        self.a.children.add(self.b, self.c)
+        self.b.children.add(self.d)
+        self.c.children.add(self.d)
+        self.d.children.add(self.e)
+        self.b.delete()
+        self.assertEqual(self.stored_paths()[(self.a.pk, self.e.pk, 3)], 1)
+        Block.objects.filter(pk__in=[self.c.pk, self.d.pk]).delete()
+        self.assertFalse(BlockPath.objects.filter(ancestor=self.a, depth__gt=0).exists())
+        self.assertPathsConsistent()
+
+    def test_paths_are_capped_by_max_depth(self):
+        chain = [make_block(self.user) for _ in range(BLOCK_PATH_MAX_DEPTH + 3)]
+        for parent, child in zip(chain, chain[1:]):
+            parent.children.add(child)
+        depths = BlockPath.objects.filter(ancestor=chain[0]).aggregate(Max('depth'))
+        self.assertEqual(depths['depth__max'], BLOCK_PATH_MAX_DEPTH)
+        self.assertPathsConsistent()
+
+
+class BlockAccessTests(TestCase):
+    """Права в api_blockaccess (user-005) пересчитываются сигналами."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.reader = User.objects.create_user('reader')
+        self.root = make_block(self.owner, access_type='private')
+        self.child = make_block(self.owner)
+        self.grandchild = make_block(self.owner)
+        self.root.children.add(self.child)
+        self.child.children.add(self.grandchild)
+
+    def test_creator_can_edit(self):
+        self.assertEqual(access_of(self.root), {self.owner.pk: True})
+
+    def test_inherited_blocks_get_parent_grants(self):
+        self.root.visible_to_users.add(self.reader)
+        self.assertEqual(access_of(self.grandchild), {self.owner.pk: True, self.reader.pk: False})
+        self.root.editable_by_users.add(self.reader)
+        self.assertTrue(access_of(self.grandchild)[self.reader.pk])
+        self.root.visible_to_users.remove(self.reader)
+        self.root.editable_by_users.remove(self.reader)
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+
+    def test_private_block_stops_inheritance(self):
+        self.root.visible_to_users.add(self.reader)
+        self.child.access_type = 'private'
+        self.child.save()
+        self.assertNotIn(self.reader.pk, access_of(self.child))
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+
+    def test_unlink_and_delete_revoke_inherited_grants(self):
+        other_root = make_block(self.owner, access_type='private')
+        other_root.visible_to_users.add(self.reader)
+        other_root.children.add(self.grandchild)
+        self.assertIn(self.reader.pk, access_of(self.grandchild))
+        other_root.children.remove(self.grandchild)
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+        other_root.children.add(self.grandchild)
+        other_root.delete()
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+
+    def test_group_grants_follow_members(self):
+        group = Group.objects.create(name='readers')
+        group.editable_blocks.add(self.root)
+        group.members.add(self.reader)
+        self.assertTrue(access_of(self.grandchild)[self.reader.pk])
+        group.members.remove(self.reader)
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+        self.reader.user_groups.add(group)
+        self.assertIn(self.reader.pk, access_of(self.grandchild))
+        group.delete()
+        self.assertNotIn(self.reader.pk, access_of(self.grandchild))
+
+    def test_group_clear_revokes_grants(self):
+        group = Group.objects.create(name='readers')
+        group.members.add(self.reader)
+        group.visible_blocks.add(self.root)
+        self.assertEqual(access_of(self.child)[self.reader.pk], False)
+        group.visible_blocks.clear()
+        self.assertNotIn(self.reader.pk, access_of(self.child))
+
+    def test_refresh_reports_changed_blocks(self):
+        self.assertEqual(refresh_block_access([self.root.pk]), set())
+        BlockAccess.objects.filter(block=self.grandchild).delete()
+        self.assertEqual(refresh_block_access([self.root.pk]), {self.grandchild.pk})
+
+
+class BlockPermissionsTests(TestCase):
+    """BlockPermissions (user-012): один запрос на набор блоков, ответы запоминаются."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        self.private = make_block(self.owner, access_type='private')
+        self.public = make_block(self.owner, access_type='public')
+        self.public_ed = make_block(self.owner, access_type='public_ed')
+        self.client = APIClient()
+        self.client.force_authenticate(self.other)
+
+    def test_access_types(self):
+        ids = [self.private.pk, self.public.pk, self.public_ed.pk, 0]
+        owner = BlockPermissions(self.owner.pk)
+        self.assertEqual(owner.viewable(ids), set(ids) - {0})
+        self.assertEqual(owner.editable(ids), set(ids) - {0})
+        other = BlockPermissions(self.other.pk)
+        self.assertEqual(other.viewable(ids), {self.public.pk, self.public_ed.pk})
+        self.assertEqual(other.editable(ids), {self.public_ed.pk})
+        anonymous = BlockPermissions(None)
+        self.assertEqual(anonymous.viewable(ids), {self.public.pk, self.public_ed.pk})
+
+    def test_answers_are_memoized(self):
+        permissions = BlockPermissions(self.other.pk)
+        with self.assertNumQueries(1):
+            permissions.viewable([self.private.pk, self.public.pk])
+            permissions.can_edit(self.private.pk)
+            permissions.can_view(self.public.pk)
+        with self.assertNumQueries(1):
+            permissions.can_view(self.public_ed.pk)
+
+    def test_patch_requires_edit_permission(self):
+        url = reverse('api:block-id', args=[self.public.pk])
+        response = self.client.patch(url, {'text': 'changed'}, format='json')
+        self.assertEqual(response.status_code, 403)
+        url = reverse('api:block-id', args=[self.public_ed.pk])
+        response = self.client.patch(url, {'text': 'changed'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_cannot_adopt_invisible_child(self):
+        url = reverse('api:block-id', args=[self.public_ed.pk])
+        response = self.client.patch(url, {'children': [self.private.pk]}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.public_ed.children.exists())
+        self.assertNotIn(self.other.pk, access_of(self.private))
+
+
+class BlockCycleTests(TestCase):
+    """Связи, замыкающие цикл, отклоняются (user-020)."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.root = make_block(self.owner, access_type='private')
+        self.a = make_block(self.owner)
+        self.b = make_block(self.owner)
+        self.root.children.add(self.a)
+        self.a.children.add(self.b)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_add_rejects_cycle(self):
+        for parent, child in ((self.b, self.a), (self.b, self.b), (self.b, self.root)):
+            with self.assertRaises(BlockCycleError), transaction.atomic():
+                parent.children.add(child)
+        with self.assertRaises(BlockCycleError), transaction.atomic():
+            self.root.parent_blocks.add(self.b)
+        self.assertFalse(self.b.children.exists())
+
+    def test_move_into_own_subtree(self):
+        url = reverse('api:block-move', args=[self.a.pk])
+        response = self.client.post(url, {'from_parent': {'id': self.root.pk}, 'to_parent': {'id': self.b.pk}},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(self.root.children.all()), [self.a])
+        self.assertFalse(self.b.children.exists())
+
+    def test_move(self):
+        target = make_block(self.owner)
+        self.root.children.add(target)
+        url = reverse('api:block-move', args=[self.b.pk])
+        response = self.client.post(url, {'from_parent': {'id': self.a.pk}, 'to_parent': {'id': target.pk}},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(target.children.all()), [self.b])
+        self.assertFalse(self.a.children.exists())
+        self.assertTrue(BlockPath.objects.filter(ancestor=self.root, descendant=self.b, depth=2).exists())
+
+    def test_batch_link_rejects_cycle(self):
+        url = reverse('api:block-batch')
+        response = self.client.post(url, {'operations': [{'op': 'link', 'parent': self.b.pk, 'child': self.root.pk}]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.b.children.exists())
+
+
+@override_settings(BLOCK_CHANGELOG={'BACKGROUND_FLUSH': False})
+class BlockChangesTests(TransactionTestCase):
+    """
+    Delta sync (user-008). Версия - граница по транзакциям, поэтому изменения делаются
+    в отдельных транзакциях, а не внутри одной транзакции TestCase.
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.root = make_block(self.owner, access_type='private')
+        self.kept, self.edited, self.removed, self.moved = [make_block(self.owner, text=name)
+                                                             for name in ('kept', 'edited', 'removed', 'moved')]
+        self.root.children.add(self.kept, self.edited, self.removed)
+        self.kept.children.add(self.moved)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def changes(self, since):
+        response = self.client.get(reverse('api:block-changes', args=[self.root.pk]), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_tree_version(self):
+        response = self.client.get(reverse('api:block-id', args=[self.root.pk]))
+        self.assertEqual(response.status_code, 200)
+        version = int(response[CHANGE_VERSION_HEADER])
+        self.assertEqual(self.changes(version)['changed'], {})
+
+        self.client.patch(reverse('api:block-id', args=[self.edited.pk]), {'text': 'edited again'}, format='json')
+        self.removed.delete()
+        self.client.post(reverse('api:block-move', args=[self.moved.pk]),
+                         {'from_parent': {'id': self.kept.pk}, 'to_parent': {'id': self.edited.pk}}, format='json')
+
+        data = self.changes(version)
+        self.assertEqual(set(data['changed']), {self.edited.pk, self.moved.pk})
+        self.assertEqual(data['changed'][self.edited.pk]['text'], 'edited again')
+        self.assertEqual(data['changed'][self.moved.pk]['paths'],
+                         [f'{self.root.pk},{self.edited.pk},{self.moved.pk}'])
+        self.assertEqual(data['deleted'], [self.removed.pk])
+        self.assertEqual(data['unlinked'], [{'parent': self.kept.pk, 'child': self.moved.pk}])
+
+        # С новой версией старые изменения не приходят
+        self.assertEqual(self.changes(data['version'])['changed'], {})
+
+    def test_requires_view_permission(self):
+        stranger = User.objects.create_user('stranger')
+        self.client.force_authenticate(stranger)
+        response = self.client.get(reverse('api:block-changes', args=[self.root.pk]), {'since': 0})
+        self.assertEqual(response.status_code, 403)
+
+
+class BlockTransferTests(TestCase):
+    """Копирование, выгрузка и загрузка поддерева (user-025). Одна операция на тест: временные таблицы живут до коммита."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.root = make_block(self.owner, access_type='private')
+        self.source = make_block(self.owner, text='source', properties={'kind': 'folder'})
+        self.left, self.right, self.shared = [make_block(self.owner, text=name) for name in ('left', 'right', 'shared')]
+        self.target = make_block(self.owner, text='target')
+        self.root.children.add(self.source, self.target)
+        self.source.children.add(self.left, self.right)
+        self.left.children.add(self.shared)
+        self.right.children.add(self.shared)
+        self.source.children_position = {str(self.left.pk): {'row': 1}, str(self.right.pk): {'row': 2}}
+        self.source.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def export(self, block_id):
+        response = self.client.get(reverse('api:block-export', args=[block_id]))
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+    def shape(self, block_id):
+        """Поддерево без id: блоки по text с детьми и children_position по text."""
+        header, blocks = self.export(block_id)
+        texts = {block['id']: block['text'] for block in blocks}
+        return {block['text']: (sorted(texts[child_id] for child_id in block['children']),
+                                {texts[int(key)]: value for key, value in (block['children_position'] or {}).items()},
+                                block['access_type'], block['properties'])
+                for block in blocks}
+
+    def assertCopied(self, new_root_id):
+        self.assertNotEqual(new_root_id, self.source.pk)
+        self.assertEqual(self.shape(new_root_id), self.shape(self.source.pk))
+        self.assertTrue(self.target.children.filter(pk=new_root_id).exists())
+        shared_copy = BlockPath.objects.get(ancestor_id=new_root_id, depth=2)
+        self.assertEqual(shared_copy.paths, 2)
+        self.assertNotEqual(shared_copy.descendant_id, self.shared.pk)
+        self.assertEqual(BlockPath.objects.filter(ancestor=self.root, descendant_id=shared_copy.descendant_id,
+                                                  depth=4).get().paths, 2)
+        self.assertTrue(access_of(Block.objects.get(pk=shared_copy.descendant_id))[self.owner.pk])
+
+    def test_export_import_round_trip(self):
+        header, blocks = self.export(self.source.pk)
+        self.assertEqual(header['root'], self.source.pk)
+        self.assertEqual(len(blocks), 4)
+        body = '\n'.join(json.dumps(line) for line in [header, *blocks]).encode()
+        response = self.client.post(reverse('api:block-import', args=[self.target.pk]), body,
+                                    content_type=NDJSON_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['blocks'], 4)
+        self.assertCopied(response.data['block_id'])
+
+    def test_clone(self):
+        response = self.client.post(reverse('api:block-clone', args=[self.source.pk]), {'parent': self.target.pk},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['blocks'], 4)
+        self.assertCopied(response.data['block_id'])
+
+    def test_import_rejects_cycle(self):
+        lines = [{'format': 'blocks', 'version': 1, 'root': 1},
+                 {'id': 1, 'children': [2]},
+                 {'id': 2, 'children': [1]}]
+        body = '\n'.join(json.dumps(line) for line in lines).encode()
+        blocks = Block.objects.count()
+        response = self.client.post(reverse('api:block-import', args=[self.target.pk]), body,
+                                    content_type=NDJSON_CONTENT_TYPE)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Block.objects.count(), blocks)
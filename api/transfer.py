@@ -0,0 +1,174 @@
+"""
+Копирование поддерева на сервере, выгрузка поддерева в NDJSON и загрузка из него.
+
+Копирование и загрузка работают над множествами, а не по блоку: новые id выдаются разом во временной
+таблице transfer_map (old_id, new_id), блоки, связи, пути BlockPath и права создателя вставляются
+через INSERT ... SELECT, ключи children_position переписываются по той же таблице. Сигналы
+отдельных блоков не срабатывают; к родителю новое поддерево привязывается обычным children.add.
+Обе операции вызываются внутри transaction.atomic() (временные таблицы живут до конца транзакции),
+не больше одной на транзакцию.
+
+Формат выгрузки: первая строка - заголовок {"format": "blocks", "version": 1, "root": id}, дальше
+по строке на блок: {"id", "children", "children_position", "access_type", "text", "content_classList",
+"classList", "layout", "color", "properties", "image"}. При загрузке строки блоков идут в базу
+через COPY; ссылки на блоки, которых нет в файле, отбрасываются, блоки, недостижимые от root,
+не загружаются, а файл с циклом в children отклоняется.
+"""
+import json
+
+import psycopg
+from django.db import IntegrityError, connection
+
+from .access import refresh_block_access
+from .models import (ACCESS_TYPE_CHOICES,
+                     BLOCK_PATH_MAX_DEPTH,
+                     LAYOUT_CHOICES,
+                     default_class_list,
+                     default_content_class_list)
+from .query import (export_subtree_query,
+                    clone_transfer_map_query,
+                    clone_blocks_query,
+                    clone_children_query,
+                    import_table_query,
+                    import_copy_query,
+                    import_invalid_lines_query,
+                    import_ids_query,
+                    import_edges_query,
+                    import_transfer_map_query,
+                    import_peel_graph_query,
+                    import_cycle_blocks_query,
+                    import_blocks_query,
+                    import_children_query,
+                    transfer_grants_query,
+                    transfer_self_paths_query,
+                    transfer_paths_query,
+                    transfer_own_access_query)
+
+EXPORT_FORMAT = 'blocks'
+EXPORT_VERSION = 1
+EXPORT_BATCH_SIZE = 1000
+MAX_IMPORT_BLOCKS = 1_000_000
+
+
+class BlockImportError(Exception):
+    pass
+
+
+def iter_subtree_export(user_id, block_id, batch_size=EXPORT_BATCH_SIZE):
+    """Выгрузка видимого пользователю поддерева block_id: строки NDJSON пачками по batch_size блоков."""
+    yield json.dumps({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'root': block_id}) + '\n'
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(export_subtree_query, {'user_id': user_id, 'block_id': block_id})
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield ''.join(row[0] + '\n' for row in rows)
+
+
+def clone_subtree(user_id, block_id, parent):
+    """
+    Копирует видимое пользователю поддерево block_id, копии принадлежат user_id.
+    Копия корня становится ребёнком parent. Возвращает (id копии корня, число скопированных блоков).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(clone_transfer_map_query, {'user_id': user_id, 'block_id': block_id})
+        cursor.execute('SELECT new_id FROM transfer_map WHERE old_id = %(block_id)s', {'block_id': block_id})
+        root_id = cursor.fetchone()[0]
+        cursor.execute(clone_blocks_query, {'user_id': user_id})
+        blocks = cursor.rowcount
+        cursor.execute(clone_children_query)
+        _add_transfer_paths_and_access(cursor, user_id, root_id)
+    parent.children.add(root_id)
+    return root_id, blocks
+
+
+def import_subtree(user_id, lines, parent):
+    """
+    Загружает выгрузку (lines - строки NDJSON в bytes), блоки принадлежат user_id, корень становится
+    ребёнком parent. Возвращает (id нового корня, число блоков). Ошибки в файле - BlockImportError.
+    """
+    lines = iter(lines)
+    root_id = _read_header(next(lines, b''))
+    with connection.cursor() as cursor:
+        cursor.execute(import_table_query)
+        _copy_lines(cursor, lines)
+
+        cursor.execute(import_invalid_lines_query)
+        row = cursor.fetchone()
+        if row is not None:
+            raise BlockImportError(f'Invalid block #{row[0]}: expected an object with an integer id '
+                                   f'and a list of children.')
+        try:
+            cursor.execute(import_ids_query)
+        except IntegrityError:
+            raise BlockImportError('Block ids must be unique.')
+        cursor.execute(import_edges_query)
+        cursor.execute(import_transfer_map_query, {'root_id': root_id})
+        cursor.execute('SELECT new_id FROM transfer_map WHERE old_id = %(root_id)s', {'root_id': root_id})
+        row = cursor.fetchone()
+        if row is None:
+            raise BlockImportError('Root block is missing.')
+        new_root_id = row[0]
+
+        cursor.execute(import_peel_graph_query)
+        cursor.execute(import_cycle_blocks_query)
+        if cursor.fetchone()[0]:
+            raise BlockImportError('Block children must not contain cycles.')
+
+        cursor.execute(import_blocks_query, {
+            'user_id': user_id,
+            'access_types': [value for value, _ in ACCESS_TYPE_CHOICES],
+            'layouts': [value for value, _ in LAYOUT_CHOICES],
+            'content_class_list': json.dumps(default_content_class_list()),
+            'class_list': json.dumps(default_class_list()),
+        })
+        blocks = cursor.rowcount
+        cursor.execute(import_children_query)
+        _add_transfer_paths_and_access(cursor, user_id, new_root_id)
+    parent.children.add(new_root_id)
+    return new_root_id, blocks
+
+
+def _read_header(line):
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if (not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT
+            or header.get('version') != EXPORT_VERSION or type(header.get('root')) is not int):
+        raise BlockImportError(f'The first line must be a header: '
+                               f'{{"format": "{EXPORT_FORMAT}", "version": {EXPORT_VERSION}, "root": <id>}}.')
+    return header['root']
+
+
+def _copy_lines(cursor, lines):
+    """Строки блоков в transfer_import через COPY (psycopg 3), с экранированием для текстового формата COPY."""
+    count = 0
+    try:
+        with cursor.copy(import_copy_query) as copy:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                count += 1
+                if count > MAX_IMPORT_BLOCKS:
+                    raise BlockImportError(f'At most {MAX_IMPORT_BLOCKS} blocks can be imported at once.')
+                copy.write(line.replace(b'\\', b'\\\\').replace(b'\t', b'\\t').replace(b'\r', b'\\r') + b'\n')
+    except psycopg.DataError as error:
+        # Строка не JSON или не UTF-8
+        raise BlockImportError(f'Invalid block data: {error}')
+    if not count:
+        raise BlockImportError('Root block is missing.')
+
+
+def _add_transfer_paths_and_access(cursor, user_id, root_id):
+    """Права создателя, пути BlockPath и api_blockaccess для блоков из transfer_map (кроме связи с родителем)."""
+    cursor.execute(transfer_grants_query, {'user_id': user_id})
+    cursor.execute(transfer_self_paths_query)
+    for depth in range(1, BLOCK_PATH_MAX_DEPTH + 1):
+        cursor.execute(transfer_paths_query, {'depth': depth})
+        if not cursor.rowcount:
+            break
+    cursor.execute(transfer_own_access_query, {'root_id': root_id})
+    refresh_block_access([row[0] for row in cursor.fetchall()])
@@ -1,5 +1,9 @@
 from django.urls import path
-from .views import RegisterView, BlockView, BlockChangeLogView, RootBlockView, DeleteBlockView
+
+from . import async_views
+from .views import RegisterView, BlockView, BlockChangeLogView, RootBlockView, DeleteBlockView, ExpandBlocksView, \
+    BlockBatchView, BlockChangesView, BlockSearchView, BlockMoveView, \
+    BlockCloneView, BlockExportView, BlockImportView, BlockEventsTicketView
 
 app_name = 'api'
 
@@ -8,6 +12,20 @@ urlpatterns = [
     path('root-block/', RootBlockView.as_view(), name='root-block'),
     path('remove-block/', DeleteBlockView.as_view(), name='remove-block'),
     path('block/<int:pk>/', BlockView.as_view(), name='block-id'),
+    path('block/expand/', ExpandBlocksView.as_view(), name='block-expand'),
+    path('block/batch/', BlockBatchView.as_view(), name='block-batch'),
+    path('block/search/', BlockSearchView.as_view(), name='block-search'),
+    path('block/<int:pk>/move/', BlockMoveView.as_view(), name='block-move'),
+    path('block/<int:pk>/clone/', BlockCloneView.as_view(), name='block-clone'),
+    path('block/<int:pk>/export/', BlockExportView.as_view(), name='block-export'),
+    path('block/<int:pk>/import/', BlockImportView.as_view(), name='block-import'),
+    path('block/<int:pk>/changes/', BlockChangesView.as_view(), name='block-changes'),
     path('block/changelog/<int:pk>/', BlockChangeLogView.as_view(), name='change-log'),
+    path('block/<int:pk>/events/ticket/', BlockEventsTicketView.as_view(), name='block-events-ticket'),
     path('register/', RegisterView.as_view(), name='register'),
+    # Асинхронное чтение для ASGI-деплоя
+    path('async/block/<int:pk>/', async_views.block_tree, name='async-block-id'),
+    path('async/root-block/', async_views.root_block_tree, name='async-root-block'),
+    path('async/block/changelog/<int:pk>/', async_views.block_changelog, name='async-change-log'),
+    path('async/block/<int:pk>/events/', async_views.block_events, name='async-block-events'),
 ]
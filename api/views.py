@@ -1,22 +1,52 @@
+import hashlib
 import json
 import logging
-from pprint import pprint
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import connection
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, quote_etag
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from .models import Block, BlockChangeLog
+from .cache import get_tree_cache
+from .changelog import capture_changes
+from .events import EVENTS_TICKET_MAX_AGE, make_events_ticket
+from .hierarchy import BlockCycleError
+from .models import Block, BlockChangeLog, Profile, DEFAULT_TREE_DEPTH
 from .serializers import (RegisterSerializer,
                           BlockSerializer,
                           ChangeLogSerializer,
                           UserSerializer,
-                          BlockCreateSerializer)
-from .query import get_blocks_query
+                          BlockCreateSerializer,
+                          BlockBatchSerializer,
+                          TreeParamsSerializer,
+                          BlockChangesParamsSerializer,
+                          ExpandBlocksSerializer,
+                          BlockSearchParamsSerializer,
+                          BlockMoveSerializer,
+                          BlockCloneSerializer)
+from .pagination import ChangeLogPagination
+from .permissions import get_block_permissions
+from .profiles import add_root_block_claim, get_root_block_id
+from .prepared import (blocks_statement,
+                       flat_map_json_statement,
+                       columnar_tree_statement,
+                       subtree_version_statement)
+from .renderers import ColumnarTreeRenderer
+from .transfer import BlockImportError, clone_subtree, import_subtree, iter_subtree_export
+from .query import (get_blocks_query,
+                    change_version_query,
+                    changed_blocks_query,
+                    block_tombstones_query,
+                    search_blocks_query)
 
 User = get_user_model()
 
@@ -24,6 +54,12 @@ logger = logging.getLogger(__name__)
 
 INFORM_BLOCK_ID = 2
 INFORM_BLOCK_USER_ID = 2
+STREAM_BATCH_SIZE = 500
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+CHANGE_VERSION_HEADER = 'X-Block-Version'
+# Вид документа с деревом -> запрос, который его собирает
+TREE_LAYOUT_STATEMENTS = {'json': flat_map_json_statement, 'columnar': columnar_tree_statement}
+TREE_RENDERER_CLASSES = [*api_settings.DEFAULT_RENDERER_CLASSES, ColumnarTreeRenderer]
 
 
 class RegisterView(APIView):
@@ -40,7 +76,8 @@ class RegisterView(APIView):
             block_serializer.is_valid()
             logger.info(block_serializer.errors)
             block = block_serializer.save()
-            refresh = RefreshToken.for_user(user)
+            Profile.objects.create(user=user, root_block=block)
+            refresh = add_root_block_claim(RefreshToken.for_user(user), user, block.id)
             return Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -52,15 +89,23 @@ class RegisterView(APIView):
 
 
 class RootBlockView(APIView):
+    renderer_classes = TREE_RENDERER_CLASSES
+
     def get(self, request):
         user = request.user
+        layout = tree_layout(request)
         if user.is_authenticated:
-            block_id = user.blocks.first().id
-            print(user.id, block_id)
-            data = get_flat_map_blocks(user.id, block_id)
-            return Response(data, status=status.HTTP_200_OK)
-        data = get_flat_map_blocks(INFORM_BLOCK_USER_ID, INFORM_BLOCK_ID)
-        return Response(data, status=status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
+            block_id = get_root_block_id(user)
+            if block_id is None:
+                return Response({'error': 'Root block not found.'}, status=status.HTTP_404_NOT_FOUND)
+            etag, last_modified, change_version = get_subtree_version(user.id, block_id, layout=layout)
+            if is_not_modified(request, etag):
+                return set_version_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified,
+                                           change_version)
+            response = tree_response(get_flat_map_json(user.id, block_id, layout=layout, etag=etag), layout)
+            return set_version_headers(response, etag, last_modified, change_version)
+        return tree_response(get_flat_map_json(INFORM_BLOCK_USER_ID, INFORM_BLOCK_ID, layout=layout), layout,
+                             status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
 
 
 class DeleteBlockView(APIView):
@@ -76,18 +121,23 @@ class DeleteBlockView(APIView):
             if not self._is_valid(request.data):
                 return Response(self.errors, status=status.HTTP_400_BAD_REQUEST)
 
+            permissions = get_block_permissions(request)
             block = Block.objects.get(pk=self.parent['id'])
-            if not self._check_user_permissions(user, block):
+            if not permissions.can_edit(block.pk):
                 return Response(
                     {"error": f"You do not have permission to update this block {self.parent['id']}"},
                     status=status.HTTP_403_FORBIDDEN)
 
-            is_updated_parent_or_err = self._update_parent(block, request)
+            try:
+                with transaction.atomic(), capture_changes(user.id):
+                    is_updated_parent_or_err = self._update_parent(block, request)
+            except BlockCycleError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
             if not isinstance(is_updated_parent_or_err, bool):
                 return Response(is_updated_parent_or_err, status=status.HTTP_400_BAD_REQUEST)
 
             child_block = Block.objects.get(pk=self.child['id'])
-            if not self._check_user_permissions(user, child_block):
+            if not permissions.can_edit(child_block.pk):
                 return Response(
                     {"error": f"You do not have permission to delete this block. {self.child['id']}"},
                     status=status.HTTP_403_FORBIDDEN)
@@ -103,20 +153,13 @@ class DeleteBlockView(APIView):
         return Response(status=status.HTTP_401_UNAUTHORIZED)
 
     def _update_parent(self, parent, request):
-        serializer = BlockSerializer(parent, data=self.parent, partial=True)
+        serializer = BlockSerializer(parent, data=self.parent, partial=True,
+                                     context={'permissions': get_block_permissions(request)})
         if serializer.is_valid():
             serializer.save()
             return True
         return serializer.errors
 
-    def _check_user_permissions(self, user, block):
-        if block.creator == user:
-            return True
-
-        if block.editable_by_users.filter(id=user.id).exists():
-            return True
-        return False
-
     def _is_valid(self, data):
         self.parent = data.get('parent')
         parent_id = self.parent.get('id')
@@ -137,20 +180,33 @@ class DeleteBlockView(APIView):
 
 
 class BlockView(APIView):
+    renderer_classes = TREE_RENDERER_CLASSES
+
     def get(self, request, pk=None):
         user = request.user
+        layout = tree_layout(request)
         if user.is_authenticated:
-            print(user.id, pk)
-            data = get_flat_map_blocks(user.id, pk)
-            print(data)
-            return Response(data, status=status.HTTP_200_OK)
-
-        data = get_flat_map_blocks(2, 2)
-        return Response(data, status=status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
+            params = TreeParamsSerializer(data=request.query_params)
+            params.is_valid(raise_exception=True)
+            etag, last_modified, change_version = get_subtree_version(user.id, pk, **params.validated_data,
+                                                                      layout=layout)
+            if is_not_modified(request, etag):
+                return set_version_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified,
+                                           change_version)
+            if request.query_params.get('stream') and layout == 'json':
+                # Большие поддеревья: строки идут клиенту по мере чтения серверного курсора, без кэша
+                response = StreamingHttpResponse(stream_flat_map_blocks(user.id, [pk], **params.validated_data),
+                                                 content_type='application/json')
+                return set_version_headers(response, etag, last_modified, change_version)
+            response = tree_response(get_flat_map_json(user.id, pk, **params.validated_data, layout=layout, etag=etag),
+                                     layout)
+            return set_version_headers(response, etag, last_modified, change_version)
+
+        return tree_response(get_flat_map_json(INFORM_BLOCK_USER_ID, INFORM_BLOCK_ID, layout=layout), layout,
+                             status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
 
     def patch(self, request, pk=None):
         user = request.user
-        print(request.data)
         if not user.is_authenticated:
             return Response({}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -159,14 +215,18 @@ class BlockView(APIView):
         except Block.DoesNotExist:
             return Response({'error': 'Object not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-        if user not in block.editable_by_users.all() and block.access_type != 'public_editable':
+        if not get_block_permissions(request).can_edit(block.pk):
             return Response({'error': 'You do not have permission to edit this block.'},
                             status=status.HTTP_403_FORBIDDEN)
 
-        serializer = BlockSerializer(block, data=request.data, partial=True)
-        print(request.data)
+        serializer = BlockSerializer(block, data=request.data, partial=True,
+                                     context={'permissions': get_block_permissions(request)})
         if serializer.is_valid():
-            serializer.save()
+            try:
+                with transaction.atomic(), capture_changes(user.id):
+                    serializer.save()
+            except BlockCycleError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -184,7 +244,7 @@ class BlockView(APIView):
         # parent = get_object_or_404(Block, pk=parent_id)
 
         # Проверка прав пользователя
-        if not self._check_user_permissions(user, block):
+        if not get_block_permissions(request).can_edit(block.pk):
             return Response(
                 {"error": "You do not have permission to delete this block."},
                 status=status.HTTP_403_FORBIDDEN
@@ -208,11 +268,13 @@ class BlockView(APIView):
             return Response({}, status=status.HTTP_401_UNAUTHORIZED)
 
         request.data['creator'] = user.id
-        print(request.data)
-        serializer = BlockSerializer(data=request.data)
+        serializer = BlockSerializer(data=request.data, context={'permissions': get_block_permissions(request)})
         if serializer.is_valid():
-            serializer.save()
-            print(serializer.data)
+            try:
+                with transaction.atomic():
+                    serializer.save()
+            except BlockCycleError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -230,6 +292,212 @@ class BlockView(APIView):
         # return Response({'parent': parent, 'child': child}, status=status.HTTP_201_CREATED)
 
 
+class BlockBatchView(APIView):
+    def post(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        serializer = BlockBatchSerializer(data=request.data, user=user, permissions=get_block_permissions(request))
+        if serializer.is_valid():
+            try:
+                return Response({'results': serializer.save()}, status=status.HTTP_200_OK)
+            except BlockCycleError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.errors, status=serializer.status)
+
+
+class BlockMoveView(APIView):
+    def post(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        serializer = BlockMoveSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        source, target = serializer.validated_data['from_parent'], serializer.validated_data['to_parent']
+
+        block = get_object_or_404(Block, pk=pk)
+        parents = Block.objects.in_bulk({source['id'], target['id']})
+        if len(parents) != len({source['id'], target['id']}):
+            return Response({'error': 'Parent block not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if get_block_permissions(request).editable(parents) != set(parents):
+            return Response({'error': 'You do not have permission to edit this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        children = Block.children.through.objects.filter(to_block_id=block.pk)
+        try:
+            with transaction.atomic(), capture_changes(user.id):
+                if not children.filter(from_block_id=source['id']).exists():
+                    return Response({'error': 'Block is not a child of from_parent.'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                if source['id'] != target['id']:
+                    if children.filter(from_block_id=target['id']).exists():
+                        return Response({'error': 'Block is already a child of to_parent.'},
+                                        status=status.HTTP_400_BAD_REQUEST)
+                    parents[source['id']].children.remove(block)
+                    # Проверка на цикл и блокировка иерархии - в сигнале children (api/hierarchy.py)
+                    parents[target['id']].children.add(block)
+
+                for data in (source, target):
+                    fields = [field for field in ('children_position', 'classList') if field in data]
+                    if fields:
+                        parent = parents[data['id']]
+                        for field in fields:
+                            setattr(parent, field, data[field])
+                        # Без revision: её только что увеличили сигналы children
+                        parent.save(update_fields=[*fields, 'updated_at'])
+        except BlockCycleError:
+            return Response({'error': 'Block cannot be moved into its own subtree.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'from_parent': BlockSerializer(parents[source['id']]).data,
+                         'to_parent': BlockSerializer(parents[target['id']]).data},
+                        status=status.HTTP_200_OK)
+
+
+class BlockCloneView(APIView):
+    """Копия поддерева pk (только видимые блоки) в новом родителе, без передачи дерева через клиент."""
+
+    def post(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        serializer = BlockCloneSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        block = get_object_or_404(Block, pk=pk)
+        parent = Block.objects.filter(pk=data['parent']).first()
+        if parent is None:
+            return Response({'error': 'Parent block not found.'}, status=status.HTTP_404_NOT_FOUND)
+        permissions = get_block_permissions(request)
+        if not permissions.can_view(block.pk):
+            return Response({'error': 'You do not have permission to view this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+        if not permissions.can_edit(parent.pk):
+            return Response({'error': 'You do not have permission to edit this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        with transaction.atomic(), capture_changes(user.id):
+            block_id, blocks = clone_subtree(user.id, block.pk, parent)
+            fields = []
+            if 'position' in data:
+                parent.children_position = {**(parent.children_position or {}), str(block_id): data['position']}
+                fields.append('children_position')
+            if 'classList' in data:
+                parent.classList = data['classList']
+                fields.append('classList')
+            if fields:
+                # Без revision: её только что увеличили сигналы children
+                parent.save(update_fields=[*fields, 'updated_at'])
+
+        return Response({'block_id': block_id, 'blocks': blocks, 'parent': BlockSerializer(parent).data},
+                        status=status.HTTP_201_CREATED)
+
+
+class BlockExportView(APIView):
+    """Выгрузка видимого поддерева pk в NDJSON (формат см. api/transfer.py), потоком."""
+
+    def get(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        block = get_object_or_404(Block, pk=pk)
+        if not get_block_permissions(request).can_view(block.pk):
+            return Response({'error': 'You do not have permission to view this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        response = StreamingHttpResponse(iter_subtree_export(user.id, block.pk), content_type=NDJSON_CONTENT_TYPE)
+        response['Content-Disposition'] = f'attachment; filename="block-{block.pk}.ndjson"'
+        return response
+
+
+class BlockImportView(APIView):
+    """Загрузка NDJSON-выгрузки из тела запроса; корень выгрузки становится ребёнком pk."""
+
+    def post(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        parent = get_object_or_404(Block, pk=pk)
+        if not get_block_permissions(request).can_edit(parent.pk):
+            return Response({'error': 'You do not have permission to edit this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        # Тело читается построчно, без request.data: файл не держится в памяти целиком
+        stream = request.stream
+        lines = iter(stream.readline, b'') if stream is not None else []
+        try:
+            with transaction.atomic(), capture_changes(user.id):
+                block_id, blocks = import_subtree(user.id, lines, parent)
+        except BlockImportError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'block_id': block_id, 'blocks': blocks}, status=status.HTTP_201_CREATED)
+
+
+class ExpandBlocksView(APIView):
+    """
+    Догрузка нескольких узлов с is_fully_loaded = false одним запросом.
+    Общие узлы поддеревьев возвращаются один раз, paths считаются от запрошенных block_ids.
+    """
+
+    def post(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        serializer = ExpandBlocksSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        params = serializer.validated_data
+        data = load_flat_map_blocks(user.id, params['block_ids'], params['depth'], params['max_children'])
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class BlockChangesView(APIView):
+    def get(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        params = BlockChangesParamsSerializer(data=request.query_params)
+        if not params.is_valid():
+            return Response(params.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        block = get_object_or_404(Block, pk=pk)
+        if not get_block_permissions(request).can_view(block.pk):
+            return Response({'error': 'You do not have permission to view this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        data = get_block_changes(user.id, pk, **params.validated_data)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class BlockEventsTicketView(APIView):
+    """Билет для подписки на события блока из EventSource, см. api/events.py."""
+
+    def post(self, request, pk):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        block = get_object_or_404(Block, pk=pk)
+        if not get_block_permissions(request).can_view(block.pk):
+            return Response({'error': 'You do not have permission to view this block.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        return Response({'ticket': make_events_ticket(user.id, block.pk), 'expires_in': EVENTS_TICKET_MAX_AGE},
+                        status=status.HTTP_201_CREATED)
+
+
 class BlockChangeLogView(APIView):
     def get(self, request, pk):
         user = request.user
@@ -240,67 +508,199 @@ class BlockChangeLogView(APIView):
         except Block.DoesNotExist:
             return Response({'error': 'Block not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-        if user not in block.visible_to_users.all() and (block.access_type != 'public' and
-                                                         block.access_type != 'public_editable'):
+        if not get_block_permissions(request).can_view(block.pk):
             return Response({'error': 'You do not have permission to view this block.'},
                             status=status.HTTP_401_UNAUTHORIZED)
 
-        try:
-            change_log = BlockChangeLog.objects.filter(block=pk)
-        except BlockChangeLog.DoesNotExist:
-            return Response({'error': 'Change log not found.'}, status=status.HTTP_404_NOT_FOUND)
+        change_log = BlockChangeLog.objects.filter(block=pk).select_related('changed_by')
+        paginator = ChangeLogPagination()
+        page = paginator.paginate_queryset(change_log, request, view=self)
+        serializer = ChangeLogSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
-        serializer = ChangeLogSerializer(change_log, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
 
+class BlockSearchView(APIView):
+    def get(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return Response({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        params = BlockSearchParamsSerializer(data=request.query_params)
+        if not params.is_valid():
+            return Response(params.errors, status=status.HTTP_400_BAD_REQUEST)
 
-def get_flat_map_blocks(user_id, block_id):
-    print(user_id, block_id)
+        data = search_blocks(user.id, **params.validated_data)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+def search_blocks(user_id, q, limit, after_rank=None, after_id=None):
+    """Страница результатов поиска и ключ следующей страницы (None, если страница последняя)."""
+    with connection.cursor() as cursor:
+        cursor.execute(search_blocks_query, {'user_id': user_id, 'query': q, 'limit': limit + 1,
+                                             'after_rank': after_rank, 'after_id': after_id})
+        rows = cursor.fetchall()
+
+    results = [{'id': block_id, 'text': text, 'updated_at': updated_at, 'rank': rank,
+                'path': (path or [block_id])[:-1]}
+               for block_id, text, updated_at, rank, path in rows[:limit]]
+    next_page = None
+    if len(rows) > limit:
+        next_page = {'after_rank': results[-1]['rank'], 'after_id': results[-1]['id']}
+    return {'results': results, 'next': next_page}
+
+
+def get_subtree_version(user_id, block_id, depth=DEFAULT_TREE_DEPTH, max_children=None, layout='json'):
+    """
+    Возвращает (etag, last_modified, change_version) поддерева без построения самого дерева.
+    change_version - версия delta sync (since для /changes/) того же снимка, что и etag.
+    """
     with connection.cursor() as cursor:
-        cursor.execute(get_blocks_query, {'user_id': user_id, 'block_id': block_id})
+        subtree_version_statement.execute(cursor, {'user_id': user_id, 'block_id': block_id, 'max_depth': depth})
+        updated_at, change_seq, revisions, paths_count, is_visible, change_version = cursor.fetchone()
+    version = (f'{user_id}:{block_id}:{depth}:{max_children}:{layout}:'
+               f'{change_seq}:{revisions}:{paths_count}:{is_visible}')
+    return 'W/' + quote_etag(hashlib.md5(version.encode()).hexdigest()), updated_at, change_version
+
+
+def is_not_modified(request, etag):
+    # Для GET If-None-Match сравнивается слабо, поэтому префикс W/ не учитывается
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return '*' in etags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+
+
+def set_version_headers(response, etag, last_modified, change_version=None):
+    response['ETag'] = etag
+    # И для 304: кэш должен различать json и columnar одного поддерева
+    patch_vary_headers(response, ['Accept'])
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if change_version is not None:
+        # since для первого запроса /changes/ после загрузки дерева
+        response[CHANGE_VERSION_HEADER] = str(change_version)
+    return response
+
+
+def get_flat_map_json(user_id, block_id, depth=DEFAULT_TREE_DEPTH, max_children=None, layout='json', etag=None):
+    """
+    Дерево блоков {id: блок} готовым JSON (bytes), собранным в Postgres, без разбора строк в Python.
+    layout - вид документа из TREE_LAYOUT_STATEMENTS, etag - версия поддерева из get_subtree_version
+    (входит в ключ кэша).
+    """
+    tree_cache = get_tree_cache()
+    key = (user_id, block_id, depth, max_children, layout, etag)
+    result = tree_cache.get(key)
+    if result is None:
+        generation = tree_cache.generation()
+        with connection.cursor() as cursor:
+            TREE_LAYOUT_STATEMENTS[layout].execute(cursor, _tree_query_params(user_id, [block_id], depth, max_children))
+            document, block_ids = cursor.fetchone()
+        result = document.encode()
+        tree_cache.set(key, result, set(block_ids) | {block_id}, generation)
+    return result
+
+
+def json_response(content, status_code=status.HTTP_200_OK, content_type='application/json'):
+    """Ответ с уже готовым JSON: рендер DRF не нужен."""
+    return HttpResponse(content, status=status_code, content_type=content_type)
+
+
+def tree_layout(request):
+    """Вид документа с деревом по результату content negotiation DRF (Accept или ?format=columnar)."""
+    return 'columnar' if request.accepted_renderer.format == ColumnarTreeRenderer.format else 'json'
+
+
+def tree_response(content, layout, status_code=status.HTTP_200_OK):
+    content_type = ColumnarTreeRenderer.media_type if layout == 'columnar' else 'application/json'
+    response = json_response(content, status_code, content_type)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def load_flat_map_blocks(user_id, block_ids, depth=DEFAULT_TREE_DEPTH, max_children=None, only_ids=None):
+    with connection.cursor() as cursor:
+        blocks_statement.execute(cursor, _tree_query_params(user_id, block_ids, depth, max_children, only_ids))
         columns = [col[0] for col in cursor.description]
-        json_fields = ['content_classList', 'classList', 'children_position', 'properties']  # Поля, ожидаемые как JSON
-
-        result = {}
-        for row in cursor.fetchall():
-            row_dict = dict(zip(columns, row))
-            row_dict['paths'] = row_dict['paths'].split(';')
-            # Преобразование строк, содержащих JSON, в объекты Python
-            for field in json_fields:
-                try:
-                    row_dict[field] = json.loads(row_dict[field])
-                except json.JSONDecodeError:
-                    print(f"Error decoding JSON for {field} in row {row[0]}")
-
-            result[row[0]] = row_dict
-
-        return result
-
-#
-#         request.data.pop('id')
-#         request.data.pop('created_at')
-#         request.data.pop('updated_at')
-#         request.data.pop('creator_id')
-#         request.data.pop('direct_status')
-#         request.data.pop('effective_status')
-#         request.data.pop('is_ambiguous')
-#         request.data.pop('is_fully_loaded')
-#         request.data.pop('paths')
-#         request.data.pop('styleObj')
-#         request.data.pop('children')
-#         old_data = {key: getattr(block, key) for key in request.data if
-#                     hasattr(block, key) and getattr(block, key) != request.data[key]}
-#
-#         change_log_data = {
-#             'block': block.id,
-#             'content_change': {
-#                 'old_data': old_data,
-#                 'new_data': request.data
-#             }
-#         }
-#         change_log_serializer = ChangeLogSerializer(data=change_log_data)
-#         if change_log_serializer.is_valid():
-#             change_log_serializer.save(changed_by=user)
-#         else:
-#             return Response({'errors': change_log_serializer.errors, 'test': 'test'},
-#                             status=status.HTTP_400_BAD_REQUEST)
+        return {row[0]: decode_block_row(columns, row) for row in cursor.fetchall()}
+
+
+def iter_flat_map_blocks(user_id, block_ids, depth=DEFAULT_TREE_DEPTH, max_children=None,
+                         batch_size=STREAM_BATCH_SIZE):
+    """
+    Те же строки, что и load_flat_map_blocks, но через серверный курсор: в памяти держится
+    не больше batch_size строк. Отдаёт списки пар (id, row_dict) по батчам.
+    """
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(get_blocks_query, _tree_query_params(user_id, block_ids, depth, max_children))
+        columns = None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if columns is None:
+                columns = [col[0] for col in cursor.description]
+            yield [(row[0], decode_block_row(columns, row)) for row in rows]
+
+
+def stream_flat_map_blocks(user_id, block_ids, depth=DEFAULT_TREE_DEPTH, max_children=None):
+    """JSON-объект {id: row} по частям, в том же виде, что отдаёт get_flat_map_json."""
+    encoder = JSONEncoder(ensure_ascii=False)
+    separator = ''
+    yield '{'
+    for batch in iter_flat_map_blocks(user_id, block_ids, depth, max_children):
+        chunk = ','.join(f'"{row_id}":{encoder.encode(row)}' for row_id, row in batch)
+        yield separator + chunk
+        separator = ','
+    yield '}'
+
+
+def get_block_changes(user_id, block_id, since, depth=DEFAULT_TREE_DEPTH):
+    """
+    Изменения поддерева block_id после версии since: строки изменённых (и новых) блоков в формате
+    load_flat_map_blocks, удалённые блоки и удалённые связи. Стоимость зависит от числа изменений,
+    а не от размера дерева. Новую версию клиент передаёт как since в следующем запросе, первую
+    он получает в заголовке X-Block-Version вместе с деревом. Версия - граница по транзакциям
+    (change_version_query), поэтому изменения долгих транзакций не теряются, но могут прийти дважды.
+    """
+    params = {'block_id': block_id, 'since': since, 'max_depth': depth}
+    with connection.cursor() as cursor:
+        # Версия берётся до чтения изменений, см. change_version_query
+        cursor.execute(change_version_query)
+        version = cursor.fetchone()[0]
+        cursor.execute(changed_blocks_query, params)
+        changed_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(block_tombstones_query, params)
+        tombstones = cursor.fetchall()
+
+    changed = load_flat_map_blocks(user_id, [block_id], depth, only_ids=changed_ids) if changed_ids else {}
+    return {
+        'version': version,
+        'changed': changed,
+        'deleted': sorted({block_id for _, kind, block_id, _ in tombstones if kind == 'deleted'}),
+        'unlinked': [{'parent': parent_id, 'child': child_id}
+                     for _, kind, child_id, parent_id in tombstones if kind == 'unlinked'],
+    }
+
+
+def _tree_query_params(user_id, block_ids, depth, max_children, only_ids=None):
+    return {'user_id': user_id,
+            'block_ids': list(block_ids),
+            'max_depth': depth,
+            'max_children': max_children,
+            'only_ids': None if only_ids is None else list(only_ids),
+            'media_url': settings.MEDIA_URL}
+
+
+def decode_block_row(columns, row):
+    json_fields = ['content_classList', 'classList', 'children_position', 'properties',
+                   'image_variants']  # Поля, ожидаемые как JSON
+    row_dict = dict(zip(columns, row))
+    row_dict['paths'] = row_dict['paths'].split(';')
+    # Преобразование строк, содержащих JSON, в объекты Python (уже разобранные значения и NULL не трогаются)
+    for field in json_fields:
+        if not isinstance(row_dict[field], str):
+            continue
+        try:
+            row_dict[field] = json.loads(row_dict[field])
+        except json.JSONDecodeError:
+            logger.warning('Error decoding JSON for %s in row %s', field, row[0])
+    return row_dict
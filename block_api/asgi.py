@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'block_api.settings')
+# Настройки соединений с базой зависят от того, запущен ли проект под ASGI (см. settings.DATABASES)
+os.environ.setdefault('DJANGO_ASGI', '1')
 
 application = get_asgi_application()
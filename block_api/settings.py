@@ -26,7 +26,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', '')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.getenv('DJANGO_DEBUG', '1') == '1'
 
 ALLOWED_HOSTS = []
 
@@ -45,6 +45,16 @@ CORS_ALLOW_ALL_ORIGINS = True  # Для разработки, для прода
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=30),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=60),
+    # Добавляет в токен root_block_id (api/profiles.py)
+    'TOKEN_OBTAIN_SERIALIZER': 'api.serializers.RootBlockTokenObtainPairSerializer',
+}
+
+# Проверка JWT без запроса пользователя из базы (api/authentication.py)
+JWT_AUTHENTICATION = {
+    # token - пользователь из полей токена, cache - User из кэша воркера, db - User из базы на каждый запрос
+    'USER_LOOKUP': os.getenv('JWT_USER_LOOKUP', 'token'),
+    'USER_CACHE_TTL': 60,
+    'REVOCATION_REFRESH_SECONDS': 30,
 }
 
 
@@ -58,19 +68,22 @@ INSTALLED_APPS = [
     'api.apps.ApiConfig',
     'rest_framework',
     'rest_framework_simplejwt.token_blacklist',
-    'debug_toolbar',
     'corsheaders',
 ]
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.StatelessJWTAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ),
 }
 
 
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'api.middleware.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -81,6 +94,12 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+if DEBUG:
+    # DebugToolbarMiddleware не умеет работать асинхронно: с ним ASGI выполняет асинхронные вью
+    # (api/async_views.py) через поток, как обычные, поэтому он только для разработки
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(1, 'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'block_api.urls'
 
 TEMPLATES = [
@@ -104,6 +123,9 @@ WSGI_APPLICATION = 'block_api.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Выставляется в block_api/asgi.py
+ASGI = os.getenv('DJANGO_ASGI', '') == '1'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -112,9 +134,60 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWD', ''),
         'HOST': 'localhost',
         'PORT': '5432',
+        # Постоянные соединения: по одному на поток воркера (размер ограничен числом потоков сервера),
+        # перед повторным использованием соединение проверяется.
+        # Под ASGI синхронный код запроса выполняется в разных потоках, и соединение каждого потока
+        # остаётся открытым, так что постоянные соединения выключены: пул - pgbouncer перед базой
+        # (Django 5.0 не умеет пул psycopg), асинхронные вью ходят через свой пул (api/async_db.py)
+        'CONN_MAX_AGE': 0 if ASGI else int(os.getenv('POSTGRES_CONN_MAX_AGE', 300)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# PREPARE/EXECUTE для запросов дерева и прав, см. api/prepared.py. Выключить при pgbouncer в transaction pooling
+prepare_statements = os.getenv('PREPARED_STATEMENTS', '1') == '1'
+# Без постоянных соединений (ASGI) подготовленный запрос прожил бы один запрос, остаётся только пул асинхронных вью
+PREPARED_STATEMENTS = prepare_statements and not ASGI
+
+# Пул psycopg 3 для асинхронных вью, см. api/async_db.py
+ASYNC_DB_POOL = {
+    'min_size': int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', 2)),
+    'max_size': int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', 20)),
+    # psycopg 3 готовит запрос на сервере, начиная с этого по счёту выполнения на соединении
+    'prepare_threshold': 1 if prepare_statements else None,
+}
+
+# Рассылка событий об изменениях блоков (SSE), см. api/events.py.
+# InProcessBroker работает только внутри одного процесса, для нескольких воркеров - api.events.PostgresBroker
+BLOCK_EVENTS_BROKER = {
+    'BACKEND': os.getenv('BLOCK_EVENTS_BROKER', 'api.events.InProcessBroker'),
+}
+
+# Запись истории изменений через outbox, см. api/changelog.py.
+# BACKGROUND_FLUSH = False, если переносом занимается только ./manage.py flush_changelog по расписанию
+BLOCK_CHANGELOG = {
+    'BACKGROUND_FLUSH': True,
+    'FLUSH_INTERVAL': 5.0,
+    'BATCH_SIZE': 500,
+}
+
+# Кэш поддеревьев get_flat_map_json, см. api/cache.py
+# Для нескольких воркеров: {'BACKEND': 'api.cache.SharedTreeCache', 'OPTIONS': {'alias': 'default', 'timeout': 300}}
+BLOCK_TREE_CACHE = {
+    'BACKEND': 'api.cache.LocMemTreeCache',
+    'OPTIONS': {'max_bytes': int(os.getenv('BLOCK_TREE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+                # Сброс доходит только до своего процесса, в остальных запись живёт не дольше timeout секунд
+                'timeout': int(os.getenv('BLOCK_TREE_CACHE_TIMEOUT', 60))},
+}
+
+# Замеры запросов (Server-Timing, лог медленных запросов), см. api/middleware.py.
+# Во время работы переключаются командой ./manage.py instrumentation on|off|reset
+REQUEST_INSTRUMENTATION = {
+    'ENABLED': os.getenv('REQUEST_INSTRUMENTATION', '') == '1',
+    'SLOW_REQUEST_MS': 500,
+    'EXPLAIN_SAMPLE_RATE': 0.1,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -149,6 +222,16 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Картинки блоков (api/images.py)
+MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_URL = '/media/'
+
+BLOCK_IMAGES = {
+    # Потоки, в которых строятся уменьшенные копии
+    'WORKERS': int(os.getenv('BLOCK_IMAGES_WORKERS', '2')),
+    'QUALITY': 80,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
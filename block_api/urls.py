@@ -22,6 +22,7 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
     TokenVerifyView
 )
+from api.images import serve_media
 from .settings import DEBUG
 
 urlpatterns = [
@@ -29,11 +30,13 @@ urlpatterns = [
     path('api/v1/login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/v1/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/v1/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
-    path('api/v1/', include('api.urls'))
+    path('api/v1/', include('api.urls')),
 ]
 
 if DEBUG:
     import debug_toolbar
     urlpatterns += [
         path('__debug__/', include(debug_toolbar.urls)),
+        # Без проверки прав, в продакшене MEDIA_URL раздаёт nginx (api/images.py)
+        path('media/<path:path>', serve_media, name='media'),
     ]
\ No newline at end of file